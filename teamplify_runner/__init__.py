@@ -1,4 +1,8 @@
-from importlib.metadata import version
+def __getattr__(name):
+    # Reading the package metadata takes a while, so it's only done when the
+    # version is actually needed
+    if name == '__version__':
+        from importlib.metadata import version
 
-
-__version__ = version('teamplify')
+        return version('teamplify')
+    raise AttributeError('module {0!r} has no attribute {1!r}'.format(__name__, name))
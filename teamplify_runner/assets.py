@@ -0,0 +1,62 @@
+import subprocess
+
+from teamplify_runner.configurator import str_to_bool
+
+
+APP_CONTAINER = 'teamplify_app'
+
+# Runs with the Python of the app container. Compresses the static files
+# that don't have an up-to-date .gz next to them, so it only does the work
+# once after the image is updated
+PRECOMPRESS_SCRIPT = r"""
+import gzip
+import os
+import shutil
+
+EXTENSIONS = {'.css', '.js', '.json', '.svg', '.txt', '.xml', '.map', '.ttf', '.otf', '.html'}
+count = 0
+for dirpath, _, filenames in os.walk('/static'):
+    for filename in filenames:
+        if os.path.splitext(filename)[1].lower() not in EXTENSIONS:
+            continue
+        path = os.path.join(dirpath, filename)
+        if os.path.getsize(path) < 1024:
+            continue
+        mtime = os.path.getmtime(path)
+        if os.path.exists(path + '.gz') and os.path.getmtime(path + '.gz') == mtime:
+            continue
+        with open(path, 'rb') as src, gzip.open(path + '.gz.tmp', 'wb', 9) as dst:
+            shutil.copyfileobj(src, dst)
+        os.utime(path + '.gz.tmp', (mtime, mtime))
+        os.replace(path + '.gz.tmp', path + '.gz')
+        count += 1
+print(count)
+"""
+
+
+class AssetsError(Exception):
+    pass
+
+
+def precompress_enabled(env):
+    return str_to_bool(env.get('WEB_PRECOMPRESS_STATIC', 'yes'))
+
+
+def precompress_static(container=APP_CONTAINER):
+    """
+    Saves gzipped copies of the static files in the app container, which
+    nginx serves with gzip_static instead of compressing the files on every
+    request. Returns the number of compressed files.
+    """
+    result = subprocess.run(
+        ['docker', 'exec', '-i', container, 'python3', '-'],
+        input=PRECOMPRESS_SCRIPT.encode(),
+        capture_output=True,
+    )
+    if result.returncode:
+        raise AssetsError(
+            'Failed to precompress static files: {0}'.format(
+                result.stderr.decode(errors='replace').strip(),
+            ),
+        )
+    return int(result.stdout.decode().strip() or 0)
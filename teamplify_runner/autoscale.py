@@ -0,0 +1,257 @@
+import math
+import os
+import subprocess
+import tempfile
+from collections import namedtuple
+
+from teamplify_runner.configurator import BASE_DIR, str_to_bool
+
+
+# Stop timeout of the removed workers, so that Celery finishes the tasks they
+# are running
+STOP_TIMEOUT = 300
+
+# worker_fat_penalized always runs one of the fat workers, the rest are
+# worker_fat containers
+WorkerGroup = namedtuple(
+    'WorkerGroup',
+    ('name', 'service', 'minimum', 'maximum', 'queues', 'fixed'),
+)
+
+
+class AutoscaleError(Exception):
+    pass
+
+
+def worker_groups(env, slim_max, fat_max, slim_queues, fat_queues):
+    """
+    Returns the worker groups to scale. The minimal counts are the ones from
+    the [worker] section.
+    """
+    groups = []
+    if slim_max:
+        slim_count = int(env['WORKER_SLIM_COUNT'])
+        if slim_max < slim_count:
+            raise AutoscaleError(
+                'The maximum of slim workers is less than [worker] slim_count: {0}'.format(
+                    slim_count
+                ),
+            )
+        groups.append(WorkerGroup('slim', 'worker_slim', slim_count, slim_max, slim_queues, 0))
+    if fat_max:
+        fat_count = int(env['WORKER_FAT_COUNT'])
+        if fat_max < fat_count:
+            raise AutoscaleError(
+                'The maximum of fat workers is less than [worker] fat_count: {0}'.format(fat_count),
+            )
+        groups.append(WorkerGroup('fat', 'worker_fat', fat_count, fat_max, fat_queues, 1))
+    return groups
+
+
+def redis_command(env):
+    container = (
+        'teamplify_redis_broker'
+        if str_to_bool(env.get('REDIS_SEPARATE_BROKER', 'no'))
+        else 'teamplify_redis'
+    )
+    return ['docker', 'exec', '-i', container, 'redis-cli']
+
+
+def queue_lengths(queues, command):
+    """
+    Returns {queue: length} of the Celery queues, which are Redis lists named
+    after the queues. All queues are sampled with one redis-cli call.
+    """
+    try:
+        result = subprocess.run(
+            command,
+            input=''.join('LLEN {0}\n'.format(queue) for queue in queues).encode(),
+            capture_output=True,
+            timeout=30,
+        )
+    except (OSError, subprocess.TimeoutExpired) as e:
+        raise AutoscaleError('Failed to read queue lengths: {0}'.format(e))
+    lines = result.stdout.decode().split()
+    if result.returncode or len(lines) != len(queues):
+        raise AutoscaleError(
+            'Failed to read queue lengths: {0}'.format(
+                result.stderr.decode(errors='replace').strip() or result.stdout.decode().strip(),
+            )
+        )
+    try:
+        return dict(zip(queues, (int(line) for line in lines)))
+    except ValueError:
+        raise AutoscaleError('Unexpected redis-cli output: {0}'.format(' '.join(lines)))
+
+
+class Compose:
+    def __init__(self, env, command=('docker', 'compose')):
+        self.env = {**os.environ, **env}
+        self.command = list(command)
+        # {service: (process, stderr file)} of the scalings still running
+        self.scaling = {}
+
+    def _run(self, *args):
+        result = subprocess.run(
+            self.command + list(args),
+            cwd=BASE_DIR,
+            env=self.env,
+            stdin=subprocess.DEVNULL,
+            capture_output=True,
+        )
+        if result.returncode:
+            raise AutoscaleError(
+                '{0} failed: {1}'.format(
+                    ' '.join(args[:1]),
+                    result.stderr.decode(errors='replace').strip(),
+                )
+            )
+        return result.stdout.decode()
+
+    def count(self, service):
+        return len(self._run('ps', '--quiet', '--status', 'running', service).split())
+
+    def scale(self, service, count):
+        """
+        Starts scaling the service in the background. Removing workers waits
+        up to STOP_TIMEOUT for their tasks, which must not hold up the
+        decisions for the other groups.
+        """
+        stderr = tempfile.TemporaryFile()
+        try:
+            process = subprocess.Popen(
+                self.command
+                + [
+                    'up',
+                    '--detach',
+                    '--no-deps',
+                    '--no-recreate',
+                    '--timeout',
+                    str(STOP_TIMEOUT),
+                    '--scale',
+                    '{0}={1}'.format(service, count),
+                    service,
+                ],
+                cwd=BASE_DIR,
+                env=self.env,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=stderr,
+            )
+        except OSError as e:
+            stderr.close()
+            raise AutoscaleError('Failed to scale {0}: {1}'.format(service, e))
+        self.scaling[service] = (process, stderr)
+
+    def busy(self, service):
+        """
+        Returns True while the last scaling of the service is running. If it
+        failed, raises AutoscaleError once.
+        """
+        if service not in self.scaling:
+            return False
+        process, stderr = self.scaling[service]
+        code = process.poll()
+        if code is None:
+            return True
+        del self.scaling[service]
+        with stderr:
+            if code:
+                stderr.seek(0)
+                raise AutoscaleError(
+                    'Scaling {0} failed: {1}'.format(
+                        service,
+                        stderr.read().decode(errors='replace').strip(),
+                    )
+                )
+        return False
+
+    def wait(self):
+        """
+        Waits for the scalings that are still running.
+        """
+        for service, (process, _) in list(self.scaling.items()):
+            process.wait()
+            self.busy(service)
+
+
+class Autoscaler:
+    """
+    Decides the number of workers of a group from the length of its queues.
+    Scales up as soon as the backlog needs more workers, but not more often
+    than up_cooldown. Scales down one worker at a time, and only after the
+    backlog stayed low for down_cooldown, so that a short lull doesn't stop
+    the workers a moment before the next burst.
+    """
+
+    def __init__(self, group, tasks_per_worker=10, up_cooldown=60, down_cooldown=300):
+        self.group = group
+        self.tasks_per_worker = tasks_per_worker
+        self.up_cooldown = up_cooldown
+        self.down_cooldown = down_cooldown
+        self.last_change = None
+        self.low_since = None
+
+    def _cooled_down(self, now, cooldown):
+        return self.last_change is None or now - self.last_change >= cooldown
+
+    def decide(self, current, backlog, now, overloaded=False):
+        """
+        Returns a tuple of (count, reason). The count equals the current one
+        if nothing should change.
+        """
+        group = self.group
+        wanted = math.ceil(backlog / self.tasks_per_worker)
+        wanted = max(group.minimum, min(wanted, group.maximum))
+        if wanted > current:
+            self.low_since = None
+            if overloaded:
+                return current, 'host is overloaded, not adding workers'
+            if not self._cooled_down(now, self.up_cooldown):
+                return current, 'waiting for the cooldown to add workers'
+            return wanted, 'backlog needs {0} worker(s)'.format(wanted)
+        # Hysteresis: one worker less must handle the backlog with half of
+        # its capacity to spare
+        if current > group.minimum and backlog * 2 <= (current - 1) * self.tasks_per_worker:
+            if self.low_since is None:
+                self.low_since = now
+            if now - self.low_since >= self.down_cooldown and self._cooled_down(
+                now, self.down_cooldown
+            ):
+                self.low_since = now
+                return current - 1, 'backlog stayed low'
+            return current, None
+        self.low_since = None
+        return current, None
+
+    def changed(self, now):
+        self.last_change = now
+
+
+def step(autoscalers, compose, lengths, now, overloaded=False):
+    """
+    Makes one round of scaling decisions. The groups that are still being
+    scaled are skipped, since their container counts are not settled yet.
+    Returns a list of (group name, backlog, current, new, reason) tuples for
+    the decisions worth logging. A failure of one group is reported as its
+    decision, with current and new set to None if the count is unknown, and
+    doesn't stop the others.
+    """
+    decisions = []
+    for autoscaler in autoscalers:
+        group = autoscaler.group
+        backlog = sum(lengths.get(queue, 0) for queue in group.queues)
+        current = None
+        try:
+            if compose.busy(group.service):
+                continue
+            current = compose.count(group.service) + group.fixed
+            count, reason = autoscaler.decide(current, backlog, now, overloaded=overloaded)
+            if count != current:
+                compose.scale(group.service, count - group.fixed)
+                autoscaler.changed(now)
+        except AutoscaleError as e:
+            count, reason = current, 'failed: {0}'.format(e)
+        if reason:
+            decisions.append((group.name, backlog, current, count, reason))
+    return decisions
@@ -0,0 +1,444 @@
+import gzip
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+
+from teamplify_runner.configurator import str_to_bool
+
+
+DB_CONTAINER = 'teamplify_db'
+CHUNK_SIZE = 1024 * 1024
+GZIP_BLOCK_SIZE = 4 * 1024 * 1024
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+COMPRESSION_SUFFIXES = {
+    'gzip': '.gz',
+    'zstd': '.zst',
+}
+DEFAULT_LEVELS = {
+    'gzip': 6,
+    'zstd': 3,
+}
+
+
+def format_size(size):
+    return '{0:.1f} MB'.format(size / 1024 / 1024)
+
+
+class Throughput:
+    """
+    Periodically reports the amount of data processed and the current speed.
+    """
+
+    def __init__(self, label, interval=1):
+        self.label = label
+        self.interval = interval
+        self.total = 0
+        self.start_time = time.monotonic()
+        self.last_report = self.start_time
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.start_time
+
+    def speed(self):
+        return self.total / max(self.elapsed, 0.001) / 1024 / 1024
+
+    def update(self, size):
+        self.total += size
+        now = time.monotonic()
+        if now - self.last_report >= self.interval:
+            self.last_report = now
+            # Add two spaces so we always overwrite the previous string
+            click.echo(
+                '{0} {1}, {2:.1f} MB/s ...  \r'.format(
+                    self.label,
+                    format_size(self.total),
+                    self.speed(),
+                ),
+                nl=False,
+            )
+
+    def finish(self):
+        click.echo(
+            '{0} {1} in {2:.0f} sec, {3:.1f} MB/s    '.format(
+                self.label,
+                format_size(self.total),
+                self.elapsed,
+                self.speed(),
+            ),
+        )
+
+
+class RateLimiter:
+    """
+    Token bucket that limits the average rate of the data passing through
+    it, allowing bursts of up to one second worth of data.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.last = time.monotonic()
+
+    def consume(self, size):
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        self.tokens -= size
+        if self.tokens < 0:
+            time.sleep(-self.tokens / self.rate)
+
+
+def _gzip_block(data, level):
+    # wbits=31 produces a complete gzip member. Concatenated gzip members
+    # form a valid gzip stream, so blocks can be compressed independently.
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+class ParallelGzipWriter:
+    """
+    Compresses the data written to it into the sink using a pool of threads.
+
+    zlib releases the GIL while compressing, so blocks are compressed in
+    parallel. The number of blocks in flight is bounded to keep memory usage
+    flat regardless of the input size.
+    """
+
+    def __init__(self, sink, level=None, threads=None, block_size=GZIP_BLOCK_SIZE):
+        self.sink = sink
+        self.level = DEFAULT_LEVELS['gzip'] if level is None else level
+        self.threads = threads or os.cpu_count() or 1
+        self.block_size = block_size
+        self.buffer = bytearray()
+        self.pending = deque()
+        self.executor = ThreadPoolExecutor(self.threads)
+        self.blocks_written = 0
+
+    def _submit(self, block):
+        self.pending.append(self.executor.submit(_gzip_block, block, self.level))
+        while len(self.pending) > self.threads * 2:
+            self._write_next()
+
+    def _write_next(self):
+        self.sink.write(self.pending.popleft().result())
+        self.blocks_written += 1
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            self._submit(bytes(self.buffer[: self.block_size]))
+            del self.buffer[: self.block_size]
+
+    def close(self):
+        try:
+            if self.buffer or not (self.pending or self.blocks_written):
+                self._submit(bytes(self.buffer))
+                self.buffer.clear()
+            while self.pending:
+                self._write_next()
+        finally:
+            self.executor.shutdown(cancel_futures=True)
+
+
+class ZstdWriter:
+    """
+    Compresses the data written to it into the sink with a multi-threaded
+    zstd process.
+    """
+
+    def __init__(self, sink, level=None, threads=None):
+        if not shutil.which('zstd'):
+            raise RuntimeError(
+                'zstd compression requires the "zstd" command-line tool to be installed',
+            )
+        level = DEFAULT_LEVELS['zstd'] if level is None else level
+        threads = threads or os.cpu_count() or 1
+        self.sink = sink
+        self.process = subprocess.Popen(
+            ['zstd', '-q', '-c', '-{0}'.format(level), '-T{0}'.format(threads)],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+        self.copier = threading.Thread(target=self._copy_output, daemon=True)
+        self.copier.start()
+
+    def _copy_output(self):
+        shutil.copyfileobj(self.process.stdout, self.sink, CHUNK_SIZE)
+
+    def write(self, data):
+        self.process.stdin.write(data)
+
+    def close(self):
+        self.process.stdin.close()
+        self.copier.join()
+        if self.process.wait():
+            raise RuntimeError('zstd failed, exit code {0}'.format(self.process.returncode))
+
+
+def compressor(compression, sink, level=None, threads=None):
+    if compression == 'zstd':
+        return ZstdWriter(sink, level=level, threads=threads)
+    return ParallelGzipWriter(sink, level=level, threads=threads)
+
+
+class ZstdReader:
+    """
+    File-like object that decompresses a zstd stream with the zstd tool.
+    """
+
+    def __init__(self, source):
+        if not shutil.which('zstd'):
+            raise RuntimeError(
+                'Restoring zstd archives requires the "zstd" command-line tool to be installed',
+            )
+        self.source = source
+        self.process = subprocess.Popen(
+            ['zstd', '-q', '-d', '-c'],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+        self.feeder = threading.Thread(target=self._feed_input, daemon=True)
+        self.feeder.start()
+
+    def _feed_input(self):
+        try:
+            shutil.copyfileobj(self.source, self.process.stdin, CHUNK_SIZE)
+        except BrokenPipeError:
+            pass
+        finally:
+            try:
+                self.process.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    def read(self, size=-1):
+        return self.process.stdout.read(size)
+
+    def read1(self, size=-1):
+        return self.process.stdout.read1(size)
+
+    def readline(self, size=-1):
+        return self.process.stdout.readline(size)
+
+    def __iter__(self):
+        return iter(self.process.stdout)
+
+    def close(self):
+        self.process.stdout.close()
+        self.feeder.join()
+        if self.process.wait() not in (0, -13):
+            raise RuntimeError('zstd failed, exit code {0}'.format(self.process.returncode))
+
+
+def decompressor(source):
+    """
+    Returns a file-like object with the decompressed contents of the source.
+    The compression format is detected from the magic bytes of the stream.
+    """
+    magic = source.peek(4)[:4] if hasattr(source, 'peek') else b''
+    if magic.startswith(GZIP_MAGIC):
+        return gzip.GzipFile(fileobj=source, mode='rb')
+    if magic == ZSTD_MAGIC:
+        return ZstdReader(source)
+    raise RuntimeError('Unknown archive format, expected gzip or zstd')
+
+
+class FileTarget:
+    """
+    Local file that a backup is written to. If the backup fails, the file is
+    removed unless it existed before.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.cleanup_on_error = not os.path.exists(path)
+        self.file = open(path, 'wb')
+
+    @property
+    def size(self):
+        return os.path.getsize(self.path)
+
+    def write(self, data):
+        self.file.write(data)
+
+    def close(self):
+        self.file.close()
+
+    def abort(self):
+        self.file.close()
+        if self.cleanup_on_error and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class ArchiveSource:
+    """
+    Decompressed contents of a local backup archive.
+    """
+
+    def __init__(self, path):
+        self.name = os.path.basename(path)
+        self.size = os.path.getsize(path)
+        self.file = open(path, 'rb')
+        try:
+            self.stream = decompressor(self.file)
+        except BaseException:
+            self.file.close()
+            raise
+
+    def position(self):
+        # The raw file offset is read without taking the buffer lock, so it
+        # can be polled while another thread is reading the file
+        return os.lseek(self.file.fileno(), 0, os.SEEK_CUR)
+
+    def close(self):
+        try:
+            self.stream.close()
+        finally:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def mysql_env(env):
+    # Passing the variable name without a value makes docker exec take it
+    # from the environment of the client, so the password does not show up
+    # in the process list on the host
+    return {**os.environ, 'MYSQL_PWD': env['DB_PASSWORD']}
+
+
+def binlog_enabled(env):
+    return str_to_bool(env.get('DB_BINLOG', 'no'))
+
+
+def dump_command(env, nice=False):
+    command = [
+        'docker',
+        'exec',
+        '-e',
+        'MYSQL_PWD',
+        DB_CONTAINER,
+    ]
+    if nice:
+        command += ['nice', '-n', '19']
+    command += [
+        'mysqldump',
+        '--single-transaction',
+        '-u{0}'.format(env['DB_USER']),
+        '-h',
+        'localhost',
+    ]
+    if binlog_enabled(env):
+        # Record the binlog position of the snapshot as a comment in the
+        # dump, incremental backups continue from it
+        command.append('--source-data=2')
+    command.append(env['DB_NAME'])
+    return command
+
+
+def mysql_command(env, database=True):
+    command = [
+        'docker',
+        'exec',
+        '-i',
+        '-e',
+        'MYSQL_PWD',
+        DB_CONTAINER,
+        'mysql',
+        '-u{0}'.format(env['DB_USER']),
+    ]
+    if database:
+        command.append(env['DB_NAME'])
+    return command
+
+
+def _read_error(stderr):
+    stderr.seek(0)
+    return stderr.read().decode(errors='replace').strip()
+
+
+def dump(env, writer, command=None, rate_limit=None):
+    """
+    Streams the DB dump out of the DB container into the writer without
+    intermediate files. Returns the number of uncompressed bytes.
+
+    With rate_limit (bytes per second), the dump is read slower. mysqldump
+    streams rows as they are read, so this also slows down the reads on the
+    DB server.
+    """
+    progress = Throughput('Dumped')
+    limiter = RateLimiter(rate_limit) if rate_limit else None
+    with tempfile.TemporaryFile() as stderr:
+        process = subprocess.Popen(
+            command or dump_command(env),
+            stdout=subprocess.PIPE,
+            stderr=stderr,
+            env=mysql_env(env),
+        )
+        try:
+            while True:
+                chunk = process.stdout.read1(CHUNK_SIZE)
+                if not chunk:
+                    break
+                writer.write(chunk)
+                progress.update(len(chunk))
+                if limiter:
+                    limiter.consume(len(chunk))
+        except BaseException:
+            process.kill()
+            raise
+        finally:
+            process.stdout.close()
+            code = process.wait()
+        if code:
+            raise RuntimeError(
+                'mysqldump failed, exit code {0}: {1}'.format(code, _read_error(stderr)),
+            )
+    progress.finish()
+    return progress.total
+
+
+def load(env, source, command=None):
+    """
+    Streams the uncompressed SQL from the source into the DB container.
+    """
+    progress = Throughput('Restored')
+    with tempfile.TemporaryFile() as stderr:
+        process = subprocess.Popen(
+            command or mysql_command(env),
+            stdin=subprocess.PIPE,
+            stderr=stderr,
+            env=mysql_env(env),
+        )
+        try:
+            while True:
+                chunk = source.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                process.stdin.write(chunk)
+                progress.update(len(chunk))
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+        except BaseException:
+            process.kill()
+            raise
+        code = process.wait()
+        if code:
+            raise RuntimeError(
+                'mysql failed, exit code {0}: {1}'.format(code, _read_error(stderr)),
+            )
+    progress.finish()
@@ -0,0 +1,225 @@
+import json
+import math
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from urllib.parse import urljoin
+
+import requests
+
+
+# Upper bounds of the latency histogram buckets, in milliseconds
+BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+PERCENTILES = (50, 95, 99)
+
+Sample = namedtuple('Sample', ('path', 'status', 'latency', 'warmup'))
+
+
+class BenchError(Exception):
+    pass
+
+
+def percentile(ordered, p):
+    """
+    Nearest-rank percentile of a sorted list.
+    """
+    if not ordered:
+        return 0.0
+    rank = max(math.ceil(p / 100 * len(ordered)), 1)
+    return ordered[rank - 1]
+
+
+def histogram(latencies):
+    """
+    Returns a list of (upper bound in ms or None for the rest, count).
+    """
+    counts = [0] * (len(BUCKETS) + 1)
+    for latency in latencies:
+        milliseconds = latency * 1000
+        for i, bound in enumerate(BUCKETS):
+            if milliseconds <= bound:
+                counts[i] += 1
+                break
+        else:
+            counts[-1] += 1
+    return list(zip(BUCKETS + (None,), counts))
+
+
+def _stats(samples, duration):
+    ordered = sorted(s.latency for s in samples)
+    errors = sum(1 for s in samples if not s.status or s.status >= 400)
+    stats = OrderedDict(
+        (
+            ('requests', len(samples)),
+            ('errors', errors),
+            ('throughput', len(samples) / duration if duration else 0.0),
+        )
+    )
+    for p in PERCENTILES:
+        stats['p{0}'.format(p)] = percentile(ordered, p) * 1000
+    stats['max'] = ordered[-1] * 1000 if ordered else 0.0
+    return stats
+
+
+def summarize(samples, duration):
+    """
+    Returns the results of a run: the total stats, the stats of each path and
+    the latency histogram. Requests started during the ramp-up are left out,
+    as the app is not under the full load yet. Latencies are in milliseconds.
+    """
+    measured = [s for s in samples if not s.warmup]
+    summary = _stats(measured, duration)
+    summary['paths'] = OrderedDict()
+    for path in sorted({s.path for s in measured}):
+        summary['paths'][path] = _stats([s for s in measured if s.path == path], duration)
+    summary['histogram'] = [
+        [bound, count] for bound, count in histogram(s.latency for s in measured)
+    ]
+    return summary
+
+
+def _slot_time(i, rate, ramp_up):
+    """
+    Returns the offset from the start at which the i-th request is due, with
+    the rate growing linearly from zero during the ramp-up.
+    """
+    ramp_requests = rate * ramp_up / 2
+    if i < ramp_requests:
+        return math.sqrt(2 * ramp_up * i / rate)
+    return ramp_up + (i - ramp_requests) / rate
+
+
+class Bench:
+    """
+    Sends requests to the paths in turn from a number of threads, each with
+    its own keep-alive connection.
+
+    Without a rate, every thread sends the next request as soon as it gets
+    the response, and the threads start one by one during the ramp-up. With
+    a rate, requests are sent on a fixed schedule, and their latency counts
+    from the time they were due. So if the app falls behind, the wait in the
+    queue shows in the latency instead of slowing down the test.
+    """
+
+    def __init__(
+        self,
+        url,
+        paths=('/',),
+        concurrency=10,
+        duration=30,
+        ramp_up=0,
+        rate=None,
+        timeout=30,
+        verify=True,
+    ):
+        self.url = url
+        self.paths = paths
+        self.concurrency = concurrency
+        self.duration = duration
+        self.ramp_up = ramp_up
+        self.rate = rate
+        self.timeout = timeout
+        self.verify = verify
+        self.lock = threading.Lock()
+        self.samples = []
+        self.next_slot = 0
+        self.start = None
+
+    def _request(self, session, i, due):
+        path = self.paths[i % len(self.paths)]
+        try:
+            response = session.get(
+                urljoin(self.url, path),
+                timeout=self.timeout,
+                verify=self.verify,
+                allow_redirects=False,
+            )
+            # Download the whole body, as a browser would
+            response.content
+            status = response.status_code
+        except requests.RequestException:
+            status = 0
+        latency = time.perf_counter() - due
+        with self.lock:
+            self.samples.append(Sample(path, status, latency, due - self.start < self.ramp_up))
+
+    def _take_slot(self):
+        with self.lock:
+            i = self.next_slot
+            self.next_slot += 1
+        return i
+
+    def _closed_loop(self, worker):
+        time.sleep(self.ramp_up * worker / self.concurrency)
+        deadline = self.start + self.ramp_up + self.duration
+        with requests.Session() as session:
+            while time.perf_counter() < deadline:
+                self._request(session, self._take_slot(), time.perf_counter())
+
+    def _fixed_rate(self, worker):
+        deadline = self.start + self.ramp_up + self.duration
+        with requests.Session() as session:
+            while True:
+                i = self._take_slot()
+                due = self.start + _slot_time(i, self.rate, self.ramp_up)
+                if due >= deadline:
+                    return
+                time.sleep(max(due - time.perf_counter(), 0))
+                self._request(session, i, due)
+
+    def run(self):
+        """
+        Returns the summary of the run.
+        """
+        target = self._fixed_rate if self.rate else self._closed_loop
+        self.start = time.perf_counter()
+        threads = [
+            threading.Thread(target=target, args=(worker,), daemon=True)
+            for worker in range(self.concurrency)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if not self.samples:
+            raise BenchError('No requests were made')
+        if all(s.status == 0 for s in self.samples):
+            raise BenchError('All requests to {0} failed'.format(self.url))
+        summary = summarize(self.samples, self.duration)
+        summary['settings'] = OrderedDict(
+            (
+                ('url', self.url),
+                ('paths', list(self.paths)),
+                ('concurrency', self.concurrency),
+                ('duration', self.duration),
+                ('ramp_up', self.ramp_up),
+                ('rate', self.rate),
+            )
+        )
+        return summary
+
+
+def save_results(summary, path):
+    with open(path, 'w') as f:
+        json.dump(summary, f, indent=2)
+
+
+def load_results(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        raise BenchError('Failed to load {0}: {1}'.format(path, e))
+
+
+def compare_results(baseline, summary):
+    """
+    Returns a list of (name, baseline, current, change in percent) for the
+    throughput and the latency percentiles.
+    """
+    rows = []
+    for name in ['throughput'] + ['p{0}'.format(p) for p in PERCENTILES] + ['max']:
+        before, after = baseline.get(name, 0.0), summary.get(name, 0.0)
+        change = (after - before) / before * 100 if before else None
+        rows.append((name, before, after, change))
+    return rows
@@ -0,0 +1,280 @@
+import io
+import json
+import os
+import re
+import shutil
+import subprocess
+import tarfile
+import tempfile
+from datetime import datetime
+
+import click
+
+from teamplify_runner.backup import (
+    DB_CONTAINER,
+    ArchiveSource,
+    format_size,
+    load,
+    mysql_command,
+    mysql_env,
+)
+
+
+STATE_FILENAME = 'binlog_state.json'
+MANIFEST_NAME = 'manifest.json'
+BINLOG_EXTENSION = '.binlog.tar'
+RESTORE_DIRNAME = 'restore_binlog'
+
+SOURCE_POSITION = re.compile(
+    rb'CHANGE (?:MASTER|REPLICATION SOURCE) TO '
+    rb"(?:MASTER|SOURCE)_LOG_FILE='(?P<file>[^']+)', "
+    rb'(?:MASTER|SOURCE)_LOG_POS=(?P<position>\d+)',
+)
+
+
+class BinlogError(Exception):
+    pass
+
+
+def parse_source_position(data):
+    match = SOURCE_POSITION.search(data)
+    if not match:
+        return None
+    return {
+        'file': match.group('file').decode(),
+        'position': int(match.group('position')),
+    }
+
+
+class PositionSniffer:
+    """
+    Passes the dump through to the writer and picks up the binlog position
+    that mysqldump records at the beginning of the dump.
+    """
+
+    limit = 64 * 1024
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.head = b''
+        self.position = None
+
+    def write(self, data):
+        if self.position is None and len(self.head) < self.limit:
+            self.head += data[: self.limit]
+            self.position = parse_source_position(self.head)
+        self.writer.write(data)
+
+    def close(self):
+        self.writer.close()
+
+
+def state_path(env):
+    return os.path.join(env['DB_BACKUP_MOUNT'], STATE_FILENAME)
+
+
+def load_state(env):
+    try:
+        with open(state_path(env)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def save_state(env, state):
+    path = state_path(env)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def clear_state(env):
+    try:
+        os.remove(state_path(env))
+    except FileNotFoundError:
+        pass
+
+
+def query(env, sql):
+    """
+    Runs the SQL in the DB container and returns the result rows.
+    """
+    result = subprocess.run(
+        mysql_command(env, database=False) + ['-N', '-B', '-e', sql],
+        stdin=subprocess.DEVNULL,
+        capture_output=True,
+        env=mysql_env(env),
+    )
+    if result.returncode:
+        raise BinlogError(
+            'mysql failed, exit code {0}: {1}'.format(
+                result.returncode,
+                result.stderr.decode(errors='replace').strip(),
+            ),
+        )
+    return [line.split('\t') for line in result.stdout.decode().splitlines()]
+
+
+def files_to_ship(binary_logs, start_file):
+    """
+    Returns the closed binlog files starting from start_file. The last file
+    in the list is the one the server currently writes to, so it's skipped.
+    """
+    names = [name for name, _ in binary_logs]
+    if start_file not in names:
+        raise BinlogError(
+            'Binlog {0} is no longer available on the server, probably it '
+            'has expired. Please make a new full backup'.format(start_file),
+        )
+    return binary_logs[names.index(start_file) : -1]
+
+
+def incremental_backup(env, writer):
+    """
+    Ships the binlog segments written since the previous full or incremental
+    backup into a tar archive. Returns the manifest of the archive.
+    """
+    state = load_state(env)
+    if not state:
+        raise BinlogError(
+            'No full backup with binlog position found, please make a full backup first',
+        )
+    query(env, 'FLUSH BINARY LOGS')
+    binary_logs = [(row[0], int(row[1])) for row in query(env, 'SHOW BINARY LOGS')]
+    files = files_to_ship(binary_logs, state['file'])
+    binlog_dir = os.path.dirname(query(env, 'SELECT @@log_bin_basename')[0][0])
+    manifest = {
+        'base': state['base'],
+        'base_position': state['base_position'],
+        'created': datetime.utcnow().replace(microsecond=0).isoformat(),
+        'start': {'file': state['file'], 'position': state['position']},
+        'end': {'file': binary_logs[-1][0], 'position': 4},
+        'files': [name for name, _ in files],
+    }
+    with tarfile.open(fileobj=writer, mode='w|') as tar:
+        data = json.dumps(manifest, indent=2).encode()
+        info = tarfile.TarInfo(MANIFEST_NAME)
+        info.size = len(data)
+        tar.addfile(info, io.BytesIO(data))
+        for name, size in files:
+            click.echo(' -> {0}, {1}'.format(name, format_size(size)))
+            process = subprocess.Popen(
+                ['docker', 'exec', DB_CONTAINER, 'cat', '/'.join((binlog_dir, name))],
+                stdout=subprocess.PIPE,
+            )
+            info = tarfile.TarInfo(name)
+            info.size = size
+            try:
+                tar.addfile(info, process.stdout)
+            finally:
+                process.stdout.close()
+                code = process.wait()
+            if code:
+                raise BinlogError('Failed to read binlog {0}'.format(name))
+    return manifest
+
+
+def read_manifest(path, opener=ArchiveSource):
+    with opener(path) as source:
+        try:
+            with tarfile.open(fileobj=source.stream, mode='r|') as tar:
+                member = tar.next()
+                if member is None or member.name != MANIFEST_NAME:
+                    raise BinlogError('Not an incremental backup: {0}'.format(path))
+                return json.load(tar.extractfile(member))
+        except tarfile.TarError:
+            raise BinlogError('Not an incremental backup: {0}'.format(path))
+
+
+def order_chain(full_backup, incrementals, opener=ArchiveSource):
+    """
+    Orders incremental backups by their binlog positions and checks that
+    they form an unbroken chain starting from the full backup.
+    """
+    remaining = {path: read_manifest(path, opener=opener) for path in incrementals}
+    base = full_backup.rstrip('/').rsplit('/', 1)[-1]
+    chain = []
+    position = None
+    while remaining:
+        if position is None:
+            candidates = [p for p, m in remaining.items() if m['start'] == m['base_position']]
+        else:
+            candidates = [p for p, m in remaining.items() if m['start'] == position]
+        if not candidates:
+            if position is None:
+                raise BinlogError(
+                    'Incremental backups do not form a continuous chain, the '
+                    'first backup after the full backup is missing',
+                )
+            raise BinlogError(
+                'Incremental backups do not form a continuous chain, the '
+                'backup starting from {0} position {1} is missing'.format(
+                    position['file'],
+                    position['position'],
+                ),
+            )
+        path = candidates[0]
+        manifest = remaining.pop(path)
+        if manifest['base'] != base:
+            raise BinlogError(
+                '{0} is based on the full backup {1}, not {2}'.format(
+                    path,
+                    manifest['base'],
+                    base,
+                ),
+            )
+        chain.append((path, manifest))
+        position = manifest['end']
+    return chain
+
+
+def replay(env, chain, until=None, restore_dir=None, opener=ArchiveSource):
+    """
+    Replays the binlogs from the incremental backups in the DB container,
+    optionally stopping at the given point in time (UTC).
+    """
+    restore_dir = restore_dir or os.path.join(env['DB_BACKUP_MOUNT'], RESTORE_DIRNAME)
+    for path, manifest in chain:
+        click.echo('Replaying {0}...'.format(path))
+        if not manifest['files']:
+            continue
+        os.makedirs(restore_dir, exist_ok=True)
+        try:
+            with opener(path) as source:
+                with tarfile.open(fileobj=source.stream, mode='r|') as tar:
+                    for member in tar:
+                        if member.name in manifest['files']:
+                            with open(os.path.join(restore_dir, member.name), 'wb') as out:
+                                shutil.copyfileobj(tar.extractfile(member), out)
+            command = [
+                'docker',
+                'exec',
+                DB_CONTAINER,
+                'mysqlbinlog',
+                '--disable-log-bin',
+                '--start-position={0}'.format(manifest['start']['position']),
+            ]
+            if until:
+                command.append('--stop-datetime={0}'.format(until.strftime('%Y-%m-%d %H:%M:%S')))
+            command += ['/'.join(('/backup', RESTORE_DIRNAME, name)) for name in manifest['files']]
+            with tempfile.TemporaryFile() as stderr:
+                process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=stderr)
+                try:
+                    load(env, process.stdout, command=mysql_command(env, database=False))
+                finally:
+                    process.stdout.close()
+                    code = process.wait()
+                if code:
+                    stderr.seek(0)
+                    raise BinlogError(
+                        'mysqlbinlog failed, exit code {0}: {1}'.format(
+                            code,
+                            stderr.read().decode(errors='replace').strip(),
+                        ),
+                    )
+        finally:
+            shutil.rmtree(restore_dir, ignore_errors=True)
+        if until and manifest['created'] >= until.isoformat():
+            # The following backups only contain changes made after the
+            # requested point in time
+            break
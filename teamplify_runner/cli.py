@@ -1,14 +1,19 @@
 #!/usr/bin/env python3
 import os
-import re
 import time
-from datetime import datetime
+from datetime import datetime, timedelta
+from functools import partial
 
 import click
-import requests
 
-from teamplify_runner import __version__
-from teamplify_runner.configurator import BASE_DIR, ConfigurationError, Configurator
+from teamplify_runner.configurator import (
+    BASE_DIR,
+    DNS_TIMEOUT,
+    PROJECT,
+    ConfigurationError,
+    Configurator,
+    HostnameResolver,
+)
 from teamplify_runner.utils import cd, compose, run
 
 
@@ -20,6 +25,12 @@ IMAGES = {
     'smtp': 'mikenye/postfix:3.5.9',
     'app': 'public.ecr.aws/q5a3z0t4/teamplify/server',
 }
+# The keys of backup.COMPRESSION_SUFFIXES, spelled out so that the options
+# don't import the backup module
+COMPRESSIONS = ('gzip', 'zstd')
+# Docker queries that should answer quickly. A hung Docker daemon fails them
+# instead of blocking the CLI forever
+QUERY_TIMEOUT = 60
 
 
 def _root_url(env):
@@ -33,72 +44,16 @@ def _root_url(env):
     return root_url
 
 
-def _wait_for_teamplify_start(url, max_minutes=10, check_interval_seconds=1):
-    click.echo('\nTeamplify will be available at {0}\n'.format(url))
-
-    status = 'Connecting'
-    start_time = time.time()
-    while time.time() < start_time + max_minutes * 60:
-        seconds_since_launch = int(time.time() - start_time)
-        minutes, seconds = divmod(seconds_since_launch, 60)
-        # Add two spaces so we always overwrite the previous string
-        click.echo(
-            '{0}, {1} min {2} sec ...  \r'.format(status, minutes, seconds),
-            nl=False,
-        )
-        time.sleep(check_interval_seconds)
-
-        try:
-            response = requests.get(url).text
-        except (requests.ConnectionError, requests.Timeout):
-            status = 'Connecting'
-            continue
-
-        if re.search(r"window.BUILD_NUMBER = '\d+'", response):
-            click.echo('\n\nTeamplify successfully started!')
-            return
-        elif 'Welcome to nginx!' in response:
-            status = 'Started nginx'
-            continue
-        elif 'Teamplify is starting...' in response:
-            status = 'Teamplify is starting'
-            continue
-        else:
-            raise RuntimeError(
-                '\n\nUnexpected response from Teamplify: {0}\n\n'
-                'Please check the Troubleshooting guide:\n -> '
-                'https://github.com/teamplify/teamplify-runner/#troubleshooting'.format(response)
-            )
-
-    raise RuntimeError(
-        "\n\nTeamplify didn't start in {0} minutes. "
-        'Please check the Troubleshooting guide:\n'
-        ' -> https://github.com/teamplify/teamplify-runner/#troubleshooting'.format(max_minutes)
-    )
-
-
 def _start(env):
+    from teamplify_runner.render import render_all
+    from teamplify_runner.rolling import scale_args, service_scale
+
     click.echo('Starting services...')
+    render_all(env)
     run('mkdir -p {0}'.format(env['DB_BACKUP_MOUNT']))
     with cd(BASE_DIR):
-        web_count = int(env['WEB_COUNT'])
-        app_replica_count = web_count - 1
-        fat_count = int(env['WORKER_FAT_COUNT'])
-        worker_fat_penalized_count = 1 if fat_count > 0 else 0
-        worker_fat_count = (fat_count - worker_fat_penalized_count) if fat_count > 0 else 0
         compose(
-            'up '
-            '--detach '
-            '--remove-orphans '
-            '--scale app_replica={app_replica_count} '
-            '--scale worker_slim={worker_slim_count} '
-            '--scale worker_fat_penalized={worker_fat_penalized_count} '
-            '--scale worker_fat={worker_fat_count}'.format(
-                app_replica_count=app_replica_count,
-                worker_slim_count=env['WORKER_SLIM_COUNT'],
-                worker_fat_penalized_count=worker_fat_penalized_count,
-                worker_fat_count=worker_fat_count,
-            ),
+            'up --detach --remove-orphans {0}'.format(' '.join(scale_args(service_scale(env)))),
             capture_output=False,
             env=env,
         )
@@ -114,20 +69,98 @@ def _start(env):
             'this server.',
         )
 
-    root_url = _root_url(env)
+    _wait_for_start(env)
+    _precompress_static(env)
+
+
+def _wait_for_start(env):
+    # The modules that use requests are imported only by the commands that
+    # need them, as loading it takes longer than the rest of the CLI
+    from teamplify_runner.readiness import wait_for_start
+
     try:
-        _wait_for_teamplify_start(root_url)
+        wait_for_start(_root_url(env), env)
     except RuntimeError as e:
         click.echo(click.style(str(e), fg='red'))
         exit(1)
 
 
+def _precompress_static(env):
+    from teamplify_runner.assets import AssetsError, precompress_enabled, precompress_static
+
+    if not precompress_enabled(env):
+        return
+    # Not critical, nginx compresses the files on the fly without it
+    try:
+        count = precompress_static()
+    except AssetsError as e:
+        click.echo(click.style(str(e), fg='yellow'), err=True)
+    else:
+        if count:
+            click.echo('Precompressed {0} static file(s)'.format(count))
+
+
+def _docker_exec(
+    container,
+    command,
+    environment=None,
+    suppress_output=False,
+    timeout=None,
+    exit_on_error=True,
+):
+    """
+    Runs the command in the container and returns its stdout lines. Uses the
+    Docker API if it's available and the docker CLI otherwise. Without
+    exit_on_error, a failed command returns None.
+    """
+    from teamplify_runner.docker_api import DockerAPIError, docker_client
+
+    client = docker_client()
+    if client is None:
+        args = ['docker', 'exec']
+        for name in environment or {}:
+            # Without a value, docker exec takes the variable from its own
+            # environment, so it doesn't show up in the process list
+            args += ['-e', name]
+        result = run(
+            args + [container] + list(command),
+            suppress_output=suppress_output,
+            timeout=timeout,
+            env=environment,
+            raise_on_error=exit_on_error,
+        )
+        if result.returncode:
+            return None
+        return result.stdout_lines
+    output = []
+    try:
+        with client.exec(container, command, env=environment, timeout=timeout) as process:
+            for stream, data in process:
+                output.append((stream, data))
+                if not suppress_output:
+                    click.echo(data, nl=False, err=stream == 'stderr')
+            code = process.exit_code()
+    except DockerAPIError as e:
+        click.echo(click.style(str(e), fg='red'), err=True)
+        exit(1)
+    if code:
+        if not exit_on_error:
+            return None
+        if suppress_output:
+            for stream, data in output:
+                click.echo(data, nl=False, err=stream == 'stderr')
+        click.echo('Command failed, exit code {0}'.format(code))
+        exit(1)
+    stdout = b''.join(data for stream, data in output if stream == 'stdout')
+    return stdout.decode(errors='replace').splitlines()
+
+
 def _create_admin(env, email, full_name):
     click.echo('Creating admin...')
-    cmd = 'docker exec teamplify_app /code/manage.py createadmin --email {0}'.format(email)
+    command = ['/code/manage.py', 'createadmin', '--email', email]
     if full_name:
-        cmd += ' --full-name "{0}"'.format(full_name)
-    run(cmd, capture_output=False, env=env)
+        command += ['--full-name', full_name]
+    _docker_exec('teamplify_app', command)
 
 
 def _stop(env):
@@ -141,10 +174,29 @@ def _stop(env):
 
 
 def _running(env):
+    from teamplify_runner.docker_api import DockerAPIError, docker_client
+
+    client = docker_client()
+    if client is not None:
+        try:
+            return bool(
+                client.containers(
+                    filters={
+                        'label': [
+                            'com.docker.compose.project={0}'.format(PROJECT),
+                            'com.docker.compose.service=app',
+                        ],
+                    },
+                ),
+            )
+        except DockerAPIError as e:
+            click.echo(click.style(str(e), fg='red'), err=True)
+            exit(1)
     with cd(BASE_DIR):
         output = compose(
             'ps -q app',
             suppress_output=True,
+            timeout=QUERY_TIMEOUT,
             env=env,
         ).stdout_lines
     return bool(output)
@@ -167,134 +219,454 @@ def _assert_builtin_db(env):
         exit(1)
 
 
-def _backup(env, filename=None):
+def _save_full_backup_state(env, name, position):
+    from teamplify_runner.binlog import save_state
+
+    if position:
+        save_state(env, {'base': name, 'base_position': position, **position})
+
+
+def _backup_to_repository(env, name, level=None, threads=None):
+    from teamplify_runner.backup import dump, format_size
+    from teamplify_runner.binlog import PositionSniffer
+    from teamplify_runner.repository import Repository, RepositoryError
+
+    repository = Repository.for_env(env)
+    click.echo('Making backup of Teamplify DB to repository:\n -> {0}'.format(repository.path))
+    click.echo('Snapshot: {0}'.format(name))
+    click.echo('Please wait...')
+    try:
+        writer = repository.writer(name, level=6 if level is None else level, threads=threads)
+    except RepositoryError as e:
+        click.echo(click.style(str(e), fg='red'), err=True)
+        exit(1)
+    sniffer = PositionSniffer(writer)
+    try:
+        dump(env, sniffer)
+        writer.close()
+    except (OSError, RuntimeError, RepositoryError) as e:
+        writer.abort()
+        click.echo(click.style(str(e), fg='red'), err=True)
+        exit(1)
+    _save_full_backup_state(env, name, sniffer.position)
+    click.echo(
+        'Done. {0} new chunk(s), {1} added to the repository'.format(
+            writer.new_chunks,
+            format_size(writer.new_size),
+        ),
+    )
+
+
+def _backup(
+    env,
+    filename=None,
+    compression='gzip',
+    level=None,
+    threads=None,
+    incremental=False,
+    repository=False,
+    rate_limit=None,
+    low_priority=False,
+):
+    from teamplify_runner.backup import (
+        COMPRESSION_SUFFIXES,
+        FileTarget,
+        compressor,
+        dump,
+        dump_command,
+        format_size,
+    )
+    from teamplify_runner.binlog import (
+        BINLOG_EXTENSION,
+        BinlogError,
+        PositionSniffer,
+        incremental_backup,
+        save_state,
+    )
+    from teamplify_runner.s3 import MultipartUpload, S3Client, S3Error, is_s3_url, parse_s3_url
+
     now = datetime.utcnow().replace(microsecond=0)
-    default_filename = '{0}_{1}.sql.gz'.format(
-        env['DB_NAME'],
-        now.isoformat('_').replace(':', '-'),
+    name = '{0}_{1}'.format(env['DB_NAME'], now.isoformat('_').replace(':', '-'))
+    if repository:
+        _backup_to_repository(env, name, level=level, threads=threads)
+        return
+    default_filename = '{0}{1}{2}'.format(
+        name,
+        BINLOG_EXTENSION if incremental else '.sql',
+        COMPRESSION_SUFFIXES[compression],
     )
-    if not filename:
-        target_file = default_filename
+    if is_s3_url(filename):
+        bucket, key = parse_s3_url(filename)
+        if not key.endswith(tuple(COMPRESSION_SUFFIXES.values())):
+            # Treat the URL as a prefix, like a directory
+            key = '/'.join(filter(None, (key.rstrip('/'), default_filename)))
+        target = 's3://{0}/{1}'.format(bucket, key)
+    elif not filename:
+        target = default_filename
     elif os.path.isdir(filename):
-        target_file = os.path.join(filename, default_filename)
+        target = os.path.join(filename, default_filename)
     else:
-        target_file = filename
-    temp_filename = os.path.join('/backup', default_filename)
-    cleanup_on_error = not os.path.exists(target_file)
-    # check for write access on the host
-    run('touch {0}'.format(target_file))
-    # check for write access inside docker
-    run('docker exec teamplify_db bash -c "touch {0}"'.format(temp_filename))
-    command = (
-        'MYSQL_PWD={password} mysqldump --single-transaction -u{user} '
-        '-h {host} {db} | gzip > {filename}'.format(
-            user=env['DB_USER'],
-            password=env['DB_PASSWORD'],
-            host='localhost',
-            db=env['DB_NAME'],
-            filename=os.path.join('/backup', default_filename),
-        )
-    )
-    click.echo('Making backup of Teamplify DB to:\n -> {0}'.format(target_file))
+        target = filename
+    if incremental:
+        click.echo('Making incremental backup of Teamplify DB to:\n -> {0}'.format(target))
+    else:
+        click.echo('Making backup of Teamplify DB to:\n -> {0}'.format(target))
     click.echo('Please wait...')
     try:
-        run(
-            'docker exec teamplify_db bash -c "{command}"'.format(
-                command=command,
-            ),
-            exit_on_error=False,
-        )
-    except RuntimeError:
-        if cleanup_on_error:
-            run('rm {0}'.format(target_file))
+        if is_s3_url(target):
+            sink = MultipartUpload(
+                S3Client.from_env(env, pool_size=int(env['S3_CONCURRENCY'])),
+                bucket,
+                key,
+                part_size=int(env['S3_PART_SIZE']) * 1024 * 1024,
+                concurrency=int(env['S3_CONCURRENCY']),
+            )
+        else:
+            sink = FileTarget(target)
+    except (OSError, S3Error) as e:
+        click.echo(click.style(str(e), fg='red'), err=True)
         exit(1)
-    run(
-        'mv {source} {target}'.format(
-            source=os.path.join(env['DB_BACKUP_MOUNT'], default_filename),
-            target=target_file,
+    try:
+        writer = compressor(compression, sink, level=level, threads=threads)
+        try:
+            if incremental:
+                manifest = incremental_backup(env, writer)
+            else:
+                writer = PositionSniffer(writer)
+                dump(
+                    env,
+                    writer,
+                    command=dump_command(env, nice=low_priority),
+                    rate_limit=rate_limit,
+                )
+        finally:
+            writer.close()
+        sink.close()
+    except (OSError, RuntimeError, BinlogError, S3Error) as e:
+        sink.abort()
+        click.echo(click.style(str(e), fg='red'), err=True)
+        exit(1)
+    if incremental:
+        save_state(
+            env,
+            {
+                'base': manifest['base'],
+                'base_position': manifest['base_position'],
+                **manifest['end'],
+            },
         )
+    else:
+        _save_full_backup_state(env, target.rsplit('/', 1)[-1], writer.position)
+    click.echo('Done. Backup size: {0}'.format(format_size(sink.size)))
+
+
+def _open_archive(env, location):
+    from teamplify_runner.backup import ArchiveSource
+    from teamplify_runner.s3 import S3Client, S3Source, is_s3_url
+
+    if is_s3_url(location):
+        concurrency = int(env['S3_CONCURRENCY'])
+        return S3Source(
+            S3Client.from_env(env, pool_size=concurrency),
+            location,
+            part_size=int(env['S3_PART_SIZE']) * 1024 * 1024,
+            concurrency=concurrency,
+        )
+    return ArchiveSource(location)
+
+
+def _mysql(env, query, suppress_output=False, timeout=None, exit_on_error=True):
+    from teamplify_runner.backup import DB_CONTAINER
+
+    return _docker_exec(
+        DB_CONTAINER,
+        ['mysql', '-u{0}'.format(env['DB_USER']), '-N', '-B', '-e', query],
+        {'MYSQL_PWD': env['DB_PASSWORD']},
+        suppress_output=suppress_output,
+        timeout=timeout,
+        exit_on_error=exit_on_error,
     )
-    click.echo('Done.')
 
 
-def _restore(env, filename):
-    click.echo('Copying the backup...')
-    restore_filename = 'restore.sql.gz'
-    restore_mount = os.path.join(env['DB_BACKUP_MOUNT'], restore_filename)
-    run('cp {0} {1}'.format(filename, restore_mount))
+def _mysql_allowed(env, statement):
+    """
+    Checks whether the DB user is allowed to run the statement, which must
+    have no lasting effect, by running it in a connection of its own.
+    """
+    result = _mysql(
+        env,
+        statement,
+        suppress_output=True,
+        timeout=QUERY_TIMEOUT,
+        exit_on_error=False,
+    )
+    return result is not None
+
+
+def _warn_skipped_tuning(consequence):
+    click.echo(
+        click.style(
+            'Warning: the DB user lacks the privileges for a faster restore, {0}'.format(
+                consequence
+            ),
+            fg='yellow',
+        ),
+        err=True,
+    )
+
+
+def _restore(env, filename=None, snapshot=None, connections=4, incrementals=(), until=None):
+    from teamplify_runner.binlog import BinlogError, clear_state, load_state, order_chain, replay
+    from teamplify_runner.repository import Repository, RepositoryError
+    from teamplify_runner.restore import restore as restore_db
+    from teamplify_runner.s3 import S3Error
+
+    opener = partial(_open_archive, env)
     try:
-        sql = 'docker exec -e MYSQL_PWD="{password}" teamplify_db mysql -u{user} -e "%s"'.format(
-            user=env['DB_USER'],
-            password=env['DB_PASSWORD'],
-        )
+        chain = order_chain(snapshot or filename, incrementals, opener=opener)
+        if snapshot:
+            source = Repository.for_env(env).open(snapshot)
+        else:
+            source = opener(filename)
+    except (OSError, RuntimeError, BinlogError, RepositoryError, S3Error) as e:
+        click.echo(click.style(str(e), fg='red'), err=True)
+        exit(1)
+    with source:
         click.echo('Dropping and re-creating the DB...')
-        run(sql % ('drop database {0}'.format(env['DB_NAME'])))
-        run(sql % ('create database {0}'.format(env['DB_NAME'])))
-        click.echo('Restoring DB backup...')
-        run(
-            'docker exec -e MYSQL_PWD="{password}" teamplify_db bash -c "'
-            'gunzip < {filename} | mysql -u{user} {db}"'.format(
-                filename='/'.join(('/backup', restore_filename)),
-                user=env['DB_USER'],
-                password=env['DB_PASSWORD'],
-                db=env['DB_NAME'],
-            ),
+        _mysql(env, 'drop database {0}'.format(env['DB_NAME']))
+        _mysql(env, 'create database {0}'.format(env['DB_NAME']))
+        # Flushing the redo log once per second instead of on every commit
+        # speeds up the bulk load considerably. It's a global setting, so it's
+        # only changed on the built-in DB and if the user is allowed to. The
+        # original value is restored when done
+        flush_setting = None
+        if env['DB_HOST'] == Configurator.defaults['db']['host'] and _mysql_allowed(
+            env,
+            'set global innodb_flush_log_at_trx_commit = @@global.innodb_flush_log_at_trx_commit',
+        ):
+            flush_setting = _mysql(
+                env,
+                'select @@global.innodb_flush_log_at_trx_commit',
+                suppress_output=True,
+                timeout=QUERY_TIMEOUT,
+            )[-1]
+            _mysql(env, 'set global innodb_flush_log_at_trx_commit = 2')
+        else:
+            _warn_skipped_tuning("redo log flushing can't be relaxed")
+        skip_binlog = _mysql_allowed(env, 'set session sql_log_bin = 0')
+        if not skip_binlog:
+            _warn_skipped_tuning('the restore will be written to the binary log')
+        click.echo(
+            'Restoring DB backup over {0} connection(s)...'.format(connections),
         )
-    finally:
-        run('rm {0}'.format(restore_mount))
+        try:
+            restore_db(
+                env,
+                source.stream,
+                connections=connections,
+                total_size=source.size,
+                position=source.position,
+                skip_binlog=skip_binlog,
+            )
+        except (RuntimeError, RepositoryError, S3Error) as e:
+            click.echo(click.style('\n' + str(e), fg='red'), err=True)
+            exit(1)
+        finally:
+            if flush_setting is not None:
+                _mysql(
+                    env,
+                    'set global innodb_flush_log_at_trx_commit = {0}'.format(flush_setting),
+                )
+    if chain:
+        try:
+            replay(env, chain, until=until, opener=opener)
+        except (RuntimeError, BinlogError, S3Error) as e:
+            click.echo(click.style(str(e), fg='red'), err=True)
+            exit(1)
+    if load_state(env):
+        # The restored DB no longer matches the binlog position of the last
+        # backup, so incremental backups must start from a new full backup
+        clear_state(env)
+        click.echo('Please make a new full backup before making incremental backups.')
     click.echo('Done.')
 
 
+def _docker_ids(client, kind, filters):
+    """
+    Returns the IDs of the Docker images, volumes or networks that match the
+    filters, a dict of {name: [values]}.
+    """
+    from teamplify_runner.docker_api import DockerAPIError
+
+    if client is None:
+        args = ' '.join(
+            '-f {0}={1}'.format(name, value) for name, values in filters.items() for value in values
+        )
+        return run(
+            'docker {0} ls {1} -q'.format(kind, args),
+            suppress_output=True,
+            timeout=QUERY_TIMEOUT,
+        ).stdout_lines
+    try:
+        if kind == 'image':
+            return [image['Id'] for image in client.images(filters)]
+        if kind == 'volume':
+            return [volume['Name'] for volume in client.volumes(filters)]
+        return [network['Id'] for network in client.networks(filters)]
+    except DockerAPIError as e:
+        click.echo(click.style(str(e), fg='red'), err=True)
+        exit(1)
+
+
+def _docker_remove(client, kind, names, suppress_output=False):
+    """
+    Removes the Docker images, volumes or networks, ignoring errors.
+    """
+    from teamplify_runner.docker_api import DockerAPIError
+
+    if client is None:
+        run(
+            'docker {0} rm {1}'.format(kind, ' '.join(names)),
+            suppress_output=suppress_output,
+            raise_on_error=False,
+        )
+        return
+    remove = {
+        'image': client.remove_image,
+        'volume': client.remove_volume,
+        'network': client.remove_network,
+    }[kind]
+    for name in names:
+        try:
+            remove(name)
+        except DockerAPIError as e:
+            if not suppress_output:
+                click.echo(str(e), err=True)
+        else:
+            if not suppress_output:
+                click.echo(name)
+
+
 def _remove_unused_images():
-    unused_images = run(
-        'docker images -f reference={0} -f dangling=true -q'.format(IMAGES['app']),
-        suppress_output=True,
-    ).stdout_lines
+    from teamplify_runner.docker_api import docker_client
+
+    client = docker_client()
+    unused_images = _docker_ids(
+        client,
+        'image',
+        {'reference': [IMAGES['app']], 'dangling': ['true']},
+    )
     click.echo('Cleanup: {0} stale image(s) found'.format(len(unused_images)))
     if unused_images:
         # Suppress errors because it might be possible
         # that some images are still used
-        run(
-            'docker rmi {0}'.format(' '.join(unused_images)),
-            suppress_output=True,
-            raise_on_error=False,
-        )
+        _docker_remove(client, 'image', unused_images, suppress_output=True)
 
 
-def cli(ctx, config):
-    config = Configurator(config).load()
-    if config.config_path:
-        click.echo('Using the configuration file at {0}'.format(config.config_path))
-    if ctx.invoked_subcommand != 'configure':
-        try:
-            config.validate()
-        except ConfigurationError as e:
-            title = 'Configuration problem'
-            title += ' - ' if len(e.messages) > 1 else ':\n -> '
-            click.echo(title + str(e), err=True)
-            click.echo('Command aborted.', err=True)
-            exit(1)
-    ctx.obj['config'] = config
-    env = config.env()
-    for image_id, reference in IMAGES.items():
-        env['IMAGE_{0}'.format(image_id.upper())] = reference
-    env['IMAGE_APP'] += ':' + env['MAIN_UPDATE_CHANNEL']
-    ctx.obj['env'] = env
+class BackupLocation(click.Path):
+    """
+    Local path or an s3://bucket/key URL
+    """
 
+    def convert(self, value, param, ctx):
+        from teamplify_runner.s3 import S3Error, is_s3_url, parse_s3_url
 
-cli.__doc__ = 'Teamplify runner v{0}'.format(__version__)
+        if is_s3_url(value):
+            try:
+                parse_s3_url(value)
+            except S3Error as e:
+                self.fail(str(e), param, ctx)
+            return value
+        return super().convert(value, param, ctx)
 
 
-cli = click.group()(
-    click.option(
-        '--config',
-        type=click.Path(exists=True, dir_okay=False),
-        default=None,
-        help='Optional, config file to use',
-    )(
-        click.pass_context(cli),
-    )
+class Settings(dict):
+    """
+    The context object of the commands. The configuration is loaded and
+    validated when a command first asks for it, so --help and the commands
+    that don't need it start without reading it.
+    """
+
+    def __init__(self, config_path=None, validate=True, resolver=None):
+        super().__init__()
+        self.config_path = config_path
+        self.validate = validate
+        self.resolver = resolver
+
+    def __missing__(self, key):
+        if key not in ('config', 'env'):
+            raise KeyError(key)
+        self.load()
+        return self[key]
+
+    def load(self):
+        config = Configurator(self.config_path).load()
+        if config.config_path:
+            click.echo('Using the configuration file at {0}'.format(config.config_path))
+        if self.validate:
+            try:
+                config.validate(resolver=self.resolver)
+            except ConfigurationError as e:
+                title = 'Configuration problem'
+                title += ' - ' if len(e.messages) > 1 else ':\n -> '
+                click.echo(title + str(e), err=True)
+                click.echo('Command aborted.', err=True)
+                exit(1)
+        self['config'] = config
+        env = config.env()
+        for image_id, reference in IMAGES.items():
+            env['IMAGE_{0}'.format(image_id.upper())] = reference
+        env['IMAGE_APP'] += ':' + env['MAIN_UPDATE_CHANNEL']
+        self['env'] = env
+
+
+def _print_version(ctx, param, value):
+    if not value or ctx.resilient_parsing:
+        return
+    from teamplify_runner import __version__
+
+    click.echo('Teamplify runner v{0}'.format(__version__))
+    ctx.exit()
+
+
+@click.group()
+@click.option(
+    '--config',
+    type=click.Path(exists=True, dir_okay=False),
+    default=None,
+    help='Optional, config file to use',
+)
+@click.option(
+    '--offline',
+    is_flag=True,
+    default=False,
+    help="Don't resolve the hostnames of the configuration, only check their syntax",
+)
+@click.option(
+    '--dns-timeout',
+    type=click.FloatRange(min=0),
+    default=DNS_TIMEOUT,
+    show_default=True,
+    help='Seconds to wait for the hostnames of the configuration to resolve',
+)
+@click.option(
+    '--version',
+    is_flag=True,
+    expose_value=False,
+    is_eager=True,
+    callback=_print_version,
+    help='Show the version and exit',
 )
+@click.pass_context
+def cli(ctx, config, offline, dns_timeout):
+    """
+    Teamplify runner
+    """
+    ctx.obj = Settings(
+        config,
+        validate=ctx.invoked_subcommand != 'configure',
+        resolver=HostnameResolver(timeout=dns_timeout, offline=offline),
+    )
 
 
 @cli.command()
@@ -321,7 +693,9 @@ def start(ctx):
     """
     Start Teamplify
     """
-    _start(ctx.obj['env'])
+    env = ctx.obj['env']
+    _pull_images(env, missing_only=True)
+    _start(env)
 
 
 @cli.command()
@@ -360,71 +734,890 @@ def restart(ctx):
     Restart Teamplify
     """
     env = ctx.obj['env']
+    _pull_images(env, missing_only=True)
     _stop(env)
     _start(env)
 
 
 @cli.command()
-@click.argument('filename', required=False)
+@click.argument('filename', required=False, type=BackupLocation())
+@click.option(
+    '--compression',
+    type=click.Choice(COMPRESSIONS),
+    default=None,
+    help='Compression format of the archive, defaults to gzip',
+)
+@click.option(
+    '--level',
+    type=click.IntRange(1, 19),
+    default=None,
+    help='Compression level, defaults to 6 for gzip and the repository and 3 for zstd',
+)
+@click.option(
+    '--threads',
+    type=click.IntRange(1),
+    default=None,
+    help='Number of compression threads, defaults to the number of CPUs',
+)
+@click.option(
+    '--incremental',
+    is_flag=True,
+    default=False,
+    help='Only save the binlogs written since the previous backup',
+)
+@click.option(
+    '--repository',
+    is_flag=True,
+    default=False,
+    help='Save a deduplicated snapshot to the repository in backup_mount',
+)
 @click.pass_context
-def backup(ctx, filename):
+def backup(ctx, filename, compression, level, threads, incremental, repository):
     """
-    Backup Teamplify DB to a GZipped archive
+    Backup Teamplify DB to a compressed archive, locally or in S3
     """
+    from teamplify_runner.backup import binlog_enabled
+    from teamplify_runner.scheduler import SchedulerError, backup_lock
+
     env = ctx.obj['env']
     _assert_builtin_db(env)
-    _backup(env, filename)
+    if repository and (filename or incremental or compression):
+        raise click.UsageError(
+            '--repository can not be used with a filename, --incremental or --compression',
+        )
+    # The repository compresses its chunks with zlib, like gzip
+    if (repository or compression in (None, 'gzip')) and level is not None and level > 9:
+        raise click.BadParameter(
+            '{0} supports levels from 1 to 9'.format('the repository' if repository else 'gzip'),
+            param_hint='--level',
+        )
+    compression = compression or 'gzip'
+    if incremental and not binlog_enabled(env):
+        raise click.UsageError(
+            'Incremental backups require binlogs, please set "binlog = yes" '
+            'in the [db] section and restart Teamplify',
+        )
+    # The binlog state of incremental backups and the repository are in
+    # backup_mount, which scheduled backups lock too, so it's locked whatever
+    # the target is. The target itself may be any directory of the user's.
+    try:
+        with backup_lock(env['DB_BACKUP_MOUNT']):
+            _backup(
+                env,
+                filename,
+                compression=compression,
+                level=level,
+                threads=threads,
+                incremental=incremental,
+                repository=repository,
+            )
+    except SchedulerError as e:
+        click.echo(click.style(str(e), fg='red'), err=True)
+        exit(1)
+
+
+def _scheduled_backup(env, directory, options):
+    from teamplify_runner.scheduler import apply_retention, backup_locks, wait_for_low_load
+
+    if not wait_for_low_load(options['max_load'], options['max_wait'] * 60):
+        click.echo(
+            'Load average stayed above {0} for {1} min, skipping this backup'.format(
+                options['max_load'],
+                options['max_wait'],
+            ),
+        )
+        return
+    with backup_locks(directory, env['DB_BACKUP_MOUNT']):
+        _backup(
+            env,
+            directory,
+            compression=options['compression'],
+            threads=options['threads'],
+            rate_limit=options['rate_limit'] * 1024 * 1024 or None,
+            low_priority=True,
+        )
+        removed = apply_retention(
+            directory,
+            env['DB_NAME'],
+            daily=options['keep_daily'],
+            weekly=options['keep_weekly'],
+            monthly=options['keep_monthly'],
+        )
+    for name in removed:
+        click.echo('Removed old backup {0}'.format(name))
+
+
+@cli.command('backup-scheduler')
+@click.argument(
+    'directory',
+    required=False,
+    type=click.Path(exists=True, file_okay=False, writable=True),
+)
+@click.option(
+    '--interval',
+    type=click.IntRange(1),
+    default=None,
+    help='Run a backup every this number of hours. Without it, run one '
+    'backup and exit, for use with cron',
+)
+@click.option(
+    '--rate-limit',
+    type=click.IntRange(0),
+    default=20,
+    show_default=True,
+    help='Maximal dump read rate in MB/s, 0 for unlimited',
+)
+@click.option(
+    '--max-load',
+    type=click.FloatRange(0, min_open=True),
+    default=float(os.cpu_count() or 1),
+    show_default='number of CPUs',
+    help='Wait until the 1-minute load average is below this value',
+)
+@click.option(
+    '--max-wait',
+    type=click.IntRange(0),
+    default=60,
+    show_default=True,
+    help='Minutes to wait for a low load before skipping the backup',
+)
+@click.option(
+    '--compression',
+    type=click.Choice(COMPRESSIONS),
+    default='gzip',
+    show_default=True,
+    help='Compression format of the archive',
+)
+@click.option(
+    '--threads',
+    type=click.IntRange(1),
+    default=1,
+    show_default=True,
+    help='Number of compression threads',
+)
+@click.option(
+    '--keep-daily',
+    type=click.IntRange(0),
+    default=7,
+    show_default=True,
+    help='Number of days to keep the newest backup of',
+)
+@click.option(
+    '--keep-weekly',
+    type=click.IntRange(0),
+    default=4,
+    show_default=True,
+    help='Number of weeks to keep the newest backup of',
+)
+@click.option(
+    '--keep-monthly',
+    type=click.IntRange(0),
+    default=12,
+    show_default=True,
+    help='Number of months to keep the newest backup of',
+)
+@click.pass_context
+def backup_scheduler(ctx, directory, interval, **options):
+    """
+    Make low-priority backups of Teamplify DB and remove old backups
+    """
+    from teamplify_runner.scheduler import SchedulerError, lower_priority
+
+    env = ctx.obj['env']
+    _assert_builtin_db(env)
+    directory = directory or env['DB_BACKUP_MOUNT']
+    lower_priority()
+    while True:
+        started = time.monotonic()
+        try:
+            _scheduled_backup(env, directory, options)
+        except SchedulerError as e:
+            click.echo('{0}, skipping this backup'.format(e))
+        except SystemExit:
+            # _backup exits on errors. A failed backup shouldn't stop the
+            # scheduler, the next run may succeed
+            if not interval:
+                raise
+        if not interval:
+            return
+        next_run = started + interval * 3600
+        click.echo(
+            'Next backup at {0}'.format(
+                datetime.now().replace(microsecond=0)
+                + timedelta(seconds=int(next_run - time.monotonic())),
+            ),
+        )
+        time.sleep(max(next_run - time.monotonic(), 0))
+
+
+def _queues(ctx, param, value):
+    return tuple(queue for queue in value.split(',') if queue) if value else ()
 
 
 @cli.command()
-@click.argument('filename', type=click.Path(exists=True))
+@click.option(
+    '--slim-max',
+    type=click.IntRange(1),
+    default=None,
+    help='Maximal number of slim workers. Without it, slim workers are not scaled',
+)
+@click.option(
+    '--slim-queues',
+    callback=_queues,
+    default='',
+    help='Comma-separated Celery queues served by slim workers',
+)
+@click.option(
+    '--fat-max',
+    type=click.IntRange(1),
+    default=None,
+    help='Maximal number of fat workers. Without it, fat workers are not scaled',
+)
+@click.option(
+    '--fat-queues',
+    callback=_queues,
+    default='',
+    help='Comma-separated Celery queues served by fat workers',
+)
+@click.option(
+    '--tasks-per-worker',
+    type=click.IntRange(1),
+    default=10,
+    show_default=True,
+    help='Number of queued tasks per worker to aim for',
+)
+@click.option(
+    '--interval',
+    type=click.IntRange(1),
+    default=30,
+    show_default=True,
+    help='Seconds between queue samples',
+)
+@click.option(
+    '--up-cooldown',
+    type=click.IntRange(0),
+    default=60,
+    show_default=True,
+    help='Minimal seconds between adding workers',
+)
+@click.option(
+    '--down-cooldown',
+    type=click.IntRange(0),
+    default=300,
+    show_default=True,
+    help='Seconds the backlog must stay low before removing a worker',
+)
+@click.option(
+    '--max-load',
+    type=click.FloatRange(0, min_open=True),
+    default=None,
+    help="Don't add workers while the 1-minute load average per CPU is above this value",
+)
+@click.pass_context
+def autoscale(ctx, slim_max, slim_queues, fat_max, fat_queues, interval, max_load, **options):
+    """
+    Scale workers with the length of their Celery queues
+    """
+    from teamplify_runner.autoscale import (
+        AutoscaleError,
+        Autoscaler,
+        Compose,
+        queue_lengths,
+        redis_command,
+        step,
+        worker_groups,
+    )
+
+    env = ctx.obj['env']
+    if not slim_max and not fat_max:
+        raise click.UsageError('Please specify --slim-max, --fat-max or both')
+    if slim_max and not slim_queues:
+        raise click.UsageError('--slim-max needs --slim-queues')
+    if fat_max and not fat_queues:
+        raise click.UsageError('--fat-max needs --fat-queues')
+    try:
+        groups = worker_groups(env, slim_max, fat_max, slim_queues, fat_queues)
+    except AutoscaleError as e:
+        raise click.UsageError(str(e))
+    autoscalers = [Autoscaler(group, **options) for group in groups]
+    queues = [queue for group in groups for queue in group.queues]
+    compose_ = Compose(env)
+    command = redis_command(env)
+    cpus = os.cpu_count() or 1
+    while True:
+        now = time.monotonic()
+        overloaded = max_load is not None and os.getloadavg()[0] / cpus > max_load
+        try:
+            lengths = queue_lengths(queues, command)
+            decisions = step(autoscalers, compose_, lengths, now, overloaded=overloaded)
+        except AutoscaleError as e:
+            click.echo('{0} {1}'.format(datetime.now().replace(microsecond=0), e), err=True)
+        else:
+            for name, backlog, current, count, reason in decisions:
+                click.echo(
+                    '{0} {1} workers: {2} task(s) queued, {3} -> {4}, {5}'.format(
+                        datetime.now().replace(microsecond=0),
+                        name,
+                        backlog,
+                        '?' if current is None else current,
+                        '?' if count is None else count,
+                        reason,
+                    ),
+                )
+        time.sleep(max(now + interval - time.monotonic(), 0))
+
+
+@cli.command()
+@click.argument('filenames', nargs=-1, type=BackupLocation(exists=True))
 @click.option('--quiet', 'quiet', flag_value='quiet', default=None)
+@click.option(
+    '--snapshot',
+    default=None,
+    help='Restore this snapshot from the repository instead of an archive',
+)
+@click.option(
+    '--connections',
+    type=click.IntRange(1),
+    default=4,
+    show_default=True,
+    help='Number of concurrent MySQL connections used to load tables',
+)
+@click.option(
+    '--until',
+    type=click.DateTime(formats=['%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S']),
+    default=None,
+    help='Replay incremental backups up to this point in time (UTC)',
+)
 @click.pass_context
-def restore(ctx, filename, quiet):
+def restore(ctx, filenames, quiet, snapshot, connections, until):
     """
-    Restore Teamplify DB from a GZipped archive
+    Restore Teamplify DB from a gzip or zstd archive or a repository
+    snapshot, followed by optional incremental backups
     """
     env = ctx.obj['env']
     _assert_builtin_db(env)
+    if snapshot:
+        filename, incrementals = None, filenames
+    elif filenames:
+        filename, incrementals = filenames[0], filenames[1:]
+    else:
+        raise click.UsageError('Please specify a backup file or a --snapshot')
+    if until and not incrementals:
+        raise click.UsageError('--until requires at least one incremental backup')
     if not quiet:
         confirm = input(
             'Current Teamplify DB will be overwritten from:\n -> {0}\nContinue (y/N)? '.format(
-                filename
+                snapshot or filename
             ),
         )
         if confirm.lower() != 'y':
             click.echo('DB restore cancelled, exiting')
             return
-    _restore(env, filename)
+    _restore(
+        env,
+        filename,
+        snapshot=snapshot,
+        connections=connections,
+        incrementals=incrementals,
+        until=until,
+    )
 
 
-def _image_id(name):
+@cli.command()
+@click.pass_context
+def snapshots(ctx):
+    """
+    List the snapshots in the backup repository
+    """
+    from teamplify_runner.backup import format_size
+    from teamplify_runner.repository import Repository
+
+    repository = Repository.for_env(ctx.obj['env'])
+    items = repository.snapshots()
+    if not items:
+        click.echo('No snapshots found in {0}'.format(repository.path))
+    for snapshot in items:
+        click.echo(
+            '{0}  {1:>10}  {2}'.format(
+                snapshot['created'],
+                format_size(snapshot['size']),
+                snapshot['name'],
+            ),
+        )
+
+
+@cli.command()
+@click.option(
+    '--keep-last',
+    type=click.IntRange(1),
+    default=None,
+    help='Remove all but this number of the newest snapshots',
+)
+@click.pass_context
+def prune(ctx, keep_last):
+    """
+    Remove old snapshots and unreferenced chunks from the backup repository
+    """
+    from teamplify_runner.backup import format_size
+    from teamplify_runner.repository import Repository, RepositoryError
+
+    repository = Repository.for_env(ctx.obj['env'])
     try:
-        return run(
-            'docker image ls -q --no-trunc {0}'.format(name),
-            suppress_output=True,
-        ).stdout_lines[0]
-    except IndexError:
-        return None
+        removed, removed_chunks, freed = repository.prune(keep_last=keep_last)
+    except RepositoryError as e:
+        click.echo(click.style(str(e), fg='red'), err=True)
+        exit(1)
+    for name in removed:
+        click.echo('Removed snapshot {0}'.format(name))
+    click.echo(
+        'Removed {0} unreferenced chunk(s), {1} freed'.format(
+            removed_chunks,
+            format_size(freed),
+        ),
+    )
+
+
+@cli.command('backup-media')
+@click.option(
+    '--threads',
+    type=click.IntRange(1),
+    default=None,
+    help='Number of files copied in parallel, defaults to the number of CPUs',
+)
+@click.pass_context
+def backup_media(ctx, threads):
+    """
+    Backup Teamplify media files, copying only the files changed since the
+    previous backup
+    """
+    from teamplify_runner.backup import format_size
+    from teamplify_runner.media import MediaBackups, MediaError, Volume
+
+    env = ctx.obj['env']
+    backups = MediaBackups.for_env(env)
+    now = datetime.utcnow().replace(microsecond=0)
+    name = '{0}_media_{1}'.format(env['DB_NAME'], now.isoformat('_').replace(':', '-'))
+    click.echo('Making backup of Teamplify media files to:\n -> {0}'.format(backups.path))
+    click.echo('Snapshot: {0}'.format(name))
+    try:
+        files, copied, copied_size = backups.backup(
+            Volume.docker(env['IMAGE_APP']),
+            name,
+            threads=threads,
+        )
+    except (OSError, MediaError) as e:
+        click.echo(click.style(str(e), fg='red'), err=True)
+        exit(1)
+    click.echo(
+        'Done. {0} file(s), {1} changed file(s) copied, {2}'.format(
+            files,
+            copied,
+            format_size(copied_size),
+        ),
+    )
+
+
+@cli.command('restore-media')
+@click.argument('snapshot', required=False)
+@click.option('--quiet', 'quiet', flag_value='quiet', default=None)
+@click.option(
+    '--threads',
+    type=click.IntRange(1),
+    default=None,
+    help='Number of files copied in parallel, defaults to the number of CPUs',
+)
+@click.pass_context
+def restore_media(ctx, snapshot, quiet, threads):
+    """
+    Restore Teamplify media files from a snapshot, the latest one by default
+    """
+    from teamplify_runner.media import MediaBackups, MediaError, Volume
+
+    env = ctx.obj['env']
+    backups = MediaBackups.for_env(env)
+    if not snapshot:
+        snapshots = backups.snapshots()
+        if not snapshots:
+            click.echo('No media snapshots found in {0}'.format(backups.path))
+            exit(1)
+        snapshot = snapshots[-1]
+    if not quiet:
+        confirm = input(
+            'Current Teamplify media files will be overwritten from:\n -> {0}\n'
+            'Continue (y/N)? '.format(snapshot),
+        )
+        if confirm.lower() != 'y':
+            click.echo('Media restore cancelled, exiting')
+            return
+    try:
+        copied, removed = backups.restore(
+            snapshot,
+            Volume.docker(env['IMAGE_APP']),
+            threads=threads,
+        )
+    except (OSError, MediaError) as e:
+        click.echo(click.style(str(e), fg='red'), err=True)
+        exit(1)
+    click.echo('Done. {0} file(s) restored, {1} file(s) removed'.format(copied, removed))
+
+
+@cli.command()
+@click.option(
+    '--write',
+    is_flag=True,
+    default=False,
+    help='Save the proposed values to the configuration file',
+)
+@click.pass_context
+def tune(ctx, write):
+    """
+    Propose web, worker, DB and Redis settings sized to the host
+    """
+    from teamplify_runner.tune import GB, LOW_DISK_SPACE, config_diff, detect_host, propose
+
+    config = ctx.obj['config']
+    host = detect_host()
+    click.echo(
+        'Host: {0} CPU(s), {1:.1f} GB memory, {2}{3:.1f} GB free disk space'.format(
+            host.cpus,
+            host.memory / GB,
+            {True: 'HDD, ', False: 'SSD, ', None: ''}[host.rotational],
+            host.disk_free / GB,
+        ),
+    )
+    if host.disk_free < LOW_DISK_SPACE:
+        click.echo(
+            click.style('WARNING:', fg='yellow')
+            + ' low disk space, please keep at least {0:.0f} GB free for the DB and backups'.format(
+                LOW_DISK_SPACE / GB
+            ),
+        )
+    diff = config_diff(config.parser, propose(host))
+    if not diff:
+        click.echo('The configuration already matches the host')
+        return
+    for section, option, current, proposed in diff:
+        click.echo(
+            '[{0}] {1}: {2} -> {3}'.format(section, option, current or '(default)', proposed),
+        )
+    if not write:
+        click.echo('\nRun "teamplify tune --write" to save these values')
+        return
+    for section, option, _, proposed in diff:
+        config.parser.set(section, option, proposed)
+    config.dump()
+    click.echo('Configuration saved to:\n -> {0}'.format(config.config_path))
+    click.echo('Please run "teamplify restart" to apply the changes')
 
 
 @cli.command()
+@click.option(
+    '--listen',
+    default=None,
+    metavar='[HOST:]PORT',
+    help='Serve the metrics over HTTP for Prometheus, e.g. 9150. The host defaults to 127.0.0.1',
+)
+@click.option(
+    '--textfile',
+    type=click.Path(dir_okay=False, writable=True),
+    default=None,
+    help='Write the metrics to this file for the node-exporter textfile collector',
+)
+@click.option(
+    '--interval',
+    type=click.IntRange(1),
+    default=15,
+    show_default=True,
+    help='Seconds between collections',
+)
+@click.pass_context
+def metrics(ctx, listen, textfile, interval):
+    """
+    Show CPU, memory, network and disk usage of Teamplify containers
+    """
+    from teamplify_runner.metrics import (
+        CachedCollector,
+        MetricsError,
+        collect,
+        metrics_server,
+        prometheus,
+        write_textfile,
+    )
+
+    if listen:
+        host, _, port = listen.rpartition(':')
+        try:
+            server = metrics_server(CachedCollector(interval), host or '127.0.0.1', int(port))
+        except (OSError, ValueError) as e:
+            click.echo(click.style('Failed to listen on {0}: {1}'.format(listen, e), fg='red'))
+            exit(1)
+        host, port = server.server_address[:2]
+        click.echo('Serving metrics at http://{0}:{1}/metrics'.format(host, port))
+        server.serve_forever()
+    while True:
+        started = time.monotonic()
+        try:
+            text = prometheus(collect())
+        except MetricsError as e:
+            click.echo(click.style(str(e), fg='red'), err=True)
+            if not textfile:
+                exit(1)
+        else:
+            if not textfile:
+                click.echo(text, nl=False)
+                return
+            write_textfile(textfile, text)
+        time.sleep(max(started + interval - time.monotonic(), 0))
+
+
+@cli.command()
+@click.option(
+    '--url',
+    help='Base URL to send requests to. Defaults to the Teamplify URL from the configuration',
+)
+@click.option(
+    '--path',
+    'paths',
+    multiple=True,
+    default=['/'],
+    show_default=True,
+    help='Path to request, can be given several times to request them in turn',
+)
+@click.option(
+    '--concurrency',
+    type=click.IntRange(1),
+    default=10,
+    show_default=True,
+    help='Number of concurrent connections',
+)
+@click.option(
+    '--duration',
+    type=click.IntRange(1),
+    default=30,
+    show_default=True,
+    help='Seconds to measure for, after the ramp-up',
+)
+@click.option(
+    '--ramp-up',
+    type=click.IntRange(0),
+    default=5,
+    show_default=True,
+    help='Seconds to gradually increase the load for. These requests are not measured',
+)
+@click.option(
+    '--rate',
+    type=click.FloatRange(0, min_open=True),
+    default=None,
+    help='Send this number of requests per second instead of as many as possible',
+)
+@click.option(
+    '--output',
+    type=click.Path(dir_okay=False, writable=True),
+    default=None,
+    help='Save the results to this JSON file',
+)
+@click.option(
+    '--compare',
+    'baseline',
+    type=click.Path(exists=True, dir_okay=False),
+    default=None,
+    help='Compare the results with the ones saved by a previous run',
+)
+@click.option(
+    '--insecure',
+    is_flag=True,
+    default=False,
+    help="Don't verify the certificate, e.g. a self-signed one",
+)
 @click.pass_context
-def update(ctx):
+def bench(ctx, url, paths, output, baseline, insecure, **options):
+    """
+    Measure throughput and latency of Teamplify under load
+    """
+    from teamplify_runner.bench import (
+        BUCKETS,
+        Bench,
+        BenchError,
+        compare_results,
+        load_results,
+        save_results,
+    )
+
+    url = url or _root_url(ctx.obj['env'])
+    try:
+        baseline = load_results(baseline) if baseline else None
+        click.echo(
+            'Sending requests to {0} for {1} sec...'.format(
+                url, options['ramp_up'] + options['duration']
+            ),
+        )
+        summary = Bench(url, paths=paths, verify=not insecure, **options).run()
+    except BenchError as e:
+        click.echo(click.style(str(e), fg='red'), err=True)
+        exit(1)
+    click.echo(
+        '\nRequests: {0}, errors: {1}, throughput: {2:.1f} req/sec'.format(
+            summary['requests'], summary['errors'], summary['throughput']
+        ),
+    )
+    for path, stats in summary['paths'].items():
+        click.echo(
+            '{0}: p50 {1:.1f} ms, p95 {2:.1f} ms, p99 {3:.1f} ms, max {4:.1f} ms'.format(
+                path, stats['p50'], stats['p95'], stats['p99'], stats['max']
+            ),
+        )
+    click.echo('\nLatency histogram:')
+    total = summary['requests'] or 1
+    for bound, count in summary['histogram']:
+        label = '<= {0} ms'.format(bound) if bound is not None else '> {0} ms'.format(BUCKETS[-1])
+        click.echo(
+            '{0:>12} {1:>7} {2}'.format(label, count, '#' * round(count / total * 50)),
+        )
+    if baseline:
+        click.echo('\nCompared to {0}:'.format(baseline['settings']['url']))
+        for name, before, after, change in compare_results(baseline, summary):
+            click.echo(
+                '{0:>10}: {1:.1f} -> {2:.1f}{3}'.format(
+                    name,
+                    before,
+                    after,
+                    ' ({0:+.1f}%)'.format(change) if change is not None else '',
+                ),
+            )
+    if output:
+        save_results(summary, output)
+        click.echo('\nResults saved to:\n -> {0}'.format(output))
+
+
+@cli.command('tls-check')
+@click.option(
+    '--url',
+    help='HTTPS URL to check. Defaults to the Teamplify URL from the configuration',
+)
+@click.option(
+    '--count',
+    type=click.IntRange(min=2),
+    default=10,
+    show_default=True,
+    help='Number of connections to make',
+)
+@click.option(
+    '--insecure',
+    is_flag=True,
+    default=False,
+    help="Don't verify the certificate, e.g. a self-signed one",
+)
+@click.pass_context
+def tls_check_command(ctx, url, count, insecure):
+    """
+    Measure TLS handshake and time to first byte
+    """
+    from teamplify_runner.tlscheck import TLSCheckError, negotiated, summarize, tls_check
+
+    url = url or _root_url(ctx.obj['env'])
+    try:
+        info = negotiated(url, verify=not insecure)
+        results = tls_check(url, count=count, verify=not insecure)
+    except TLSCheckError as e:
+        click.echo(click.style(str(e), fg='red'), err=True)
+        exit(1)
+    click.echo(
+        '{0}, {1}, {2} certificate, {3}'.format(
+            info.version,
+            info.cipher,
+            info.key,
+            'HTTP/2' if info.protocol == 'h2' else 'no HTTP/2',
+        ),
+    )
+    for name, milliseconds in summarize(results):
+        click.echo('{0}: {1:.1f} ms'.format(name, milliseconds))
+    resumed = sum(1 for m in results[1:] if m.resumed)
+    click.echo('Sessions resumed: {0} of {1}'.format(resumed, len(results) - 1))
+
+
+def _rolling_update(env, old_image, batch_size):
+    from teamplify_runner.render import render_all
+    from teamplify_runner.rolling import RollingUpdate, RollingUpdateError
+
+    render_all(env)
+    try:
+        RollingUpdate(env, old_image, batch_size=batch_size).run()
+    except RollingUpdateError as e:
+        click.echo(click.style(str(e), fg='red'), err=True)
+        exit(1)
+    _wait_for_start(env)
+    _precompress_static(env)
+
+
+def _pull_images(env, workers=3, missing_only=False):
+    """
+    Pulls the images that are not up to date, or with missing_only, the ones
+    that don't exist locally. Returns the list of pulled images.
+    """
+    from teamplify_runner.images import ImageError, prefetch, required_images
+
+    click.echo(
+        'Checking for missing images...' if missing_only else 'Checking for image updates...'
+    )
+    try:
+        return prefetch(required_images(env), workers=workers, missing_only=missing_only)
+    except ImageError as e:
+        click.echo(click.style(str(e), fg='red'), err=True)
+        exit(1)
+
+
+@cli.command()
+@click.option(
+    '--workers',
+    type=click.IntRange(min=1),
+    default=3,
+    show_default=True,
+    help='Number of images to pull at a time',
+)
+@click.pass_context
+def pull(ctx, workers):
+    """
+    Download the latest versions of the Docker images
+    """
+    pulled = _pull_images(ctx.obj['env'], workers=workers)
+    click.echo('Done. {0} image(s) updated'.format(len(pulled)))
+
+
+@cli.command()
+@click.option(
+    '--rolling',
+    is_flag=True,
+    default=False,
+    help='Replace the app containers one by one while Teamplify keeps serving requests',
+)
+@click.option(
+    '--batch-size',
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    help='Number of worker containers to replace at a time in the rolling mode',
+)
+@click.pass_context
+def update(ctx, rolling, batch_size):
     """
     Update to the latest version
     """
+    from teamplify_runner.images import local_image_id, local_images
+
     env = ctx.obj['env']
     if _running(env):
-        current_image = _image_id(env['IMAGE_APP'])
-        run('docker pull {0}'.format(env['IMAGE_APP']), capture_output=False)
-        new_image = _image_id(env['IMAGE_APP'])
+        current_image = local_image_id(local_images(), env['IMAGE_APP'])
+        _pull_images(env)
+        new_image = local_image_id(local_images(), env['IMAGE_APP'])
         if current_image != new_image:
-            _stop(env)
-            _start(env)
+            if rolling:
+                _rolling_update(env, current_image, batch_size)
+            else:
+                _stop(env)
+                _start(env)
             click.echo('')
     else:
-        run('docker pull {0}'.format(env['IMAGE_APP']))
+        _pull_images(env)
     _remove_unused_images()
     click.echo('Done.')
 
@@ -436,6 +1629,8 @@ def erase(ctx, quiet):
     """
     Erase all of Teamplify data and Docker images
     """
+    from teamplify_runner.docker_api import docker_client
+
     if not quiet:
         confirm = input(
             '\nIMPORTANT: This command will erase all of the data stored in '
@@ -449,20 +1644,15 @@ def erase(ctx, quiet):
     env = ctx.obj['env']
     _stop(env)
     click.echo('')
-    networks = run(
-        'docker network ls -f name=teamplify_runner* -q',
-        suppress_output=True,
-    ).stdout_lines
+    client = docker_client()
+    networks = _docker_ids(client, 'network', {'name': ['teamplify_runner']})
     if networks:
         click.echo('Removing {0} Docker network(s):'.format(len(networks)))
-        run('docker network rm {0}'.format(' '.join(networks)), raise_on_error=False)
-    volumes = run(
-        'docker volume ls -f name=teamplify_runner* -q',
-        suppress_output=True,
-    ).stdout_lines
+        _docker_remove(client, 'network', networks)
+    volumes = _docker_ids(client, 'volume', {'name': ['teamplify_runner']})
     if volumes:
         click.echo('Removing {0} Docker volume(s):'.format(len(volumes)))
-        run('docker volume rm {0}'.format(' '.join(volumes)), raise_on_error=False)
+        _docker_remove(client, 'volume', volumes)
     click.echo('Removing Docker images:')
     images = []
     for image_id, reference in IMAGES.items():
@@ -471,7 +1661,7 @@ def erase(ctx, quiet):
                 images.append('{0}:{1}'.format(reference, channel))
         else:
             images.append(reference)
-    run('docker rmi {0}'.format(' '.join(images)), raise_on_error=False)
+    _docker_remove(client, 'image', images)
     click.echo('Done.')
 
 
@@ -1,8 +1,11 @@
 import io
+import json
 import os
 import pickle
 import re
 import socket
+import threading
+import time
 from collections import OrderedDict
 from configparser import ConfigParser
 from functools import partial
@@ -11,6 +14,39 @@ from teamplify_runner.utils import is_ip_address, random_string
 
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+COMPOSE_FILE = 'docker-compose.yml'
+# Makes the services wait for the separate Celery broker
+BROKER_COMPOSE_FILE = 'docker-compose.broker.yml'
+# Compose names the project after the directory of the compose file
+PROJECT = re.sub(r'[^a-z0-9_-]', '', os.path.basename(BASE_DIR).lower())
+
+# TLS policies supported by nginx-proxy, see
+# https://wiki.mozilla.org/Security/Server_Side_TLS
+SSL_POLICIES = ['Mozilla-Modern', 'Mozilla-Intermediate', 'Mozilla-Old']
+
+# Services that share CPU and memory limits. The options of the [resources]
+# section are named as <group>_<setting>
+RESOURCE_GROUPS = ('db', 'redis', 'web', 'worker_slim', 'worker_fat', 'beat')
+RESOURCE_SETTINGS = ('cpus', 'cpuset', 'memory', 'memory_reservation')
+MEMORY_UNITS = {'b': 1, 'k': 1024, 'm': 1024**2, 'g': 1024**3}
+
+DNS_TIMEOUT = 5
+# Hostnames that resolved are not looked up again for this long
+DNS_CACHE_TTL = 24 * 60 * 60
+# Underscores are not valid in hostnames, but resolvers accept them and so
+# does the online check, such as for the names of Docker services
+HOSTNAME = re.compile(
+    r'^(?!-)[a-z0-9_-]{1,63}(?<!-)(\.(?!-)[a-z0-9_-]{1,63}(?<!-))*\.?$',
+    re.IGNORECASE,
+)
+
+
+def dns_cache_path():
+    return os.path.join(
+        os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+        'teamplify',
+        'hostnames.json',
+    )
 
 
 class ConfigurationError(Exception):
@@ -37,11 +73,118 @@ class ConfigurationError(Exception):
         return self.messages[0]
 
 
-def validate_hostname(hostname):
-    try:
-        socket.gethostbyname(hostname)
-    except socket.gaierror:
-        raise ConfigurationError("Can't resolve hostname: {0}".format(hostname))
+class HostnameResolver:
+    """
+    Checks that hostnames resolve. The lookups run concurrently and are given
+    up after the timeout. The hostnames that resolve are cached on disk for
+    ttl seconds, so the next runs don't need DNS at all. The cache is kept in
+    the user cache directory unless another cache_path is given, and
+    cache=False disables it. Offline, only the syntax of the hostnames is
+    checked.
+    """
+
+    def __init__(
+        self,
+        timeout=DNS_TIMEOUT,
+        ttl=DNS_CACHE_TTL,
+        cache_path=None,
+        cache=True,
+        offline=False,
+    ):
+        self.timeout = timeout
+        self.ttl = ttl
+        self.cache_path = None
+        if cache:
+            self.cache_path = cache_path or dns_cache_path()
+        self.offline = offline
+        # {hostname: True, False or None if the lookup timed out}
+        self.results = {}
+
+    def _load_cache(self):
+        if not self.cache_path:
+            return {}
+        try:
+            with open(self.cache_path) as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if not isinstance(cache, dict):
+            return {}
+        now = time.time()
+        return {
+            hostname: expires
+            for hostname, expires in cache.items()
+            if isinstance(expires, (int, float)) and expires > now
+        }
+
+    def _save_cache(self, cache):
+        # The cache only saves time, failing to write it is not an error
+        if not self.cache_path:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            with open(self.cache_path + '.tmp', 'w') as f:
+                json.dump(cache, f)
+            os.replace(self.cache_path + '.tmp', self.cache_path)
+        except OSError:
+            pass
+
+    def resolve(self, hostnames):
+        """
+        Looks up all hostnames that are not known yet at once.
+        """
+        if self.offline:
+            return
+        cache = self._load_cache()
+        pending = []
+        for hostname in dict.fromkeys(hostnames):
+            if hostname in self.results:
+                continue
+            if hostname.lower() in cache:
+                self.results[hostname] = True
+            else:
+                pending.append(hostname)
+        if not pending:
+            return
+        resolved = {}
+
+        def lookup(hostname):
+            try:
+                socket.gethostbyname(hostname)
+                resolved[hostname] = True
+            except (OSError, UnicodeError):
+                resolved[hostname] = False
+
+        # The lookups can't be cancelled, so the threads that are still
+        # waiting for the resolver after the timeout are left behind
+        threads = [
+            threading.Thread(target=lookup, args=(hostname,), daemon=True) for hostname in pending
+        ]
+        for thread in threads:
+            thread.start()
+        deadline = time.monotonic() + self.timeout
+        for thread in threads:
+            thread.join(max(deadline - time.monotonic(), 0))
+        expires = time.time() + self.ttl
+        for hostname in pending:
+            self.results[hostname] = resolved.get(hostname)
+            if self.results[hostname]:
+                cache[hostname.lower()] = expires
+        if any(self.results[hostname] for hostname in pending):
+            self._save_cache(cache)
+
+    def check(self, hostname):
+        if self.offline:
+            if hostname and not (HOSTNAME.match(hostname) or is_ip_address(hostname)):
+                raise ConfigurationError('Invalid hostname: {0}'.format(hostname))
+            return
+        self.resolve([hostname])
+        if self.results[hostname] is None:
+            raise ConfigurationError(
+                'Timed out resolving hostname in {0} seconds: {1}'.format(self.timeout, hostname),
+            )
+        if not self.results[hostname]:
+            raise ConfigurationError("Can't resolve hostname: {0}".format(hostname))
 
 
 def validate_integer(value, min=None, max=None):  # noqa C901
@@ -89,6 +232,46 @@ def validate_certs(path, hostname):
 validate_port = partial(validate_integer, min=0, max=65535)
 
 
+def validate_cpus(value):
+    try:
+        cpus = float(value)
+    except ValueError:
+        raise ConfigurationError('Must be a number. You provided: {0}'.format(value))
+    if cpus <= 0:
+        raise ConfigurationError('Must be greater than 0. You provided: {0}'.format(value))
+
+
+def validate_cpuset(value):
+    if not re.match(r'^\d+(-\d+)?(,\d+(-\d+)?)*$', value):
+        raise ConfigurationError(
+            'Must be a list of CPUs, such as 0-3 or 0,2. You provided: {0}'.format(value),
+        )
+    cpus = os.cpu_count() or 1
+    for cpu in re.findall(r'\d+', value):
+        if int(cpu) >= cpus:
+            raise ConfigurationError(
+                'There are {0} CPU(s), numbered from 0. You provided: {1}'.format(cpus, value),
+            )
+
+
+def parse_memory(value):
+    """
+    Converts a size such as 512m or 2g to bytes.
+    """
+    match = re.match(r'^(\d+)([bkmg]?)$', value.lower())
+    if not match:
+        raise ConfigurationError(
+            'Must be a size, such as 512m or 2g. You provided: {0}'.format(value),
+        )
+    return int(match.group(1)) * MEMORY_UNITS[match.group(2) or 'b']
+
+
+def validate_memory(value):
+    # Docker doesn't start containers with less memory
+    if parse_memory(value) < 6 * 1024**2:
+        raise ConfigurationError('Must be at least 6m. You provided: {0}'.format(value))
+
+
 def validate_boolean(value):
     if value.lower() not in ('yes', 'no', 'y', 'n', 'true', 'false', '0', '1'):
         raise ConfigurationError(
@@ -110,6 +293,13 @@ def validate_choice(value, choices):
         )
 
 
+def validate_url(value):
+    if not re.match(r'^https?://[^/\s]+/?$', value):
+        raise ConfigurationError(
+            'Must be an http:// or https:// URL without a path. You provided: {0}'.format(value),
+        )
+
+
 def validate_email(value):
     """
     Not going to write insane regex here,
@@ -149,6 +339,13 @@ class Configurator:
                         ('ssl_certs', ''),
                         ('use_ssl', 'no'),
                         ('count', 2),
+                        ('static_caching', 'yes'),
+                        ('precompress_static', 'yes'),
+                        ('load_balancing', 'least_conn'),
+                        ('microcache', 0),
+                        ('http2', 'yes'),
+                        ('ssl_policy', 'Mozilla-Intermediate'),
+                        ('ssl_key_type', 'ecdsa'),
                     )
                 ),
             ),
@@ -162,6 +359,27 @@ class Configurator:
                         ('user', 'root'),
                         ('password', 'teamplify'),
                         ('backup_mount', os.path.join(BASE_DIR, 'backup')),
+                        ('binlog', 'no'),
+                        ('binlog_expire_days', 7),
+                        ('size', ''),
+                        ('durability', 'durable'),
+                        ('innodb_buffer_pool_size', ''),
+                        ('innodb_log_file_size', ''),
+                        ('innodb_flush_log_at_trx_commit', ''),
+                        ('innodb_io_capacity', ''),
+                        ('max_connections', ''),
+                    )
+                ),
+            ),
+            (
+                'redis',
+                OrderedDict(
+                    (
+                        ('maxmemory', ''),
+                        ('maxmemory_policy', ''),
+                        ('io_threads', 1),
+                        ('separate_broker', 'no'),
+                        ('broker_maxmemory', ''),
                     )
                 ),
             ),
@@ -178,7 +396,21 @@ class Configurator:
                     )
                 ),
             ),
-            ('crypto', OrderedDict((('signing_key', random_string(50)),))),
+            # Generated when missing, see ensure_signing_key()
+            ('crypto', OrderedDict((('signing_key', ''),))),
+            (
+                's3',
+                OrderedDict(
+                    (
+                        ('endpoint', 'https://s3.amazonaws.com'),
+                        ('region', 'us-east-1'),
+                        ('access_key', ''),
+                        ('secret_key', ''),
+                        ('part_size', 16),
+                        ('concurrency', 4),
+                    )
+                ),
+            ),
             (
                 'worker',
                 OrderedDict(
@@ -188,6 +420,14 @@ class Configurator:
                     )
                 ),
             ),
+            (
+                'resources',
+                OrderedDict(
+                    ('{0}_{1}'.format(group, setting), '')
+                    for group in RESOURCE_GROUPS
+                    for setting in RESOURCE_SETTINGS
+                ),
+            ),
         )
     )
     default_config_locations = [
@@ -214,6 +454,7 @@ class Configurator:
                     break
         self.parser = ConfigParser(allow_no_value=True)
         self.parser.read_dict(self.defaults)
+        self.resolver = HostnameResolver()
 
     def load(self, config_path=None):
         if config_path:
@@ -228,7 +469,13 @@ class Configurator:
         self.parser.read_string(configuration)
         return self
 
+    def ensure_signing_key(self):
+        if not self.parser.get('crypto', 'signing_key', fallback=''):
+            self.parser.set('crypto', 'signing_key', random_string(50))
+        return self
+
     def dump(self, config_path=None, hide_defaults=True):
+        self.ensure_signing_key()
         self.config_path = config_path or self.config_path or self.default_save_location
         parser = self.parser
         if hide_defaults:
@@ -256,7 +503,21 @@ class Configurator:
             return 'builtin'
         return ''
 
+    def mysqld_args(self):
+        if not str_to_bool(self.parser.get('db', 'binlog', fallback='no')):
+            return '--skip-log-bin'
+        expire_days = int(self.parser.get('db', 'binlog_expire_days', fallback=7))
+        return ' '.join(
+            (
+                '--log-bin=binlog',
+                '--server-id=1',
+                '--binlog-format=ROW',
+                '--binlog-expire-logs-seconds={0}'.format(expire_days * 24 * 60 * 60),
+            )
+        )
+
     def env(self):
+        self.ensure_signing_key()
         env = {}
         for section in self.parser.sections():
             for option in self.parser.options(section):
@@ -295,9 +556,39 @@ class Configurator:
         elif not _ssl_mode:
             del env['WEB_SSL_PORT']
 
+        env['DB_MYSQLD_ARGS'] = self.mysqld_args()
+        # Round robin is the default of nginx, it needs no directive
+        env['WEB_UPSTREAM_LOADBALANCE'] = (
+            'least_conn;' if env['WEB_LOAD_BALANCING'] == 'least_conn' else ''
+        )
+        # nginx-proxy and the Let's Encrypt companion settings
+        env['ENABLE_HTTP2'] = 'true' if str_to_bool(env['WEB_HTTP2']) else 'false'
+        env['SSL_POLICY'] = env['WEB_SSL_POLICY']
+        env['DEFAULT_KEY_SIZE'] = 'ec-256' if env['WEB_SSL_KEY_TYPE'] == 'ecdsa' else '4096'
+        if str_to_bool(env['REDIS_SEPARATE_BROKER']):
+            env['COMPOSE_PROFILES'] += ',broker'
+            env['COMPOSE_FILE'] = ':'.join((COMPOSE_FILE, BROKER_COMPOSE_FILE))
+            env['CELERY_BROKER_URL'] = 'redis://redis_broker:6379/0'
+
         return env
 
-    def validate(self):
+    def hostnames(self):
+        """
+        Returns the hostnames that the validation resolves.
+        """
+        hostnames = [self.parser.get('web', 'host', fallback='')]
+        db_host = self.parser.get('db', 'host', fallback='')
+        if db_host.lower() != 'builtin_db':
+            hostnames.append(db_host)
+        smtp_host = self.parser.get('email', 'smtp_host', fallback='')
+        if smtp_host.lower() != 'builtin_smtp':
+            hostnames.append(smtp_host)
+        return hostnames
+
+    def validate(self, resolver=None):
+        if resolver is not None:
+            self.resolver = resolver
+        self.resolver.resolve(self.hostnames())
         errors = []
         for section in self.parser.sections():
             if section not in self.defaults:
@@ -338,8 +629,7 @@ class Configurator:
                 validate_choice(value, ['stable', 'latest'])
         elif section == 'web':
             if option == 'host':
-                validate_hostname(value)
-                pass
+                self.resolver.check(value)
             elif option == 'port':
                 validate_port(value)
                 if value == '443':
@@ -376,11 +666,41 @@ class Configurator:
                     validate_certs(value, hostname)
             elif option == 'count':
                 validate_integer(value, 1)
+            elif option in {'static_caching', 'precompress_static'}:
+                validate_boolean(value)
+            elif option == 'load_balancing':
+                validate_choice(value, ['least_conn', 'round_robin'])
+            elif option == 'microcache':
+                validate_integer(value, 0, 60)
+            elif option == 'http2':
+                validate_boolean(value)
+            elif option == 'ssl_policy':
+                validate_choice(value, SSL_POLICIES)
+            elif option == 'ssl_key_type':
+                validate_choice(value, ['ecdsa', 'rsa'])
         elif section == 'db':
             if option == 'host' and value.lower() != 'builtin_db':
-                validate_hostname(value)
+                self.resolver.check(value)
             elif option == 'port':
                 validate_port(value)
+            elif option == 'binlog':
+                validate_boolean(value)
+            elif option == 'binlog_expire_days':
+                validate_integer(value, 1)
+            elif option == 'size' and value:
+                validate_choice(value, ['small', 'medium', 'large'])
+            elif option == 'durability':
+                validate_choice(value, ['durable', 'fast'])
+            elif option == 'innodb_buffer_pool_size' and value:
+                validate_integer(value, 5)
+            elif option == 'innodb_log_file_size' and value:
+                validate_integer(value, 4)
+            elif option == 'innodb_flush_log_at_trx_commit' and value:
+                validate_choice(value, ['0', '1', '2'])
+            elif option == 'innodb_io_capacity' and value:
+                validate_integer(value, 100)
+            elif option == 'max_connections' and value:
+                validate_integer(value, 1, 100000)
             elif option == 'backup_mount':
                 if not os.path.isdir(value):
                     raise ConfigurationError('Must be a directory: {0}'.format(value))
@@ -388,18 +708,67 @@ class Configurator:
                     raise ConfigurationError(
                         'Write permission denied: {0}'.format(value),
                     )
+        elif section == 'redis':
+            if option in {'maxmemory', 'broker_maxmemory'} and value:
+                validate_integer(value, 1)
+            elif option == 'maxmemory_policy' and value:
+                validate_choice(
+                    value,
+                    [
+                        'noeviction',
+                        'allkeys-lru',
+                        'volatile-lru',
+                        'allkeys-lfu',
+                        'volatile-lfu',
+                        'allkeys-random',
+                        'volatile-random',
+                        'volatile-ttl',
+                    ],
+                )
+            elif option == 'io_threads':
+                validate_integer(value, 1, 128)
+            elif option == 'separate_broker':
+                validate_boolean(value)
         elif section == 'email':
             if option == 'smtp_host' and value.lower() != 'builtin_smtp':
-                validate_hostname(value)
+                self.resolver.check(value)
             elif option == 'smtp_protocol':
                 validate_choice(value, ['plain', 'ssl', 'tls'])
             elif option == 'smtp_port':
                 validate_port(value)
             elif option == 'address_from':
                 validate_email(value)
+        elif section == 's3':
+            if option == 'endpoint':
+                validate_url(value)
+            elif option == 'part_size':
+                # S3 requires all parts except the last one to be at least 5 MB
+                validate_integer(value, 5, 5120)
+            elif option == 'concurrency':
+                validate_integer(value, 1, 64)
         elif section == 'worker':
             if option in {'slim_count', 'fat_count'}:
                 validate_integer(value, 1)
+        elif section == 'resources' and value:
+            if option.endswith('_cpus'):
+                validate_cpus(value)
+            elif option.endswith('_cpuset'):
+                validate_cpuset(value)
+            elif option.endswith('_memory'):
+                validate_memory(value)
+            elif option.endswith('_memory_reservation'):
+                validate_memory(value)
+                group = option[: -len('_memory_reservation')]
+                limit = self.parser.get('resources', group + '_memory', fallback='')
+                try:
+                    limit = parse_memory(limit) if limit else None
+                except ConfigurationError:
+                    # Reported for the limit option
+                    limit = None
+                if limit is not None and parse_memory(value) > limit:
+                    raise ConfigurationError(
+                        'Must not exceed {0}_memory. You provided: {1}'.format(group, value),
+                    )
 
     def remove_unknown(self):
         unknown_sections = []
@@ -0,0 +1,358 @@
+import functools
+import http.client
+import json
+import os
+import queue
+import socket
+import struct
+import threading
+from urllib.parse import quote, urlencode
+
+
+DEFAULT_SOCKET = '/var/run/docker.sock'
+STREAMS = {0: 'stdin', 1: 'stdout', 2: 'stderr'}
+CHUNK_SIZE = 64 * 1024
+
+
+class DockerAPIError(Exception):
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, timeout=60):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+        except OSError:
+            sock.close()
+            raise
+        self.sock = sock
+
+
+def _query(params):
+    params = {name: value for name, value in (params or {}).items() if value is not None}
+    if isinstance(params.get('filters'), dict):
+        params['filters'] = json.dumps(params['filters'])
+    for name, value in params.items():
+        if isinstance(value, bool):
+            params[name] = int(value)
+    return '?' + urlencode(params) if params else ''
+
+
+def _error(status, data):
+    try:
+        message = json.loads(data)['message']
+    except (ValueError, KeyError, TypeError):
+        message = data.decode(errors='replace').strip()
+    return DockerAPIError('Docker API error {0}: {1}'.format(status, message), status=status)
+
+
+class Exec:
+    """
+    The output of a command started with DockerClient.exec, as
+    (stream name, bytes) tuples. The stdin file is sent to the command
+    from a separate thread while the output is read.
+    """
+
+    def __init__(self, client, exec_id, sock, reader, stdin=None):
+        self.client = client
+        self.exec_id = exec_id
+        self.sock = sock
+        self.reader = reader
+        self.writer = None
+        self.error = None
+        if stdin is not None:
+            self.writer = threading.Thread(target=self._write, args=(stdin,), daemon=True)
+            self.writer.start()
+
+    def _write(self, stdin):
+        try:
+            while True:
+                chunk = stdin.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                self.sock.sendall(chunk)
+            # Closing our side of the connection closes the stdin of the
+            # command
+            self.sock.shutdown(socket.SHUT_WR)
+        except OSError as e:
+            self.error = e
+
+    def _read_exactly(self, size):
+        try:
+            data = self.reader.read(size)
+        except OSError as e:
+            raise DockerAPIError('Failed to read the output: {0}'.format(e))
+        if len(data) < size:
+            return None
+        return data
+
+    def __iter__(self):
+        while True:
+            header = self._read_exactly(8)
+            if header is None:
+                break
+            stream, size = struct.unpack('>BxxxL', header)
+            data = self._read_exactly(size)
+            if data is None:
+                break
+            yield STREAMS.get(stream, 'stdout'), data
+        if self.writer:
+            self.writer.join()
+        if self.error:
+            raise DockerAPIError('Failed to write to stdin: {0}'.format(self.error))
+
+    def exit_code(self):
+        return self.client.get('/exec/{0}/json'.format(self.exec_id))['ExitCode']
+
+    def close(self):
+        self.reader.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class DockerClient:
+    """
+    Client for the Docker Engine API over the UNIX socket. Keeps a pool of
+    keep-alive connections for the requests, while streamed responses, such
+    as exec and events, get connections of their own.
+    """
+
+    def __init__(self, socket_path=DEFAULT_SOCKET, pool_size=4, timeout=60):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.pool = queue.LifoQueue(pool_size)
+
+    def _connection(self, timeout=None):
+        return UnixHTTPConnection(self.socket_path, timeout=timeout)
+
+    def _send(self, connection, method, path, params, body):
+        headers = {}
+        if body is not None:
+            body = json.dumps(body).encode()
+            headers['Content-Type'] = 'application/json'
+        connection.request(method, path + _query(params), body=body, headers=headers)
+        return connection.getresponse()
+
+    def request(self, method, path, params=None, body=None):
+        """
+        Returns the decoded JSON of the response, or None if it's empty.
+        """
+        try:
+            connection, reused = self.pool.get_nowait(), True
+        except queue.Empty:
+            connection, reused = self._connection(self.timeout), False
+        try:
+            try:
+                response = self._send(connection, method, path, params, body)
+            except (http.client.RemoteDisconnected, ConnectionError):
+                if not reused:
+                    raise
+                # The daemon closed the idle connection, try a new one
+                connection.close()
+                connection = self._connection(self.timeout)
+                response = self._send(connection, method, path, params, body)
+            data = response.read()
+        except (OSError, http.client.HTTPException) as e:
+            connection.close()
+            raise DockerAPIError('Failed to connect to Docker: {0}'.format(e))
+        if response.will_close:
+            connection.close()
+        else:
+            try:
+                self.pool.put_nowait(connection)
+            except queue.Full:
+                connection.close()
+        if response.status >= 400:
+            raise _error(response.status, data)
+        return json.loads(data) if data else None
+
+    def get(self, path, params=None):
+        return self.request('GET', path, params=params)
+
+    def ping(self):
+        connection = self._connection(self.timeout)
+        try:
+            connection.request('GET', '/_ping')
+            response = connection.getresponse()
+            response.read()
+        except (OSError, http.client.HTTPException) as e:
+            raise DockerAPIError('Failed to connect to Docker: {0}'.format(e))
+        finally:
+            connection.close()
+        if response.status != 200:
+            raise DockerAPIError('Docker API error {0}'.format(response.status), response.status)
+
+    def containers(self, filters=None, all=False):
+        return self.get('/containers/json', {'filters': filters, 'all': all})
+
+    def images(self, filters=None):
+        return self.get('/images/json', {'filters': filters})
+
+    def remove_image(self, name, force=False):
+        """
+        Returns the list of {"Untagged": ...} and {"Deleted": ...} results.
+        """
+        return self.request('DELETE', '/images/' + quote(name), {'force': force})
+
+    def volumes(self, filters=None):
+        return self.get('/volumes', {'filters': filters})['Volumes'] or []
+
+    def remove_volume(self, name):
+        self.request('DELETE', '/volumes/' + quote(name))
+
+    def networks(self, filters=None):
+        return self.get('/networks', {'filters': filters})
+
+    def remove_network(self, name):
+        self.request('DELETE', '/networks/' + quote(name))
+
+    def exec(self, container, cmd, env=None, stdin=None, timeout=None):
+        """
+        Starts the command in the container and returns its Exec. env is a
+        dict of variables for the command, stdin a binary file to send to
+        it. The timeout applies to every read of the output.
+        """
+        created = self.request(
+            'POST',
+            '/containers/{0}/exec'.format(quote(container)),
+            body={
+                'AttachStdin': stdin is not None,
+                'AttachStdout': True,
+                'AttachStderr': True,
+                'Cmd': list(cmd),
+                'Env': ['{0}={1}'.format(name, value) for name, value in (env or {}).items()],
+            },
+        )
+        exec_id = created['Id']
+        # The connection is taken over by the raw stream of the command, so
+        # the request is written by hand
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(timeout)
+            sock.connect(self.socket_path)
+            body = json.dumps({'Detach': False, 'Tty': False}).encode()
+            sock.sendall(
+                (
+                    'POST /exec/{0}/start HTTP/1.1\r\n'
+                    'Host: localhost\r\n'
+                    'Content-Type: application/json\r\n'
+                    'Content-Length: {1}\r\n'
+                    'Connection: Upgrade\r\n'
+                    'Upgrade: tcp\r\n'
+                    '\r\n'
+                )
+                .format(exec_id, len(body))
+                .encode()
+                + body
+            )
+            reader = sock.makefile('rb')
+            status_line = reader.readline().decode(errors='replace')
+            headers = {}
+            for line in iter(reader.readline, b'\r\n'):
+                if not line:
+                    break
+                name, _, value = line.decode(errors='replace').partition(':')
+                headers[name.strip().lower()] = value.strip()
+        except OSError as e:
+            sock.close()
+            raise DockerAPIError('Failed to connect to Docker: {0}'.format(e))
+        parts = status_line.split(None, 2)
+        status = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else 0
+        if status not in (101, 200):
+            length = int(headers.get('content-length', 0))
+            data = reader.read(length) if length else b''
+            reader.close()
+            sock.close()
+            raise _error(status, data)
+        return Exec(self, exec_id, sock, reader, stdin=stdin)
+
+    def exec_run(self, container, cmd, env=None, stdin=None):
+        """
+        Runs the command in the container and returns a tuple of
+        (exit code, stdout, stderr).
+        """
+        output = {'stdout': [], 'stderr': []}
+        with self.exec(container, cmd, env=env, stdin=stdin) as command:
+            for stream, data in command:
+                output[stream].append(data)
+            code = command.exit_code()
+        return code, b''.join(output['stdout']), b''.join(output['stderr'])
+
+    def events(self, filters=None, since=None, until=None):
+        """
+        Yields the events as dicts. Without until, waits for new events
+        until the generator is closed.
+        """
+        connection = self._connection()
+        try:
+            try:
+                response = self._send(
+                    connection,
+                    'GET',
+                    '/events',
+                    {'filters': filters, 'since': since, 'until': until},
+                    None,
+                )
+                if response.status >= 400:
+                    raise _error(response.status, response.read())
+                for line in response:
+                    if line.strip():
+                        yield json.loads(line)
+            except (OSError, http.client.HTTPException) as e:
+                raise DockerAPIError('Failed to read Docker events: {0}'.format(e))
+        finally:
+            connection.close()
+
+
+def socket_path():
+    """
+    Returns the path of the Docker socket, or None if the docker CLI is set
+    up to talk to the daemon in another way.
+    """
+    host = os.environ.get('DOCKER_HOST')
+    if host:
+        return host[len('unix://') :] if host.startswith('unix://') else None
+    context = os.environ.get('DOCKER_CONTEXT')
+    if context is None:
+        config = os.path.join(
+            os.environ.get('DOCKER_CONFIG', os.path.expanduser('~/.docker')), 'config.json'
+        )
+        try:
+            with open(config) as f:
+                context = json.load(f).get('currentContext')
+        except (OSError, ValueError, AttributeError):
+            pass
+    if context and context != 'default':
+        return None
+    return DEFAULT_SOCKET
+
+
+@functools.lru_cache(maxsize=None)
+def docker_client():
+    """
+    Returns the client for the local Docker daemon, or None if it can't be
+    reached over the UNIX socket. The callers fall back to the docker CLI
+    then.
+    """
+    path = socket_path()
+    if not path:
+        return None
+    client = DockerClient(path)
+    try:
+        client.ping()
+    except DockerAPIError:
+        return None
+    return client
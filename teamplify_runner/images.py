@@ -0,0 +1,230 @@
+import re
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+import requests
+
+
+DEFAULT_REGISTRY = 'registry-1.docker.io'
+MANIFEST_TYPES = ', '.join(
+    (
+        'application/vnd.oci.image.index.v1+json',
+        'application/vnd.docker.distribution.manifest.list.v2+json',
+        'application/vnd.oci.image.manifest.v1+json',
+        'application/vnd.docker.distribution.manifest.v2+json',
+    )
+)
+AUTH_PARAM = re.compile(r'(\w+)="([^"]*)"')
+
+
+class ImageError(Exception):
+    pass
+
+
+def required_images(env):
+    """
+    Returns the images of the services that run with the current
+    configuration.
+    """
+    images = [env['IMAGE_DB'], env['IMAGE_REDIS'], env['IMAGE_NGINX'], env['IMAGE_SMTP']]
+    if 'letsencrypt' in env['COMPOSE_PROFILES'].split(','):
+        images.append(env['IMAGE_LETSENCRYPT'])
+    images.append(env['IMAGE_APP'])
+    return images
+
+
+def parse_reference(reference):
+    """
+    Splits an image reference into (registry, repository, tag).
+    """
+    name, _, tag = reference.rpartition(':')
+    if not name or '/' in tag:
+        # No tag, the colon was the registry port
+        name, tag = reference, 'latest'
+    first, _, rest = name.partition('/')
+    if rest and ('.' in first or ':' in first or first == 'localhost'):
+        registry, repository = first, rest
+    else:
+        registry, repository = DEFAULT_REGISTRY, name
+    if registry == DEFAULT_REGISTRY and '/' not in repository:
+        repository = 'library/' + repository
+    return registry, repository, tag
+
+
+def local_image_id(images, reference):
+    return images.get(_normalize(reference), (None, ''))[0]
+
+
+def _normalize(reference):
+    return reference if ':' in reference.rpartition('/')[2] else reference + ':latest'
+
+
+def local_images():
+    """
+    Returns {reference: (id, digest)} of all local images in one call.
+    """
+    result = subprocess.run(
+        [
+            'docker',
+            'image',
+            'ls',
+            '--no-trunc',
+            '--digests',
+            '--format',
+            '{{.Repository}}:{{.Tag}} {{.ID}} {{.Digest}}',
+        ],
+        stdin=subprocess.DEVNULL,
+        capture_output=True,
+    )
+    if result.returncode:
+        raise ImageError(
+            'Failed to list images: {0}'.format(result.stderr.decode(errors='replace').strip()),
+        )
+    images = {}
+    for line in result.stdout.decode().splitlines():
+        parts = line.split()
+        if len(parts) == 3:
+            reference, id_, digest = parts
+            images[reference] = (id_, digest if digest != '<none>' else '')
+    return images
+
+
+def _token(session, challenge, timeout):
+    """
+    Gets an anonymous token for public images, following the
+    WWW-Authenticate challenge of the registry.
+    """
+    scheme, _, params = challenge.partition(' ')
+    if scheme.lower() != 'bearer':
+        return None
+    params = dict(AUTH_PARAM.findall(params))
+    realm = params.pop('realm', None)
+    if not realm:
+        return None
+    response = session.get(realm, params=params, timeout=timeout)
+    response.raise_for_status()
+    data = response.json()
+    return data.get('token') or data.get('access_token')
+
+
+def remote_digest(reference, scheme='https', timeout=10):
+    """
+    Returns the digest the registry has for the reference, or None if it
+    can't be found out.
+    """
+    registry, repository, tag = parse_reference(reference)
+    url = '{0}://{1}/v2/{2}/manifests/{3}'.format(scheme, registry, repository, tag)
+    headers = {'Accept': MANIFEST_TYPES}
+    try:
+        with requests.Session() as session:
+            response = session.head(url, headers=headers, timeout=timeout)
+            if response.status_code == 401:
+                token = _token(session, response.headers.get('WWW-Authenticate', ''), timeout)
+                if not token:
+                    return None
+                headers['Authorization'] = 'Bearer ' + token
+                response = session.head(url, headers=headers, timeout=timeout)
+    except (requests.RequestException, ValueError):
+        return None
+    if response.status_code != 200:
+        return None
+    return response.headers.get('Docker-Content-Digest')
+
+
+def _pull(reference):
+    result = subprocess.run(
+        ['docker', 'pull', '--quiet', reference],
+        stdin=subprocess.DEVNULL,
+        capture_output=True,
+    )
+    if result.returncode:
+        raise ImageError(
+            'Failed to pull {0}: {1}'.format(
+                reference,
+                result.stderr.decode(errors='replace').strip(),
+            )
+        )
+
+
+class Progress:
+    def __init__(self, total):
+        self.total = total
+        self.done = 0
+        self.pulled = 0
+        self.lock = threading.Lock()
+
+    def update(self, pulled):
+        with self.lock:
+            self.done += 1
+            self.pulled += int(pulled)
+            # Add two spaces so we always overwrite the previous string
+            click.echo(
+                'Images: {0} of {1} ready, {2} pulled  \r'.format(
+                    self.done, self.total, self.pulled
+                ),
+                nl=False,
+            )
+
+
+def prefetch(
+    references,
+    workers=3,
+    local=None,
+    digest=remote_digest,
+    pull=_pull,
+    missing_only=False,
+):
+    """
+    Pulls the images concurrently, skipping the ones that are up to date.
+    Returns the list of pulled references.
+
+    Images that exist locally are never a reason to fail: if the registry
+    can't be reached or the pull fails, the local image is used and a
+    warning is shown. With missing_only, only the images that don't exist
+    locally are pulled.
+    """
+    local = local_images() if local is None else local
+    progress = Progress(len(references))
+    warnings = []
+
+    def fetch(reference):
+        local_id, local_digest = local.get(_normalize(reference), (None, ''))
+        if local_id and missing_only:
+            progress.update(pulled=False)
+            return False
+        if local_id:
+            remote = digest(reference)
+            # Without the remote digest, there is no telling whether the
+            # local image is outdated, so it's pulled to find out
+            if remote is not None and remote == local_digest:
+                progress.update(pulled=False)
+                return False
+        try:
+            pull(reference)
+        except ImageError as e:
+            if not local_id:
+                raise
+            warnings.append('{0}, using the local image'.format(e))
+            progress.update(pulled=False)
+            return False
+        progress.update(pulled=True)
+        return True
+
+    errors = []
+    pulled = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [(reference, executor.submit(fetch, reference)) for reference in references]
+        for reference, future in futures:
+            try:
+                if future.result():
+                    pulled.append(reference)
+            except ImageError as e:
+                errors.append(str(e))
+    click.echo('')
+    for warning in warnings:
+        click.echo(click.style(warning, fg='yellow'), err=True)
+    if errors:
+        raise ImageError('\n'.join(errors))
+    return pulled
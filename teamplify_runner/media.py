@@ -0,0 +1,422 @@
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import click
+
+
+MEDIA_VOLUME = 'teamplify_runner_media'
+MEDIA_DIRNAME = 'media'
+MEDIA_MOUNT = '/media'
+COPY_BUFFER_SIZE = 1024 * 1024
+# tar only keeps whole seconds, so the exact times go into a header of ours
+MTIME_HEADER = 'TEAMPLIFY.mtime_ns'
+
+# Runs next to the files with the Python of the app image: lists the
+# regular files, sends some of them as a tar stream or writes the files of a
+# tar stream, removing the given files first
+HELPER = (
+    r"""
+import json, os, shutil, stat, sys, tarfile
+
+MTIME_HEADER = %r
+mode, root = sys.argv[1:3]
+
+
+def full_path(name):
+    path = os.path.normpath(os.path.join(root, name))
+    if not path.startswith(os.path.join(root, '')):
+        raise ValueError('Invalid path: ' + name)
+    return path
+
+
+if mode == 'list':
+    files = {}
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            st = os.lstat(path)
+            if stat.S_ISREG(st.st_mode):
+                files[os.path.relpath(path, root)] = [st.st_size, st.st_mtime_ns]
+    json.dump(files, sys.stdout)
+elif mode == 'read':
+    paths = json.load(sys.stdin)
+    with tarfile.open(fileobj=sys.stdout.buffer, mode='w|', format=tarfile.PAX_FORMAT) as tar:
+        for name in paths:
+            try:
+                f = open(full_path(name), 'rb')
+            except FileNotFoundError:
+                continue
+            with f:
+                info = tar.gettarinfo(arcname=name, fileobj=f)
+                info.pax_headers = {MTIME_HEADER: str(os.fstat(f.fileno()).st_mtime_ns)}
+                tar.addfile(info, f)
+elif mode == 'write':
+    for name in json.loads(sys.stdin.buffer.readline()):
+        try:
+            os.remove(full_path(name))
+        except FileNotFoundError:
+            pass
+    with tarfile.open(fileobj=sys.stdin.buffer, mode='r|') as tar:
+        for info in tar:
+            path = full_path(info.name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + '.tmp', 'wb') as f:
+                shutil.copyfileobj(tar.extractfile(info), f)
+            os.chmod(path + '.tmp', info.mode & 0o7777)
+            if os.geteuid() == 0:
+                os.chown(path + '.tmp', info.uid, info.gid)
+            mtime = int(info.pax_headers[MTIME_HEADER])
+            os.utime(path + '.tmp', ns=(mtime, mtime))
+            os.replace(path + '.tmp', path)
+"""
+    % MTIME_HEADER
+)
+
+
+class MediaError(Exception):
+    pass
+
+
+class Volume:
+    """
+    The files of a directory, accessed through a helper process that runs
+    next to them. For a Docker volume, it's a short-lived container that
+    mounts the volume, so the files are never touched from the host.
+    """
+
+    def __init__(self, python, root):
+        self.python = python
+        self.root = root
+
+    @classmethod
+    def local(cls, path):
+        return cls([sys.executable], os.path.abspath(path))
+
+    @classmethod
+    def docker(cls, image, volume=MEDIA_VOLUME):
+        result = subprocess.run(
+            ['docker', 'volume', 'inspect', volume],
+            stdin=subprocess.DEVNULL,
+            capture_output=True,
+        )
+        if result.returncode:
+            raise MediaError(
+                'Docker volume {0} not found, please start Teamplify at least once'.format(volume),
+            )
+        python = [
+            'docker',
+            'run',
+            '--rm',
+            '-i',
+            '--user',
+            '0',
+            '--network',
+            'none',
+            '--entrypoint',
+            'python3',
+            '-v',
+            '{0}:{1}'.format(volume, MEDIA_MOUNT),
+            image,
+        ]
+        return cls(python, MEDIA_MOUNT)
+
+    @contextmanager
+    def _helper(self, mode):
+        with tempfile.TemporaryFile() as stderr:
+            process = subprocess.Popen(
+                self.python + ['-c', HELPER, mode, self.root],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=stderr,
+            )
+            try:
+                yield process
+            except BaseException:
+                process.kill()
+                process.wait()
+                raise
+            finally:
+                process.stdin.close()
+                process.stdout.close()
+            if process.wait():
+                stderr.seek(0)
+                message = stderr.read().decode(errors='replace').strip()
+                raise MediaError('Failed to access the media files: {0}'.format(message))
+
+    def files(self):
+        """
+        Returns (size, mtime in nanoseconds) of all regular files, by
+        relative path.
+        """
+        with self._helper('list') as process:
+            process.stdin.close()
+            data = process.stdout.read()
+        return {path: tuple(st) for path, st in json.loads(data).items()}
+
+    def read(self, paths):
+        """
+        Yields (path, mtime in nanoseconds, TarInfo, file) of the files that
+        still exist.
+        """
+        with self._helper('read') as process:
+            process.stdin.write(json.dumps(list(paths)).encode())
+            process.stdin.close()
+            with tarfile.open(fileobj=process.stdout, mode='r|') as tar:
+                for info in tar:
+                    if not _safe_path(info.name):
+                        raise MediaError('Invalid path in the media files: {0}'.format(info.name))
+                    mtime = int(info.pax_headers[MTIME_HEADER])
+                    yield info.name, mtime, info, tar.extractfile(info)
+
+    def write(self, files, removed=()):
+        """
+        Removes the files in removed and writes the files, an iterable of
+        (path, local file), with the times, permissions and owners of the
+        local files. Returns the SHA-256 of the written files by path.
+        """
+        digests = {}
+        with self._helper('write') as process:
+            try:
+                process.stdin.write(json.dumps(list(removed)).encode() + b'\n')
+                with tarfile.open(
+                    fileobj=process.stdin,
+                    mode='w|',
+                    format=tarfile.PAX_FORMAT,
+                ) as tar:
+                    for path, local in files:
+                        with open(local, 'rb') as f:
+                            info = tar.gettarinfo(arcname=path, fileobj=f)
+                            info.pax_headers = {
+                                MTIME_HEADER: str(os.fstat(f.fileno()).st_mtime_ns),
+                            }
+                            reader = HashingReader(f)
+                            tar.addfile(info, reader)
+                        digests[path] = reader.digest.hexdigest()
+            except BrokenPipeError:
+                # The helper failed, its error is reported when it exits
+                pass
+        return digests
+
+
+class HashingReader:
+    def __init__(self, f):
+        self.f = f
+        self.digest = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.digest.update(data)
+        return data
+
+
+def _safe_path(path):
+    return not (os.path.isabs(path) or os.path.normpath(path).split(os.sep)[0] == '..')
+
+
+def store_file(src, dst, info, mtime):
+    """
+    Saves the file read from the volume with its times, permissions and,
+    when running as root, the owner. Returns the SHA-256 of the contents.
+    """
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    digest = hashlib.sha256()
+    tmp = dst + '.tmp'
+    with open(tmp, 'wb') as fdst:
+        while True:
+            data = src.read(COPY_BUFFER_SIZE)
+            if not data:
+                break
+            digest.update(data)
+            fdst.write(data)
+    os.chmod(tmp, info.mode & 0o7777)
+    if os.geteuid() == 0:
+        os.chown(tmp, info.uid, info.gid)
+    os.utime(tmp, ns=(mtime, mtime))
+    os.replace(tmp, dst)
+    return digest.hexdigest()
+
+
+def batches(items, count):
+    """
+    Splits the items into at most count batches of similar size.
+    """
+    count = max(min(count, len(items)), 1)
+    return [items[i::count] for i in range(count)] if items else []
+
+
+class Progress:
+    def __init__(self, label, total):
+        self.label = label
+        self.total = total
+        self.done = 0
+        self.lock = threading.Lock()
+
+    def update(self):
+        with self.lock:
+            self.done += 1
+            if self.done % 100 == 0 or self.done == self.total:
+                # Add two spaces so we always overwrite the previous string
+                click.echo(
+                    '{0} {1} of {2} file(s) ...  \r'.format(self.label, self.done, self.total),
+                    nl=False,
+                )
+
+    def finish(self):
+        if self.total:
+            click.echo('')
+
+
+class MediaBackups:
+    """
+    Snapshots of the media files.
+
+    Each snapshot is a complete copy of the files in its own directory, with
+    a manifest of file sizes, modification times and hashes next to it.
+    Files that didn't change since the previous snapshot are hardlinks to
+    the previous copy, so a snapshot only takes the space of the changed
+    files, and removing one doesn't affect the others.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    @classmethod
+    def for_env(cls, env):
+        return cls(os.path.join(env['DB_BACKUP_MOUNT'], MEDIA_DIRNAME))
+
+    def snapshot_dir(self, name):
+        return os.path.join(self.path, name)
+
+    def manifest_path(self, name):
+        return os.path.join(self.path, name + '.json')
+
+    def snapshots(self):
+        """
+        Returns the names of complete snapshots, from the oldest to the newest.
+        """
+        if not os.path.isdir(self.path):
+            return []
+        return sorted(
+            entry.name[: -len('.json')]
+            for entry in os.scandir(self.path)
+            if entry.name.endswith('.json')
+        )
+
+    def load_manifest(self, name):
+        try:
+            with open(self.manifest_path(name)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            raise MediaError('Media snapshot not found: {0}'.format(name))
+
+    def remove(self, name):
+        os.remove(self.manifest_path(name))
+        shutil.rmtree(self.snapshot_dir(name), ignore_errors=True)
+
+    def backup(self, volume, name, threads=None):
+        """
+        Makes a new snapshot of the files of the volume. The changed files
+        are read over several helper processes in parallel. Returns the
+        number of files, the number of copied files and the size of copied
+        files.
+        """
+        previous = self.snapshots()
+        previous = previous[-1] if previous else None
+        old = self.load_manifest(previous)['files'] if previous else {}
+        threads = threads or os.cpu_count() or 1
+        files = volume.files()
+        unchanged = []
+        changed = []
+        for path, (size, mtime) in files.items():
+            entry = old.get(path)
+            if entry and entry['size'] == size and entry['mtime'] == mtime:
+                unchanged.append(path)
+            else:
+                changed.append(path)
+        target = self.snapshot_dir(name)
+        tmp_target = target + '.tmp'
+        shutil.rmtree(tmp_target, ignore_errors=True)
+        os.makedirs(tmp_target)
+        manifest = {}
+        copied = []
+        progress = Progress('Backed up', len(files))
+
+        def link(path):
+            dst = os.path.join(tmp_target, path)
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            os.link(os.path.join(self.snapshot_dir(previous), path), dst)
+            manifest[path] = old[path]
+            progress.update()
+
+        def copy(paths):
+            for path, mtime, info, src in volume.read(paths):
+                digest = store_file(src, os.path.join(tmp_target, path), info, mtime)
+                manifest[path] = {'size': info.size, 'mtime': mtime, 'sha256': digest}
+                copied.append(info.size)
+                progress.update()
+
+        try:
+            with ThreadPoolExecutor(threads) as executor:
+                list(executor.map(link, unchanged))
+                list(executor.map(copy, batches(changed, threads)))
+        except BaseException:
+            shutil.rmtree(tmp_target, ignore_errors=True)
+            raise
+        finally:
+            progress.finish()
+        os.replace(tmp_target, target)
+        with open(self.manifest_path(name) + '.tmp', 'w') as f:
+            json.dump({'name': name, 'previous': previous, 'files': manifest}, f)
+        os.replace(self.manifest_path(name) + '.tmp', self.manifest_path(name))
+        return len(manifest), len(copied), sum(copied)
+
+    def restore(self, name, volume, threads=None):
+        """
+        Makes the files of the volume identical to the snapshot. Files that
+        match the snapshot are left as is, and the rest are written over
+        several helper processes in parallel and verified against the
+        manifest. Returns the number of copied and removed files.
+        """
+        manifest = self.load_manifest(name)['files']
+        snapshot_dir = self.snapshot_dir(name)
+        existing = volume.files()
+        removed = [path for path in existing if path not in manifest]
+        changed = [
+            path
+            for path, entry in manifest.items()
+            if existing.get(path) != (entry['size'], entry['mtime'])
+        ]
+        progress = Progress('Restored', len(changed))
+
+        def files(paths):
+            for path in paths:
+                yield path, os.path.join(snapshot_dir, path)
+                progress.update()
+
+        def write(args):
+            paths, removed = args
+            return volume.write(files(paths), removed=removed)
+
+        threads = threads or os.cpu_count() or 1
+        # The first helper removes the files that are not in the snapshot
+        work = [(paths, []) for paths in batches(changed, threads)]
+        if removed:
+            work[:1] = [(work[0][0] if work else [], removed)]
+        try:
+            with ThreadPoolExecutor(threads) as executor:
+                for digests in executor.map(write, work):
+                    for path, digest in digests.items():
+                        if digest != manifest[path]['sha256']:
+                            raise MediaError('{0} is damaged in snapshot {1}'.format(path, name))
+        finally:
+            progress.finish()
+        return len(changed), len(removed)
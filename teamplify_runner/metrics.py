@@ -0,0 +1,321 @@
+import json
+import os
+import re
+import subprocess
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from teamplify_runner.configurator import PROJECT
+from teamplify_runner.docker_api import DockerAPIError, docker_client
+
+
+UNITS = {
+    '': 1,
+    'k': 1000,
+    'm': 1000**2,
+    'g': 1000**3,
+    't': 1000**4,
+    'ki': 1024,
+    'mi': 1024**2,
+    'gi': 1024**3,
+    'ti': 1024**4,
+}
+SIZE = re.compile(r'^([\d.]+)\s*([kmgt]?i?)b$', re.IGNORECASE)
+
+Container = namedtuple('Container', ('id', 'name', 'service', 'replica'))
+Stats = namedtuple(
+    'Stats',
+    (
+        'cpu_percent',
+        'memory_usage',
+        'memory_limit',
+        'network_receive',
+        'network_transmit',
+        'block_read',
+        'block_write',
+        'pids',
+    ),
+)
+
+# (name, Stats field, type, help)
+METRICS = (
+    ('cpu_percent', 'cpu_percent', 'gauge', 'CPU usage, 100 is one full CPU'),
+    ('memory_usage_bytes', 'memory_usage', 'gauge', 'Memory usage'),
+    ('memory_limit_bytes', 'memory_limit', 'gauge', 'Memory limit'),
+    ('network_receive_bytes_total', 'network_receive', 'counter', 'Bytes received'),
+    ('network_transmit_bytes_total', 'network_transmit', 'counter', 'Bytes sent'),
+    ('block_read_bytes_total', 'block_read', 'counter', 'Bytes read from block devices'),
+    ('block_write_bytes_total', 'block_write', 'counter', 'Bytes written to block devices'),
+    ('pids', 'pids', 'gauge', 'Number of processes'),
+)
+
+
+class MetricsError(Exception):
+    pass
+
+
+def containers(client):
+    """
+    Returns the running containers of Teamplify.
+    """
+    result = []
+    for data in client.containers(
+        filters={'label': ['com.docker.compose.project={0}'.format(PROJECT)]},
+    ):
+        labels = data.get('Labels') or {}
+        result.append(
+            Container(
+                id=data['Id'],
+                name=(data.get('Names') or ['/'])[0].lstrip('/'),
+                service=labels.get('com.docker.compose.service', ''),
+                replica=labels.get('com.docker.compose.container-number', ''),
+            )
+        )
+    return result
+
+
+def cpu_percent(data):
+    """
+    The CPU usage between the two samples of the stats, computed the same
+    way as docker stats does.
+    """
+    cpu = data.get('cpu_stats') or {}
+    precpu = data.get('precpu_stats') or {}
+    cpu_delta = (cpu.get('cpu_usage') or {}).get('total_usage', 0) - (
+        precpu.get('cpu_usage') or {}
+    ).get('total_usage', 0)
+    system_delta = cpu.get('system_cpu_usage', 0) - precpu.get('system_cpu_usage', 0)
+    online = cpu.get('online_cpus') or len((cpu.get('cpu_usage') or {}).get('percpu_usage') or [])
+    if cpu_delta <= 0 or system_delta <= 0:
+        return 0.0
+    return cpu_delta / system_delta * (online or 1) * 100
+
+
+def parse_stats(data):
+    """
+    Converts the response of /containers/{id}/stats to Stats.
+    """
+    memory = data.get('memory_stats') or {}
+    memory_details = memory.get('stats') or {}
+    # Like docker stats, don't count the page cache that can be reclaimed.
+    # cgroup v2 calls it inactive_file, v1 total_inactive_file
+    inactive = memory_details.get('inactive_file', memory_details.get('total_inactive_file', 0))
+    networks = (data.get('networks') or {}).values()
+    block = (data.get('blkio_stats') or {}).get('io_service_bytes_recursive') or []
+    return Stats(
+        cpu_percent=round(cpu_percent(data), 2),
+        memory_usage=max(memory.get('usage', 0) - inactive, 0),
+        memory_limit=memory.get('limit', 0),
+        network_receive=sum(network.get('rx_bytes', 0) for network in networks),
+        network_transmit=sum(network.get('tx_bytes', 0) for network in networks),
+        block_read=sum(item['value'] for item in block if item.get('op', '').lower() == 'read'),
+        block_write=sum(item['value'] for item in block if item.get('op', '').lower() == 'write'),
+        pids=(data.get('pids_stats') or {}).get('current', 0),
+    )
+
+
+def _stats(client, container):
+    try:
+        return client.get('/containers/{0}/stats'.format(container.id), {'stream': False})
+    except DockerAPIError as e:
+        # The container has just been removed
+        if e.status == 404:
+            return None
+        raise
+
+
+def _docker(*args):
+    result = subprocess.run(
+        ['docker'] + list(args),
+        stdin=subprocess.DEVNULL,
+        capture_output=True,
+    )
+    if result.returncode:
+        raise MetricsError(
+            'docker {0} failed: {1}'.format(
+                args[0],
+                result.stderr.decode(errors='replace').strip(),
+            )
+        )
+    return result.stdout.decode()
+
+
+def parse_size(value):
+    """
+    Converts sizes as shown by docker stats, such as 1.5GiB or 12kB, to
+    bytes.
+    """
+    match = SIZE.match(value.strip())
+    if not match:
+        return 0
+    return round(float(match.group(1)) * UNITS[match.group(2).lower()])
+
+
+def _pair(value):
+    first, _, second = value.partition('/')
+    return parse_size(first), parse_size(second)
+
+
+def parse_stats_line(line):
+    """
+    Parses a line of `docker stats --format '{{json .}}'`. Returns a tuple of
+    (container id, Stats).
+    """
+    data = json.loads(line)
+    memory_usage, memory_limit = _pair(data.get('MemUsage', ''))
+    network_receive, network_transmit = _pair(data.get('NetIO', ''))
+    block_read, block_write = _pair(data.get('BlockIO', ''))
+    try:
+        cpu_percent = float(data.get('CPUPerc', '').rstrip('%'))
+    except ValueError:
+        cpu_percent = 0.0
+    try:
+        pids = int(data.get('PIDs', ''))
+    except ValueError:
+        pids = 0
+    return data.get('ID', ''), Stats(
+        cpu_percent=cpu_percent,
+        memory_usage=memory_usage,
+        memory_limit=memory_limit,
+        network_receive=network_receive,
+        network_transmit=network_transmit,
+        block_read=block_read,
+        block_write=block_write,
+        pids=pids,
+    )
+
+
+def _collect_cli():
+    """
+    Collects with the docker CLI when the Docker API isn't available. The
+    sizes are rounded by docker stats, so they are less exact.
+    """
+    output = _docker(
+        'ps',
+        '--filter',
+        'label=com.docker.compose.project={0}'.format(PROJECT),
+        '--format',
+        '{{.ID}} {{.Names}} {{.Label "com.docker.compose.service"}} '
+        '{{.Label "com.docker.compose.container-number"}}',
+    )
+    running = [Container(*line.split()) for line in output.splitlines() if len(line.split()) == 4]
+    if not running:
+        return []
+    output = _docker(
+        'stats', '--no-stream', '--no-trunc', '--format', '{{json .}}', *[c.id for c in running]
+    )
+    stats = dict(parse_stats_line(line) for line in output.splitlines() if line.strip())
+    result = []
+    for container in running:
+        for container_id, container_stats in stats.items():
+            # docker ps shows short IDs, docker stats full ones
+            if container_id.startswith(container.id):
+                result.append((container, container_stats))
+                break
+    return result
+
+
+def collect(client=None):
+    """
+    Returns a list of (Container, Stats). Docker takes a second or two to
+    sample the CPU usage of a container, so all containers are sampled
+    concurrently. Uses the Docker API if it's available and the docker CLI
+    otherwise.
+    """
+    client = client or docker_client()
+    if client is None:
+        return _collect_cli()
+    try:
+        running = containers(client)
+        if not running:
+            return []
+        with ThreadPoolExecutor(len(running)) as executor:
+            stats = list(executor.map(lambda container: _stats(client, container), running))
+    except DockerAPIError as e:
+        raise MetricsError(str(e))
+    return [
+        (container, parse_stats(data))
+        for container, data in zip(running, stats)
+        if data is not None
+    ]
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def prometheus(samples, prefix='teamplify_container_'):
+    """
+    Formats the samples in the Prometheus text exposition format.
+    """
+    lines = []
+    for name, field, metric_type, description in METRICS:
+        lines.append('# HELP {0}{1} {2}'.format(prefix, name, description))
+        lines.append('# TYPE {0}{1} {2}'.format(prefix, name, metric_type))
+        for container, stats in samples:
+            lines.append(
+                '{0}{1}{{container="{2}",service="{3}",replica="{4}"}} {5}'.format(
+                    prefix,
+                    name,
+                    _escape(container.name),
+                    _escape(container.service),
+                    _escape(container.replica),
+                    getattr(stats, field),
+                )
+            )
+    return '\n'.join(lines) + '\n'
+
+
+def write_textfile(path, text):
+    # node-exporter may read the file at any moment, so replace it at once
+    with open(path + '.tmp', 'w') as f:
+        f.write(text)
+    os.replace(path + '.tmp', path)
+
+
+class CachedCollector:
+    """
+    Collects at most once per interval, however often the metrics are
+    scraped.
+    """
+
+    def __init__(self, interval, collect=collect):
+        self.interval = interval
+        self.collect = collect
+        self.lock = threading.Lock()
+        self.collected = None
+        self.text = ''
+
+    def text_format(self):
+        with self.lock:
+            now = time.monotonic()
+            if self.collected is None or now - self.collected >= self.interval:
+                self.text = prometheus(self.collect())
+                self.collected = now
+            return self.text
+
+
+def metrics_server(collector, host, port):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            try:
+                body = collector.text_format().encode()
+            except MetricsError as e:
+                self.send_error(500, str(e))
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    return ThreadingHTTPServer((host, port), Handler)
@@ -0,0 +1,202 @@
+import json
+import os
+import re
+import subprocess
+import time
+
+import click
+import requests
+
+from teamplify_runner.configurator import BASE_DIR
+
+
+READY_MARKER = re.compile(rb"window.BUILD_NUMBER = '\d+'")
+# The marker is in the head of the page, no need to download all of it
+MAX_PROBE_SIZE = 256 * 1024
+# Bad gateway and friends mean that nginx is up, but the app is not yet
+GATEWAY_ERRORS = {502, 503, 504}
+
+
+class Backoff:
+    """
+    Delays between the probes: short at first, when the app may come up at
+    any moment, and growing while nothing changes.
+    """
+
+    def __init__(self, initial=0.2, maximum=3, factor=1.5):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.delay = initial
+
+    def next(self):
+        delay = self.delay
+        self.delay = min(self.delay * self.factor, self.maximum)
+        return delay
+
+    def reset(self):
+        self.delay = self.initial
+
+
+def parse_compose_ps(output):
+    """
+    Parses the output of `docker compose ps --format json`, which is a JSON
+    array in older Compose versions and one JSON object per line in newer.
+    Returns a list of (service, state, health) tuples.
+    """
+    output = output.strip()
+    if not output:
+        return []
+    if output.startswith('['):
+        containers = json.loads(output)
+    else:
+        containers = [json.loads(line) for line in output.splitlines() if line.strip()]
+    return [(c.get('Service', ''), c.get('State', ''), c.get('Health', '')) for c in containers]
+
+
+def pending_services(containers):
+    """
+    Describes the services that are not running or not healthy yet.
+    """
+    pending = []
+    for service, state, health in sorted(containers):
+        if state != 'running':
+            pending.append('{0} ({1})'.format(service, state or 'unknown'))
+        elif health and health != 'healthy':
+            pending.append('{0} ({1})'.format(service, health))
+    return pending
+
+
+def health_pending(containers):
+    """
+    Returns the services with healthchecks that don't pass yet.
+    """
+    return sorted(service for service, _, health in containers if health and health != 'healthy')
+
+
+def compose_services(env):
+    try:
+        result = subprocess.run(
+            ['docker', 'compose', 'ps', '--all', '--format', 'json'],
+            cwd=BASE_DIR,
+            env={**os.environ, **env},
+            stdin=subprocess.DEVNULL,
+            capture_output=True,
+            timeout=10,
+        )
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    if result.returncode:
+        return None
+    try:
+        return parse_compose_ps(result.stdout.decode())
+    except ValueError:
+        return None
+
+
+class ReadinessProbe:
+    """
+    Checks whether Teamplify is serving requests, reusing one keep-alive
+    connection for all probes.
+    """
+
+    def __init__(self, url, timeout=(2, 5)):
+        self.url = url
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def check(self):
+        """
+        Returns a tuple of (ready, status).
+        """
+        try:
+            response = self.session.get(self.url, timeout=self.timeout, stream=True)
+        except (requests.ConnectionError, requests.Timeout):
+            return False, 'Connecting'
+        with response:
+            if response.status_code in GATEWAY_ERRORS:
+                return False, 'Waiting for the app'
+            content = b''
+            for chunk in response.iter_content(16 * 1024):
+                content += chunk
+                if READY_MARKER.search(content):
+                    return True, 'Started'
+                if len(content) >= MAX_PROBE_SIZE:
+                    break
+        if b'Welcome to nginx!' in content:
+            return False, 'Started nginx'
+        if b'Teamplify is starting...' in content:
+            return False, 'Teamplify is starting'
+        raise RuntimeError(
+            '\n\nUnexpected response from Teamplify: {0}\n\n'
+            'Please check the Troubleshooting guide:\n -> '
+            'https://github.com/teamplify/teamplify-runner/#troubleshooting'.format(
+                content.decode(errors='replace'),
+            )
+        )
+
+    def close(self):
+        self.session.close()
+
+
+def wait_for_start(
+    url,
+    env=None,
+    max_minutes=10,
+    backoff=None,
+    services_interval=5,
+    services=compose_services,
+):
+    """
+    Probes Teamplify until it serves requests and the healthchecks of all
+    services pass, reporting the services that hold up the start.
+    """
+    click.echo('\nTeamplify will be available at {0}\n'.format(url))
+    probe = ReadinessProbe(url)
+    backoff = backoff or Backoff()
+    start_time = time.monotonic()
+    deadline = start_time + max_minutes * 60
+    pending = []
+    checking = []
+    last_status = None
+    services_checked = None
+    try:
+        while True:
+            ready, status = probe.check()
+            now = time.monotonic()
+            if env is not None and (
+                ready or services_checked is None or now - services_checked >= services_interval
+            ):
+                services_checked = now
+                containers = services(env)
+                if containers is not None:
+                    pending = pending_services(containers)
+                    checking = health_pending(containers)
+            if ready and not checking:
+                click.echo('\n\nTeamplify successfully started!')
+                return
+            if pending:
+                status += ', waiting for ' + ', '.join(pending)
+            if status != last_status:
+                # Something has changed, so the next one may be close
+                backoff.reset()
+                last_status = status
+            minutes, seconds = divmod(int(now - start_time), 60)
+            # Add two spaces so we always overwrite the previous string
+            click.echo(
+                '{0}, {1} min {2} sec ...  \r'.format(status, minutes, seconds),
+                nl=False,
+            )
+            if now >= deadline:
+                break
+            time.sleep(min(backoff.next(), max(deadline - now, 0)))
+    finally:
+        probe.close()
+    raise RuntimeError(
+        "\n\nTeamplify didn't start in {0} minutes{1}. "
+        'Please check the Troubleshooting guide:\n'
+        ' -> https://github.com/teamplify/teamplify-runner/#troubleshooting'.format(
+            max_minutes,
+            ', still waiting for ' + ', '.join(pending) if pending else '',
+        )
+    )
@@ -0,0 +1,294 @@
+import os
+from collections import OrderedDict
+
+from teamplify_runner.configurator import BASE_DIR, str_to_bool
+
+
+GENERATED_DIR = os.path.join(BASE_DIR, 'generated')
+
+# Presets for the size of the server
+MYSQL_SIZES = OrderedDict(
+    (
+        (
+            'small',
+            {
+                'innodb_buffer_pool_size': 256,
+                'innodb_log_file_size': 64,
+                'innodb_io_capacity': 200,
+                'max_connections': 151,
+            },
+        ),
+        (
+            'medium',
+            {
+                'innodb_buffer_pool_size': 1024,
+                'innodb_log_file_size': 256,
+                'innodb_io_capacity': 1000,
+                'max_connections': 300,
+            },
+        ),
+        (
+            'large',
+            {
+                'innodb_buffer_pool_size': 4096,
+                'innodb_log_file_size': 1024,
+                'innodb_io_capacity': 2000,
+                'max_connections': 500,
+            },
+        ),
+    )
+)
+
+# Presets for how commits are flushed to disk
+MYSQL_DURABILITY = OrderedDict(
+    (
+        # Every transaction is flushed to disk on commit, nothing is lost if
+        # the server crashes
+        (
+            'durable',
+            {
+                'innodb_flush_log_at_trx_commit': 1,
+                'sync_binlog': 1,
+            },
+        ),
+        # The log is flushed about once a second, so a crash of the OS may
+        # lose the last second of transactions, but commits are much cheaper
+        (
+            'fast',
+            {
+                'innodb_flush_log_at_trx_commit': 2,
+                'sync_binlog': 0,
+            },
+        ),
+    )
+)
+
+# Options from the [db] section that go to mysql.cnf. Sizes are in megabytes
+MYSQL_OPTIONS = (
+    'innodb_buffer_pool_size',
+    'innodb_log_file_size',
+    'innodb_flush_log_at_trx_commit',
+    'innodb_io_capacity',
+    'max_connections',
+)
+
+
+def mysql_settings(env):
+    """
+    Returns the MySQL settings from the size and durability presets,
+    overridden by the options set explicitly in the [db] section.
+    """
+    settings = OrderedDict()
+    size = env.get('DB_SIZE', '')
+    if size:
+        settings.update(MYSQL_SIZES[size])
+    settings.update(MYSQL_DURABILITY[env.get('DB_DURABILITY') or 'durable'])
+    for option in MYSQL_OPTIONS:
+        value = env.get('DB_' + option.upper(), '')
+        if value:
+            settings[option] = int(value)
+    return settings
+
+
+def render_mysql_cnf(env):
+    with open(os.path.join(BASE_DIR, 'mysql.cnf')) as f:
+        cnf = f.read()
+    lines = [
+        '',
+        '# Generated by teamplify from the [db] section of the configuration',
+        '[mysqld]',
+    ]
+    for option, value in mysql_settings(env).items():
+        if option == 'innodb_buffer_pool_size':
+            lines.append('innodb_buffer_pool_size = {0}M'.format(value))
+        elif option == 'innodb_log_file_size':
+            # MySQL 8.0.30+ sizes the redo log with a single setting. It was
+            # two log files of innodb_log_file_size before
+            lines.append('innodb_redo_log_capacity = {0}M'.format(value * 2))
+        else:
+            lines.append('{0} = {1}'.format(option, value))
+    return cnf.rstrip('\n') + '\n' + '\n'.join(lines) + '\n'
+
+
+def separate_broker(env):
+    return str_to_bool(env.get('REDIS_SEPARATE_BROKER', 'no'))
+
+
+def render_redis_conf(env, broker=False):
+    """
+    Renders the config of the shared Redis instance, or of the cache and the
+    broker instances if the broker is separate.
+    """
+    with open(os.path.join(BASE_DIR, 'redis.conf')) as f:
+        base = f.read()
+    lines = ['', '# Generated by teamplify from the [redis] section of the configuration']
+    if broker:
+        maxmemory = env.get('REDIS_BROKER_MAXMEMORY', '')
+        # Tasks must never be evicted, and should survive a restart
+        policy = 'noeviction'
+        base = base.replace('appendonly no', 'appendonly yes\nappendfsync everysec')
+    else:
+        maxmemory = env.get('REDIS_MAXMEMORY', '')
+        # When the instance also holds the task queues, only evict the keys
+        # that expire anyway, such as cached values
+        policy = env.get('REDIS_MAXMEMORY_POLICY', '') or (
+            'allkeys-lru' if separate_broker(env) else 'volatile-lru'
+        )
+    if maxmemory:
+        lines.append('maxmemory {0}mb'.format(maxmemory))
+    lines.append('maxmemory-policy {0}'.format(policy))
+    io_threads = int(env.get('REDIS_IO_THREADS', '') or 1)
+    if io_threads > 1:
+        lines.append('io-threads {0}'.format(io_threads))
+        lines.append('io-threads-do-reads yes')
+    return base.rstrip('\n') + '\n' + '\n'.join(lines) + '\n'
+
+
+GZIP_TYPES = (
+    'text/css',
+    'text/plain',
+    'text/xml',
+    'application/javascript',
+    'application/json',
+    'application/xml',
+    'image/svg+xml',
+    'font/ttf',
+    'font/otf',
+)
+
+
+def render_vhost_conf(env):
+    """
+    Renders the nginx config of the Teamplify host, with the static and media
+    delivery settings from the [web] section.
+    """
+    caching = str_to_bool(env.get('WEB_STATIC_CACHING', 'yes'))
+    precompressed = str_to_bool(env.get('WEB_PRECOMPRESS_STATIC', 'yes'))
+    lines = [
+        '# Generated by teamplify from the [web] section of the configuration',
+        'gzip on;',
+        'gzip_vary on;',
+        'gzip_proxied any;',
+        'gzip_comp_level 5;',
+        'gzip_min_length 1024;',
+        'gzip_types {0};'.format(' '.join(GZIP_TYPES)),
+        '',
+    ]
+    if caching:
+        lines += [
+            'open_file_cache max=10000 inactive=5m;',
+            'open_file_cache_valid 1m;',
+            'open_file_cache_min_uses 2;',
+            'open_file_cache_errors on;',
+            '',
+        ]
+    lines += ['location /media/ {', '    alias   /media/;']
+    if caching:
+        lines += ['    sendfile on;', '    tcp_nopush on;', '    expires 1h;']
+    lines += ['}', '']
+    if caching:
+        lines += [
+            '# Fingerprinted static files never change, a new version gets a new name',
+            'location ~ "^/static/.+\\.[0-9a-f]{12}\\.[A-Za-z0-9]+$" {',
+            '    root    /;',
+            '    add_header Cache-Control "public, max-age=31536000, immutable";',
+        ]
+        if precompressed:
+            lines.append('    gzip_static on;')
+        lines += ['}', '']
+    lines += ['location /static/ {', '    alias   /static/;']
+    if caching:
+        lines.append('    expires 1h;')
+    if precompressed:
+        lines.append('    gzip_static on;')
+    lines += ['}', '']
+    with open(os.path.join(BASE_DIR, 'vhost.conf')) as f:
+        return '\n'.join(lines) + '\n' + f.read()
+
+
+# Django renders large pages, such as reports, so a response mostly fits the
+# buffers and doesn't spill to temporary files
+UWSGI_LOCATION = (
+    'uwsgi_buffer_size 32k;',
+    'uwsgi_buffers 16 32k;',
+    'uwsgi_busy_buffers_size 64k;',
+    'uwsgi_connect_timeout 5s;',
+    'uwsgi_send_timeout 60s;',
+    'uwsgi_read_timeout 300s;',
+    # A replica that is restarting refuses connections, try another one. Slow
+    # responses are not retried, as the request may be already processed
+    'uwsgi_next_upstream error http_502 http_503;',
+    'uwsgi_next_upstream_tries 2;',
+)
+
+
+def microcache(env):
+    return int(env.get('WEB_MICROCACHE', '') or 0)
+
+
+def render_nginx_http_conf(env):
+    """
+    Renders the settings that must be in the http block of the nginx config.
+    """
+    lines = ['# Generated by teamplify from the [web] section of the configuration']
+    # nginx terminates TLS only in the builtin SSL mode
+    if env.get('HTTPS_METHOD') == 'redirect':
+        # Smaller TLS records let the browser start rendering the page before
+        # the whole 16k record arrives
+        lines += ['ssl_buffer_size 4k;', '']
+    if microcache(env):
+        lines += [
+            'uwsgi_cache_path /var/cache/nginx/teamplify levels=1:2 '
+            'keys_zone=teamplify:10m max_size=256m inactive=10m use_temp_path=off;',
+            '',
+            '# Only anonymous requests are cached, the pages of signed in users are not',
+            'map $http_cookie$http_authorization $teamplify_no_cache {',
+            '    default 1;',
+            '    "" 0;',
+            '}',
+        ]
+    return '\n'.join(lines) + '\n'
+
+
+def render_vhost_location_conf(env):
+    """
+    Renders the settings of the location that passes requests to the app.
+    """
+    lines = ['# Generated by teamplify from the [web] section of the configuration']
+    lines += UWSGI_LOCATION
+    seconds = microcache(env)
+    if seconds:
+        lines += [
+            '',
+            'uwsgi_cache teamplify;',
+            'uwsgi_cache_key $scheme$host$request_uri;',
+            'uwsgi_cache_valid 200 301 302 {0}s;'.format(seconds),
+            'uwsgi_cache_bypass $teamplify_no_cache;',
+            'uwsgi_no_cache $teamplify_no_cache;',
+            # Only one request for a page goes to the app when it expires
+            'uwsgi_cache_lock on;',
+            'uwsgi_cache_use_stale updating error timeout http_502 http_503;',
+            'uwsgi_cache_background_update on;',
+        ]
+    return '\n'.join(lines) + '\n'
+
+
+def _write(name, content):
+    os.makedirs(GENERATED_DIR, exist_ok=True)
+    path = os.path.join(GENERATED_DIR, name)
+    with open(path + '.tmp', 'w') as f:
+        f.write(content)
+    os.replace(path + '.tmp', path)
+    return path
+
+
+def render_all(env):
+    """
+    Renders the configuration files mounted into the containers.
+    """
+    _write('mysql.cnf', render_mysql_cnf(env))
+    _write('redis.conf', render_redis_conf(env))
+    _write('redis-broker.conf', render_redis_conf(env, broker=True))
+    _write('vhost.conf', render_vhost_conf(env))
+    _write('vhost_location.conf', render_vhost_location_conf(env))
+    _write('nginx.conf', render_nginx_http_conf(env))
@@ -0,0 +1,377 @@
+import fcntl
+import hashlib
+import io
+import json
+import os
+import re
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+
+REPOSITORY_DIRNAME = 'repository'
+LOCK_FILENAME = 'lock'
+MIN_CHUNK_SIZE = 256 * 1024
+MAX_CHUNK_SIZE = 8 * 1024 * 1024
+# On average, every 64th boundary candidate past the minimal size ends a chunk
+BOUNDARY_MASK = 0x3F
+WINDOW_SIZE = 48
+# Boundary candidates: the end of a line, or the end of a row in a
+# multi-row INSERT statement. Rows are where the changes between two dumps
+# happen, so boundaries placed after them re-synchronize right after a change
+BOUNDARY = re.compile(rb'\n|\),\(')
+
+
+class RepositoryError(Exception):
+    pass
+
+
+class Chunker:
+    """
+    Content-defined chunking of a stream.
+
+    A chunk ends at a boundary candidate when the hash of the bytes preceding
+    it matches the mask. Since boundaries depend only on the local content,
+    an insertion or a change in one place of a dump only affects the chunks
+    around it, and the rest of the chunks are the same as in the previous
+    dump.
+    """
+
+    def __init__(
+        self,
+        min_size=MIN_CHUNK_SIZE,
+        max_size=MAX_CHUNK_SIZE,
+        mask=BOUNDARY_MASK,
+    ):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.mask = mask
+        self.buffer = bytearray()
+        # Where to continue looking for a boundary when more data arrives
+        self.scan_position = min_size
+
+    def _cut(self):
+        buffer = self.buffer
+        pos = self.scan_position
+        while True:
+            match = BOUNDARY.search(buffer, pos, self.max_size)
+            if not match:
+                break
+            end = match.end()
+            if zlib.crc32(buffer[max(end - WINDOW_SIZE, 0) : end]) & self.mask == 0:
+                return end
+            pos = end
+        if len(buffer) >= self.max_size:
+            return self.max_size
+        # Step back a little, a delimiter may be split between two writes
+        self.scan_position = max(pos, len(buffer) - 2, self.min_size)
+        return None
+
+    def feed(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.min_size:
+            end = self._cut()
+            if end is None:
+                break
+            chunk = bytes(self.buffer[:end])
+            del self.buffer[:end]
+            self.scan_position = self.min_size
+            yield chunk
+
+    def flush(self):
+        if self.buffer:
+            chunk = bytes(self.buffer)
+            self.buffer.clear()
+            yield chunk
+
+
+def _compress_chunk(data, level):
+    return hashlib.sha256(data).hexdigest(), zlib.compress(data, level)
+
+
+class SnapshotWriter:
+    """
+    File-like object that stores the data written to it as a new snapshot,
+    saving only the chunks that are not in the repository yet. The
+    repository stays locked until the writer is closed or aborted, since
+    prune would see the new chunks as unreferenced until then.
+    """
+
+    def __init__(self, repository, name, level=6, threads=None):
+        self.lock = repository.lock()
+        self.repository = repository
+        self.name = name
+        self.level = level
+        self.threads = threads or os.cpu_count() or 1
+        self.executor = ThreadPoolExecutor(self.threads)
+        self.pending = deque()
+        self.chunker = Chunker()
+        self.chunks = []
+        self.size = 0
+        self.new_chunks = 0
+        self.new_size = 0
+
+    def _submit(self, chunk):
+        self.pending.append(
+            (len(chunk), self.executor.submit(_compress_chunk, chunk, self.level)),
+        )
+        while len(self.pending) > self.threads * 2:
+            self._store_next()
+
+    def _store_next(self):
+        size, future = self.pending.popleft()
+        digest, compressed = future.result()
+        if self.repository.store_chunk(digest, compressed):
+            self.new_chunks += 1
+            self.new_size += len(compressed)
+        self.chunks.append([digest, size])
+        self.size += size
+
+    def write(self, data):
+        for chunk in self.chunker.feed(data):
+            self._submit(chunk)
+
+    def abort(self):
+        """
+        Stops writing without saving the snapshot. The chunks saved so far
+        are removed by the next prune.
+        """
+        self.executor.shutdown(cancel_futures=True)
+        self.lock.close()
+
+    def close(self):
+        try:
+            try:
+                for chunk in self.chunker.flush():
+                    self._submit(chunk)
+                while self.pending:
+                    self._store_next()
+            finally:
+                self.executor.shutdown(cancel_futures=True)
+            self.repository.save_snapshot(
+                {
+                    'name': self.name,
+                    'created': datetime.utcnow().replace(microsecond=0).isoformat(),
+                    'size': self.size,
+                    'chunks': self.chunks,
+                }
+            )
+        finally:
+            self.lock.close()
+
+
+class SnapshotReader(io.RawIOBase):
+    """
+    Reassembles a snapshot as a stream, loading and decompressing the next
+    chunks in the background.
+    """
+
+    def __init__(self, repository, snapshot, prefetch=4):
+        super().__init__()
+        self.repository = repository
+        self.chunks = deque(snapshot['chunks'])
+        self.prefetch = prefetch
+        self.executor = ThreadPoolExecutor(prefetch)
+        self.pending = deque()
+        self.current = b''
+        self.offset = 0
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def _fill(self):
+        while self.chunks and len(self.pending) < self.prefetch:
+            digest, size = self.chunks.popleft()
+            self.pending.append(self.executor.submit(self.repository.load_chunk, digest, size))
+
+    def readinto(self, buffer):
+        if self.offset >= len(self.current):
+            self._fill()
+            if not self.pending:
+                return 0
+            self.current = self.pending.popleft().result()
+            self.offset = 0
+        size = min(len(buffer), len(self.current) - self.offset)
+        buffer[:size] = self.current[self.offset : self.offset + size]
+        self.offset += size
+        self.position += size
+        return size
+
+    def close(self):
+        self.executor.shutdown(cancel_futures=True)
+        super().close()
+
+
+class SnapshotSource:
+    """
+    Contents of a snapshot, with the same interface as ArchiveSource.
+    """
+
+    def __init__(self, repository, name):
+        snapshot = repository.load_snapshot(name)
+        self.name = name
+        self.size = snapshot['size']
+        self.reader = SnapshotReader(repository, snapshot)
+        self.stream = io.BufferedReader(self.reader, 1024 * 1024)
+
+    def position(self):
+        return self.reader.position
+
+    def close(self):
+        self.stream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class Repository:
+    """
+    Deduplicating backup repository.
+
+    Snapshots are lists of chunks stored in the snapshots directory. Chunks
+    are compressed and stored under their SHA-256 hash, so identical chunks
+    of different snapshots are stored once.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.chunks_dir = os.path.join(path, 'chunks')
+        self.snapshots_dir = os.path.join(path, 'snapshots')
+        self._index = None
+
+    @classmethod
+    def for_env(cls, env):
+        return cls(os.path.join(env['DB_BACKUP_MOUNT'], REPOSITORY_DIRNAME))
+
+    @property
+    def index(self):
+        """
+        The set of hashes of the chunks in the repository.
+        """
+        if self._index is None:
+            self._index = set()
+            if os.path.isdir(self.chunks_dir):
+                for prefix in os.scandir(self.chunks_dir):
+                    if prefix.is_dir():
+                        self._index.update(
+                            entry.name for entry in os.scandir(prefix.path) if '.' not in entry.name
+                        )
+        return self._index
+
+    def lock(self):
+        """
+        Takes the exclusive lock of the repository and returns the lock file.
+        Closing the file releases the lock.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        f = open(os.path.join(self.path, LOCK_FILENAME), 'w')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            f.close()
+            raise RepositoryError('The repository is in use by another backup or prune')
+        # Other processes may have added or removed chunks in the meantime
+        self._index = None
+        return f
+
+    def chunk_path(self, digest):
+        return os.path.join(self.chunks_dir, digest[:2], digest)
+
+    def store_chunk(self, digest, data):
+        """
+        Saves the chunk unless it's already in the repository. Returns True
+        if the chunk was saved.
+        """
+        if digest in self.index:
+            return False
+        path = self.chunk_path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(path + '.tmp', path)
+        self.index.add(digest)
+        return True
+
+    def load_chunk(self, digest, size):
+        try:
+            with open(self.chunk_path(digest), 'rb') as f:
+                data = zlib.decompress(f.read())
+        except (OSError, zlib.error) as e:
+            raise RepositoryError('Chunk {0} is missing or damaged: {1}'.format(digest, e))
+        if len(data) != size or hashlib.sha256(data).hexdigest() != digest:
+            raise RepositoryError('Chunk {0} is damaged'.format(digest))
+        return data
+
+    def snapshot_path(self, name):
+        return os.path.join(self.snapshots_dir, name + '.json')
+
+    def save_snapshot(self, snapshot):
+        os.makedirs(self.snapshots_dir, exist_ok=True)
+        path = self.snapshot_path(snapshot['name'])
+        with open(path + '.tmp', 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(path + '.tmp', path)
+
+    def load_snapshot(self, name):
+        try:
+            with open(self.snapshot_path(name)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            raise RepositoryError('Snapshot not found: {0}'.format(name))
+
+    def snapshots(self):
+        """
+        Returns the snapshots sorted from the oldest to the newest.
+        """
+        if not os.path.isdir(self.snapshots_dir):
+            return []
+        snapshots = []
+        for entry in os.scandir(self.snapshots_dir):
+            if entry.name.endswith('.json'):
+                with open(entry.path) as f:
+                    snapshots.append(json.load(f))
+        return sorted(snapshots, key=lambda s: (s['created'], s['name']))
+
+    def writer(self, name, level=6, threads=None):
+        return SnapshotWriter(self, name, level=level, threads=threads)
+
+    def open(self, name):
+        return SnapshotSource(self, name)
+
+    def remove_snapshot(self, name):
+        os.remove(self.snapshot_path(name))
+
+    def prune(self, keep_last=None):
+        """
+        Removes all but keep_last newest snapshots, and then the chunks that
+        are not referenced by any snapshot. Returns the names of the removed
+        snapshots, the number of removed chunks and the freed space.
+        """
+        with self.lock():
+            return self._prune(keep_last)
+
+    def _prune(self, keep_last):
+        snapshots = self.snapshots()
+        removed = []
+        if keep_last is not None and len(snapshots) > keep_last:
+            for snapshot in snapshots[: len(snapshots) - keep_last]:
+                self.remove_snapshot(snapshot['name'])
+                removed.append(snapshot['name'])
+            snapshots = snapshots[len(snapshots) - keep_last :]
+        referenced = set()
+        for snapshot in snapshots:
+            referenced.update(digest for digest, _ in snapshot['chunks'])
+        removed_chunks = 0
+        freed = 0
+        for digest in list(self.index - referenced):
+            path = self.chunk_path(digest)
+            freed += os.path.getsize(path)
+            os.remove(path)
+            self.index.discard(digest)
+            removed_chunks += 1
+        return removed, removed_chunks, freed
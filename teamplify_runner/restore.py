@@ -0,0 +1,316 @@
+import queue
+import re
+import subprocess
+import tempfile
+import threading
+import time
+
+import click
+
+from teamplify_runner.backup import CHUNK_SIZE, format_size, mysql_command, mysql_env
+
+
+# Session settings applied to every restore connection for the duration of
+# the restore. The dump itself re-enables the checks at the end of the
+# preamble scope, but only for the connection that ran it.
+BULK_LOAD_SETTINGS = (
+    b'SET SESSION foreign_key_checks = 0;\n'
+    b'SET SESSION unique_checks = 0;\n'
+    b'SET SESSION autocommit = 0;\n'
+)
+# Keeping the restore out of the binary log requires a privilege that the DB
+# user may not have, so it's only added on request
+SKIP_BINLOG_SETTING = b'SET SESSION sql_log_bin = 0;\n'
+
+
+def bulk_load_settings(skip_binlog=False):
+    if skip_binlog:
+        return BULK_LOAD_SETTINGS + SKIP_BINLOG_SETTING
+    return BULK_LOAD_SETTINGS
+
+
+SECTION_HEADER = re.compile(
+    rb'^-- (?:'
+    rb'Table structure for table `(?P<table>.+)`'
+    rb'|Temporary view structure for view `.+`'
+    rb'|Final view structure for view `.+`'
+    rb'|Dumping routines for database .+'
+    rb'|Dumping events for database .+'
+    rb')\s*$',
+)
+
+
+class Table:
+    """
+    A single table section of the dump, streamed to a loader through a
+    bounded queue of chunks.
+    """
+
+    def __init__(self, name, max_chunks):
+        self.name = name
+        self.chunks = queue.Queue(max_chunks)
+        self.size = 0
+        self.started = None
+        self.finished = None
+
+
+def split_dump(lines, chunk_size=CHUNK_SIZE):
+    """
+    Splits the lines of a mysqldump into sections.
+
+    Yields (kind, name, chunk) tuples, where kind is 'preamble', 'table' or
+    'serial'. Chunks of the same section are yielded consecutively, and each
+    new section starts with a new chunk. 'serial' sections (views, routines,
+    events) depend on the tables, so they must run after all of them.
+    """
+    kind, name = 'preamble', None
+    chunk = []
+    chunk_length = 0
+    for line in lines:
+        match = SECTION_HEADER.match(line)
+        if match:
+            if chunk:
+                yield kind, name, b''.join(chunk)
+                chunk, chunk_length = [], 0
+            table = match.group('table')
+            if table is not None:
+                kind, name = 'table', table.decode()
+            else:
+                kind, name = 'serial', None
+        chunk.append(line)
+        chunk_length += len(line)
+        if chunk_length >= chunk_size:
+            yield kind, name, b''.join(chunk)
+            chunk, chunk_length = [], 0
+    if chunk:
+        yield kind, name, b''.join(chunk)
+
+
+class Loader(threading.Thread):
+    """
+    Loads the tables it picks from the queue through its own MySQL connection.
+    """
+
+    def __init__(self, env, preamble, tables, progress, command=None, settings=BULK_LOAD_SETTINGS):
+        super().__init__(daemon=True)
+        self.settings = settings
+        self.preamble = preamble
+        self.tables = tables
+        self.progress = progress
+        self.error = None
+        self.stderr = tempfile.TemporaryFile()
+        self.process = subprocess.Popen(
+            command or mysql_command(env),
+            stdin=subprocess.PIPE,
+            stderr=self.stderr,
+            env=mysql_env(env),
+        )
+
+    def run(self):
+        try:
+            self.process.stdin.write(self.settings + self.preamble)
+            while True:
+                table = self.tables.get()
+                if table is None:
+                    break
+                table.started = time.monotonic()
+                self.progress.table_started(table)
+                while True:
+                    chunk = table.chunks.get()
+                    if chunk is None:
+                        break
+                    self.process.stdin.write(chunk)
+                self.process.stdin.write(b'COMMIT;\n')
+                self.process.stdin.flush()
+                table.finished = time.monotonic()
+                self.progress.table_done(table)
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        except Exception as e:
+            self.error = str(e)
+        code = self.process.wait()
+        if code and not self.error:
+            self.stderr.seek(0)
+            self.error = 'mysql failed, exit code {0}: {1}'.format(
+                code,
+                self.stderr.read().decode(errors='replace').strip(),
+            )
+        self.stderr.close()
+
+    def abort(self):
+        self.process.kill()
+
+
+class RestoreProgress:
+    """
+    Reports the overall progress, the ETA and the tables being loaded.
+    """
+
+    def __init__(self, total_size, position, interval=1):
+        self.total_size = total_size
+        self.position = position
+        self.interval = interval
+        self.start_time = time.monotonic()
+        self.last_report = 0
+        self.loading = set()
+        self.lock = threading.Lock()
+
+    def status(self):
+        elapsed = time.monotonic() - self.start_time
+        status = 'Restoring'
+        if self.total_size and self.position:
+            done = min(self.position() / self.total_size, 1)
+            status += ' {0:.0f}%'.format(done * 100)
+            if done > 0.01:
+                eta = int(elapsed / done - elapsed)
+                status += ', ETA {0} min {1} sec'.format(*divmod(eta, 60))
+        if self.loading:
+            status += ', loading: {0}'.format(', '.join(sorted(self.loading)))
+        return status
+
+    def update(self, force=False):
+        now = time.monotonic()
+        if force or now - self.last_report >= self.interval:
+            self.last_report = now
+            with self.lock:
+                # Add two spaces so we always overwrite the previous string
+                click.echo('{0} ...  \r'.format(self.status()[:150]), nl=False)
+
+    def table_started(self, table):
+        with self.lock:
+            self.loading.add(table.name)
+
+    def table_done(self, table):
+        with self.lock:
+            self.loading.discard(table.name)
+            click.echo(
+                '\033[K -> {0}: {1} in {2:.0f} sec'.format(
+                    table.name,
+                    format_size(table.size),
+                    table.finished - table.started,
+                ),
+            )
+
+
+def restore(  # noqa C901
+    env,
+    lines,
+    connections=4,
+    total_size=None,
+    position=None,
+    max_chunks=16,
+    command=None,
+    skip_binlog=False,
+):
+    """
+    Restores the dump from an iterable of lines, loading tables in parallel
+    over several MySQL connections. Memory usage is bounded by max_chunks
+    chunks per table in flight. With skip_binlog, the restore is not written
+    to the binary log, which requires the DB user to be allowed to change
+    sql_log_bin.
+    """
+    settings = bulk_load_settings(skip_binlog)
+    progress = RestoreProgress(total_size, position)
+    tables = queue.Queue()
+    loaders = []
+    preamble = []
+    serial = []
+    current = None
+    table_count = 0
+
+    def start_loaders():
+        for _ in range(connections):
+            loader = Loader(
+                env,
+                b''.join(preamble),
+                tables,
+                progress,
+                command=command,
+                settings=settings,
+            )
+            loader.start()
+            loaders.append(loader)
+
+    def check_loaders():
+        for loader in loaders:
+            if loader.error:
+                raise RuntimeError(loader.error)
+
+    def put_chunk(table, chunk):
+        while True:
+            try:
+                table.chunks.put(chunk, timeout=0.5)
+                return
+            except queue.Full:
+                check_loaders()
+                progress.update()
+
+    try:
+        for kind, name, chunk in split_dump(lines):
+            if kind == 'preamble':
+                preamble.append(chunk)
+                continue
+            if not loaders:
+                start_loaders()
+            if kind == 'serial':
+                serial.append(chunk)
+            else:
+                if current is None or current.name != name:
+                    if current is not None:
+                        put_chunk(current, None)
+                    current = Table(name, max_chunks)
+                    table_count += 1
+                    tables.put(current)
+                current.size += len(chunk)
+                put_chunk(current, chunk)
+            check_loaders()
+            progress.update()
+        if current is not None:
+            put_chunk(current, None)
+        if not loaders:
+            start_loaders()
+        for _ in loaders:
+            tables.put(None)
+        while any(loader.is_alive() for loader in loaders):
+            for loader in loaders:
+                loader.join(timeout=0.5)
+            check_loaders()
+            progress.update()
+        check_loaders()
+    except BaseException:
+        for loader in loaders:
+            loader.abort()
+        raise
+
+    if serial:
+        click.echo('\033[KRestoring views and routines...')
+        _run_serial(env, settings + b''.join(preamble + serial), command=command)
+    click.echo(
+        '\033[KRestored {0} table(s) in {1:.0f} sec'.format(
+            table_count,
+            time.monotonic() - progress.start_time,
+        ),
+    )
+
+
+def _run_serial(env, sql, command=None):
+    with tempfile.TemporaryFile() as stderr:
+        process = subprocess.Popen(
+            command or mysql_command(env),
+            stdin=subprocess.PIPE,
+            stderr=stderr,
+            env=mysql_env(env),
+        )
+        try:
+            process.communicate(sql + b'COMMIT;\n')
+        except BrokenPipeError:
+            process.wait()
+        if process.returncode:
+            stderr.seek(0)
+            raise RuntimeError(
+                'mysql failed, exit code {0}: {1}'.format(
+                    process.returncode,
+                    stderr.read().decode(errors='replace').strip(),
+                ),
+            )
@@ -0,0 +1,263 @@
+import os
+import subprocess
+import time
+from collections import OrderedDict
+
+import click
+
+from teamplify_runner.configurator import BASE_DIR
+
+
+WORKER_SERVICES = ('worker_slim', 'worker_fat', 'worker_fat_penalized')
+# Services that run the app image
+APP_SERVICES = ('app', 'app_replica') + WORKER_SERVICES + ('beat',)
+# Celery workers finish the tasks they are running after SIGTERM
+WORKER_STOP_TIMEOUT = 300
+WEB_STOP_TIMEOUT = 30
+# Containers without a healthcheck are ready when they run without restarts
+# for this number of seconds
+SETTLE_SECONDS = 15
+
+
+class RollingUpdateError(Exception):
+    pass
+
+
+def service_scale(env):
+    """
+    Returns the number of containers of the scaled services.
+    """
+    fat_count = int(env['WORKER_FAT_COUNT'])
+    worker_fat_penalized_count = 1 if fat_count > 0 else 0
+    return OrderedDict(
+        (
+            ('app_replica', int(env['WEB_COUNT']) - 1),
+            ('worker_slim', int(env['WORKER_SLIM_COUNT'])),
+            ('worker_fat_penalized', worker_fat_penalized_count),
+            ('worker_fat', fat_count - worker_fat_penalized_count),
+        )
+    )
+
+
+def scale_args(scale):
+    args = []
+    for service, count in scale.items():
+        args += ['--scale', '{0}={1}'.format(service, count)]
+    return args
+
+
+def nginx_service(env):
+    return 'nginx-ssl' if 'ssl' in env['COMPOSE_PROFILES'].split(',') else 'nginx'
+
+
+def _run(args, env=None, timeout=None):
+    try:
+        result = subprocess.run(
+            args,
+            cwd=BASE_DIR,
+            env={**os.environ, **env} if env else None,
+            stdin=subprocess.DEVNULL,
+            capture_output=True,
+            timeout=timeout,
+        )
+    except (OSError, subprocess.TimeoutExpired) as e:
+        raise RollingUpdateError('{0} failed: {1}'.format(' '.join(args), e))
+    if result.returncode:
+        raise RollingUpdateError(
+            '{0} failed: {1}'.format(
+                ' '.join(args),
+                result.stderr.decode(errors='replace').strip(),
+            )
+        )
+    return result.stdout.decode()
+
+
+def _compose(env, *args):
+    return _run(['docker', 'compose'] + list(args), env=env)
+
+
+def containers(env, service):
+    return _compose(env, 'ps', '--quiet', service).split()
+
+
+def inspect(ids):
+    """
+    Returns a list of (id, status, restarts, health) tuples.
+    """
+    output = _run(
+        [
+            'docker',
+            'inspect',
+            '--format',
+            '{{.Id}} {{.State.Status}} {{.RestartCount}} '
+            '{{if .State.Health}}{{.State.Health.Status}}{{end}}',
+        ]
+        + list(ids),
+        timeout=30,
+    )
+    states = []
+    for line in output.splitlines():
+        parts = line.split()
+        if parts:
+            states.append((parts[0], parts[1], int(parts[2]), parts[3] if len(parts) > 3 else ''))
+    return states
+
+
+def check_states(states, running_for):
+    """
+    Returns whether all containers are ready. Raises RollingUpdateError if any
+    of them failed.
+    """
+    ready = True
+    for container, status, restarts, health in states:
+        if status in ('exited', 'dead') or restarts or health == 'unhealthy':
+            raise RollingUpdateError(
+                'Container {0} failed to start: {1}'.format(
+                    container[:12],
+                    health if health == 'unhealthy' else status,
+                )
+            )
+        if health:
+            ready = ready and health == 'healthy'
+        else:
+            ready = ready and status == 'running' and running_for >= SETTLE_SECONDS
+    return ready
+
+
+def wait_ready(ids, timeout=600, interval=2, inspect=inspect):
+    start = time.monotonic()
+    while True:
+        running_for = time.monotonic() - start
+        if check_states(inspect(ids), running_for):
+            return
+        if running_for >= timeout:
+            raise RollingUpdateError(
+                "New containers didn't become healthy in {0} seconds".format(timeout),
+            )
+        time.sleep(interval)
+
+
+def _remove(ids, stop_timeout):
+    if ids:
+        _run(['docker', 'stop', '--time', str(stop_timeout)] + list(ids))
+        _run(['docker', 'rm', '--volumes'] + list(ids))
+
+
+class RollingUpdate:
+    """
+    Replaces the containers that run the app image one group at a time,
+    starting the new containers before the old ones are stopped. The DB,
+    Redis and SMTP keep running.
+    """
+
+    def __init__(self, env, old_image, batch_size=1, timeout=600):
+        self.env = env
+        self.old_image = old_image
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.scale = service_scale(env)
+        self.created = []
+
+    def _surge(self, service, count):
+        """
+        Starts count more containers of the service on the new image, leaving
+        the running ones as they are. Returns the new containers.
+        """
+        old = containers(self.env, service)
+        _compose(
+            self.env,
+            'up',
+            '--detach',
+            '--no-deps',
+            '--no-recreate',
+            '--scale',
+            '{0}={1}'.format(service, len(old) + count),
+            service,
+        )
+        new = [c for c in containers(self.env, service) if c not in old]
+        self.created += new
+        wait_ready(new, timeout=self.timeout)
+        return new
+
+    def _recreate(self, service):
+        # Anonymous volumes, such as the static files, come from the new image
+        _compose(
+            self.env,
+            'up',
+            '--detach',
+            '--no-deps',
+            '--force-recreate',
+            '--renew-anon-volumes',
+            service,
+        )
+        wait_ready(containers(self.env, service), timeout=self.timeout)
+
+    def update_web(self):
+        click.echo('Starting new web instances...')
+        old_replicas = containers(self.env, 'app_replica')
+        # At least one new replica serves the requests while the main app
+        # container restarts
+        self._surge('app_replica', max(self.scale['app_replica'], 1))
+        click.echo('Restarting the main web instance...')
+        self._recreate('app')
+        click.echo('Stopping old web instances...')
+        _remove(old_replicas, WEB_STOP_TIMEOUT)
+        # nginx serves the static files from the volumes of the app container
+        self._recreate(nginx_service(self.env))
+        extra = containers(self.env, 'app_replica')[self.scale['app_replica'] :]
+        _remove(extra, WEB_STOP_TIMEOUT)
+        self.created = [c for c in self.created if c not in extra]
+
+    def update_workers(self):
+        for service in WORKER_SERVICES:
+            old = containers(self.env, service)
+            if not old:
+                continue
+            click.echo('Replacing {0} ({1} container(s))...'.format(service, len(old)))
+            while old:
+                batch, old = old[: self.batch_size], old[self.batch_size :]
+                self._surge(service, len(batch))
+                _remove(batch, WORKER_STOP_TIMEOUT)
+        # Only one beat may run, or the periodic tasks would run twice
+        click.echo('Restarting beat...')
+        self._recreate('beat')
+
+    def rollback(self):
+        """
+        Restores the old image and brings all app services back to it.
+        """
+        click.echo(click.style('Rolling back to the previous version...', fg='yellow'))
+        if self.created:
+            _run(['docker', 'rm', '--force', '--volumes'] + self.created)
+        if self.old_image:
+            _run(['docker', 'tag', self.old_image, self.env['IMAGE_APP']])
+        else:
+            click.echo(
+                click.style(
+                    'The previous image is unknown, so the app stays on the new one',
+                    fg='yellow',
+                ),
+            )
+        _compose(
+            self.env,
+            'up',
+            '--detach',
+            '--no-deps',
+            '--renew-anon-volumes',
+            *scale_args(self.scale),
+            *APP_SERVICES,
+        )
+        _compose(
+            self.env, 'up', '--detach', '--no-deps', '--force-recreate', nginx_service(self.env)
+        )
+
+    def run(self):
+        try:
+            self.update_web()
+            self.update_workers()
+        except RollingUpdateError:
+            try:
+                self.rollback()
+            except RollingUpdateError as e:
+                click.echo(click.style(str(e), fg='red'), err=True)
+            raise
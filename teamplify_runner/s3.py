@@ -0,0 +1,375 @@
+import hashlib
+import hmac
+import io
+import threading
+import time
+import xml.etree.ElementTree as ET
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from urllib.parse import quote, urlparse
+
+from teamplify_runner.backup import decompressor
+
+
+MB = 1024 * 1024
+EMPTY_SHA256 = hashlib.sha256(b'').hexdigest()
+RETRIES = 3
+
+
+class S3Error(Exception):
+    pass
+
+
+def is_s3_url(location):
+    return bool(location) and location.startswith('s3://')
+
+
+def parse_s3_url(url):
+    """
+    Splits s3://bucket/key into the bucket and the key.
+    """
+    parsed = urlparse(url)
+    if parsed.scheme != 's3' or not parsed.netloc:
+        raise S3Error('Invalid S3 URL: {0}'.format(url))
+    return parsed.netloc, parsed.path.lstrip('/')
+
+
+def _hmac(key, msg):
+    return hmac.new(key, msg.encode(), hashlib.sha256).digest()
+
+
+class S3Client:
+    """
+    Minimal S3 client for multipart uploads and ranged downloads, signing
+    requests with AWS Signature Version 4. Works with AWS S3 and
+    S3-compatible storages, using path-style URLs.
+    """
+
+    def __init__(self, endpoint, access_key, secret_key, region='us-east-1', pool_size=10):
+        self.endpoint = endpoint.rstrip('/')
+        self.host = urlparse(self.endpoint).netloc
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        # requests takes a while to load, and the S3 URL helpers of this
+        # module are needed by the CLI before any backup starts
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    @classmethod
+    def from_env(cls, env, pool_size=10):
+        return cls(
+            endpoint=env['S3_ENDPOINT'],
+            access_key=env['S3_ACCESS_KEY'],
+            secret_key=env['S3_SECRET_KEY'],
+            region=env['S3_REGION'],
+            pool_size=pool_size,
+        )
+
+    @staticmethod
+    def _canonical_query(query):
+        return '&'.join(
+            '{0}={1}'.format(quote(k, safe='-_.~'), quote(str(v), safe='-_.~'))
+            for k, v in sorted(query.items())
+        )
+
+    def _sign(self, method, path, query, headers, payload_hash):
+        now = datetime.now(timezone.utc)
+        amz_date = now.strftime('%Y%m%dT%H%M%SZ')
+        date = now.strftime('%Y%m%d')
+        headers = {
+            **headers,
+            'host': self.host,
+            'x-amz-date': amz_date,
+            'x-amz-content-sha256': payload_hash,
+        }
+        canonical_headers = ''.join(
+            '{0}:{1}\n'.format(name.lower(), str(value).strip())
+            for name, value in sorted(headers.items(), key=lambda item: item[0].lower())
+        )
+        signed_headers = ';'.join(sorted(name.lower() for name in headers))
+        canonical_query = self._canonical_query(query)
+        canonical_request = '\n'.join(
+            (
+                method,
+                quote(path, safe='/-_.~'),
+                canonical_query,
+                canonical_headers,
+                signed_headers,
+                payload_hash,
+            )
+        )
+        scope = '{0}/{1}/s3/aws4_request'.format(date, self.region)
+        string_to_sign = '\n'.join(
+            (
+                'AWS4-HMAC-SHA256',
+                amz_date,
+                scope,
+                hashlib.sha256(canonical_request.encode()).hexdigest(),
+            )
+        )
+        key = _hmac(('AWS4' + self.secret_key).encode(), date)
+        key = _hmac(key, self.region)
+        key = _hmac(key, 's3')
+        key = _hmac(key, 'aws4_request')
+        signature = hmac.new(key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+        headers['Authorization'] = (
+            'AWS4-HMAC-SHA256 Credential={0}/{1}, SignedHeaders={2}, Signature={3}'.format(
+                self.access_key,
+                scope,
+                signed_headers,
+                signature,
+            )
+        )
+        del headers['host']
+        return headers
+
+    def request(self, method, bucket, key, query=None, headers=None, data=b'', expect=(200,)):
+        query = query or {}
+        path = '/{0}/{1}'.format(bucket, key)
+        # The query string is built by hand to match the signed one exactly
+        url = self.endpoint + quote(path, safe='/-_.~')
+        if query:
+            url += '?' + self._canonical_query(query)
+        import requests
+
+        payload_hash = hashlib.sha256(data).hexdigest() if data else EMPTY_SHA256
+        last_error = None
+        for attempt in range(RETRIES):
+            signed = self._sign(method, path, query, headers or {}, payload_hash)
+            try:
+                response = self.session.request(
+                    method,
+                    url,
+                    headers=signed,
+                    data=data,
+                    timeout=(10, 300),
+                )
+            except (requests.ConnectionError, requests.Timeout) as e:
+                last_error = str(e)
+            else:
+                if response.status_code in expect:
+                    return response
+                last_error = 'HTTP {0}: {1}'.format(response.status_code, response.text[:500])
+                if response.status_code < 500:
+                    break
+            time.sleep(2**attempt)
+        raise S3Error('S3 {0} {1} failed: {2}'.format(method, path, last_error))
+
+    def size(self, bucket, key):
+        response = self.request('HEAD', bucket, key)
+        return int(response.headers['Content-Length'])
+
+    def get_range(self, bucket, key, start, end):
+        response = self.request(
+            'GET',
+            bucket,
+            key,
+            headers={'Range': 'bytes={0}-{1}'.format(start, end)},
+            expect=(200, 206),
+        )
+        return response.content
+
+
+def _find(element, name):
+    for child in element.iter():
+        if child.tag == name or child.tag.endswith('}' + name):
+            return child.text
+    return None
+
+
+class MultipartUpload:
+    """
+    File-like object that uploads the data written to it as an S3 multipart
+    upload. Parts are uploaded concurrently, and the number of parts held in
+    memory is bounded, so memory usage is about part_size * (concurrency + 1).
+    """
+
+    def __init__(self, client, bucket, key, part_size=16 * MB, concurrency=4):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.buffer = bytearray()
+        self.parts = []
+        self.pending = deque()
+        self.slots = threading.BoundedSemaphore(concurrency)
+        self.executor = ThreadPoolExecutor(concurrency)
+        self.size = 0
+        response = client.request('POST', bucket, key, query={'uploads': ''})
+        self.upload_id = _find(ET.fromstring(response.content), 'UploadId')
+        if not self.upload_id:
+            raise S3Error('S3 did not return an upload ID')
+
+    def _upload_part(self, number, data):
+        try:
+            response = self.client.request(
+                'PUT',
+                self.bucket,
+                self.key,
+                query={'partNumber': number, 'uploadId': self.upload_id},
+                data=data,
+            )
+            return number, response.headers['ETag']
+        finally:
+            self.slots.release()
+
+    def _submit(self, data):
+        # Blocks while all upload slots are busy, which bounds memory usage
+        self.slots.acquire()
+        number = len(self.pending) + len(self.parts) + 1
+        self.pending.append(self.executor.submit(self._upload_part, number, data))
+        self._collect()
+
+    def _collect(self, wait=False):
+        while self.pending and (wait or self.pending[0].done()):
+            self.parts.append(self.pending.popleft().result())
+
+    def write(self, data):
+        self.buffer += data
+        self.size += len(data)
+        while len(self.buffer) >= self.part_size:
+            self._submit(bytes(self.buffer[: self.part_size]))
+            del self.buffer[: self.part_size]
+
+    def close(self):
+        try:
+            if self.buffer or not (self.parts or self.pending):
+                self._submit(bytes(self.buffer))
+                self.buffer.clear()
+            self._collect(wait=True)
+        except BaseException:
+            self.abort()
+            raise
+        finally:
+            self.executor.shutdown()
+        body = ''.join(
+            '<Part><PartNumber>{0}</PartNumber><ETag>{1}</ETag></Part>'.format(number, etag)
+            for number, etag in sorted(self.parts)
+        )
+        response = self.client.request(
+            'POST',
+            self.bucket,
+            self.key,
+            query={'uploadId': self.upload_id},
+            data='<CompleteMultipartUpload>{0}</CompleteMultipartUpload>'.format(body).encode(),
+        )
+        # S3 may report an error with the 200 status once the response has
+        # started, so the body has to be checked as well
+        if b'<Error>' in response.content:
+            self.abort()
+            raise S3Error(
+                'S3 failed to complete the upload: {0}'.format(
+                    _find(ET.fromstring(response.content), 'Message'),
+                ),
+            )
+
+    def abort(self):
+        self.executor.shutdown(cancel_futures=True)
+        try:
+            self.client.request(
+                'DELETE',
+                self.bucket,
+                self.key,
+                query={'uploadId': self.upload_id},
+                expect=(200, 204),
+            )
+        except S3Error:
+            pass
+
+
+class RangedReader(io.RawIOBase):
+    """
+    Downloads an S3 object as a stream of ranges fetched in parallel, keeping
+    a bounded number of ranges in memory.
+    """
+
+    def __init__(self, client, bucket, key, size, part_size=16 * MB, concurrency=4):
+        super().__init__()
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.ranges = deque(
+            (start, min(start + part_size, size) - 1) for start in range(0, size, part_size)
+        )
+        self.concurrency = concurrency
+        self.executor = ThreadPoolExecutor(concurrency)
+        self.pending = deque()
+        self.current = b''
+        self.offset = 0
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def _fill(self):
+        while self.ranges and len(self.pending) < self.concurrency:
+            start, end = self.ranges.popleft()
+            self.pending.append(
+                self.executor.submit(self.client.get_range, self.bucket, self.key, start, end),
+            )
+
+    def readinto(self, buffer):
+        if self.offset >= len(self.current):
+            self._fill()
+            if not self.pending:
+                return 0
+            self.current = self.pending.popleft().result()
+            self.offset = 0
+            self._fill()
+        size = min(len(buffer), len(self.current) - self.offset)
+        buffer[:size] = self.current[self.offset : self.offset + size]
+        self.offset += size
+        self.position += size
+        return size
+
+    def close(self):
+        self.executor.shutdown(cancel_futures=True)
+        super().close()
+
+
+class S3Source:
+    """
+    Decompressed contents of a backup archive in S3, with the same interface
+    as ArchiveSource.
+    """
+
+    def __init__(self, client, url, part_size=16 * MB, concurrency=4):
+        bucket, key = parse_s3_url(url)
+        self.name = key.rsplit('/', 1)[-1]
+        self.size = client.size(bucket, key)
+        self.reader = RangedReader(
+            client,
+            bucket,
+            key,
+            self.size,
+            part_size=part_size,
+            concurrency=concurrency,
+        )
+        self.file = io.BufferedReader(self.reader, MB)
+        try:
+            self.stream = decompressor(self.file)
+        except BaseException:
+            self.file.close()
+            raise
+
+    def position(self):
+        return self.reader.position
+
+    def close(self):
+        try:
+            self.stream.close()
+        finally:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,166 @@
+import contextlib
+import fcntl
+import os
+import re
+import shutil
+import subprocess
+import time
+from datetime import datetime
+
+import click
+
+from teamplify_runner.binlog import BinlogError, read_manifest
+
+
+LOCK_FILENAME = '.backup.lock'
+TIME_FORMAT = '%Y-%m-%d_%H-%M-%S'
+
+
+class SchedulerError(Exception):
+    pass
+
+
+def lower_priority():
+    """
+    Moves the current process to the lowest CPU priority and to the idle I/O
+    class, so that the backup only uses the resources the app doesn't need.
+    Threads started after this call inherit the priorities.
+    """
+    try:
+        os.setpriority(os.PRIO_PROCESS, 0, 19)
+    except (AttributeError, OSError):
+        pass
+    if shutil.which('ionice'):
+        subprocess.run(
+            ['ionice', '-c', '3', '-p', str(os.getpid())],
+            stdin=subprocess.DEVNULL,
+            capture_output=True,
+        )
+
+
+@contextlib.contextmanager
+def backup_lock(directory):
+    """
+    Makes sure that only one backup to the directory runs at a time.
+    """
+    path = os.path.join(directory, LOCK_FILENAME)
+    try:
+        f = open(path, 'w')
+    except OSError as e:
+        raise SchedulerError('Could not create the backup lock {0}: {1}'.format(path, e.strerror))
+    with f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise SchedulerError('Another backup is already in progress')
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+@contextlib.contextmanager
+def backup_locks(*directories):
+    """
+    Takes the backup locks of all directories, each one once.
+    """
+    with contextlib.ExitStack() as stack:
+        for directory in sorted({os.path.realpath(d) for d in directories}):
+            stack.enter_context(backup_lock(directory))
+        yield
+
+
+def wait_for_low_load(max_load, max_wait, check_interval=60):
+    """
+    Waits up to max_wait seconds for the 1-minute load average to drop below
+    max_load. Returns False if it didn't.
+    """
+    deadline = time.monotonic() + max_wait
+    while True:
+        load = os.getloadavg()[0]
+        if load < max_load:
+            return True
+        if time.monotonic() >= deadline:
+            return False
+        click.echo('Load average is {0:.2f}, waiting for it to drop...'.format(load))
+        time.sleep(check_interval)
+
+
+def gfs_retention(times, daily=7, weekly=4, monthly=12):
+    """
+    Grandfather-father-son retention: keeps the newest backup of each of the
+    last `daily` days, `weekly` ISO weeks and `monthly` months that have
+    backups. The newest backup is always kept. Returns the set of times to
+    keep.
+    """
+    ordered = sorted(times, reverse=True)
+    keep = set(ordered[:1])
+    periods = (
+        (daily, lambda t: t.date()),
+        (weekly, lambda t: t.isocalendar()[:2]),
+        (monthly, lambda t: (t.year, t.month)),
+    )
+    for count, period in periods:
+        seen = set()
+        for t in ordered:
+            if period(t) in seen:
+                continue
+            if len(seen) == count:
+                break
+            seen.add(period(t))
+            keep.add(t)
+    return keep
+
+
+def backup_files(directory, db_name):
+    """
+    Returns the full and incremental backups in the directory, as lists of
+    (time, filename) tuples.
+    """
+    pattern = re.compile(
+        r'^{0}_(\d{{4}}-\d\d-\d\d_\d\d-\d\d-\d\d)(\.sql|\.binlog\.tar)(\.gz|\.zst)$'.format(
+            re.escape(db_name),
+        ),
+    )
+    full, incremental = [], []
+    for entry in os.scandir(directory):
+        match = pattern.match(entry.name)
+        if match and entry.is_file():
+            t = datetime.strptime(match.group(1), TIME_FORMAT)
+            if match.group(2) == '.sql':
+                full.append((t, entry.name))
+            else:
+                incremental.append((t, entry.name))
+    return full, incremental
+
+
+def incremental_base(directory, name):
+    """
+    Returns the name of the full backup that the incremental backup is
+    based on, or None if its manifest can't be read.
+    """
+    try:
+        return read_manifest(os.path.join(directory, name))['base']
+    except (OSError, EOFError, RuntimeError, BinlogError, KeyError, TypeError, ValueError):
+        return None
+
+
+def apply_retention(directory, db_name, daily=7, weekly=4, monthly=12):
+    """
+    Removes the full backups not kept by the GFS policy, and the incremental
+    backups older than the oldest full backup it keeps. A full backup that a
+    remaining incremental backup is based on is kept as well, so that the
+    incremental backup can still be restored. Returns the names of the
+    removed files.
+    """
+    full, incremental = backup_files(directory, db_name)
+    if not full:
+        return []
+    keep = gfs_retention([t for t, _ in full], daily, weekly, monthly)
+    oldest = min(keep)
+    removed = [name for t, name in incremental if t < oldest]
+    bases = {incremental_base(directory, name) for t, name in incremental if t >= oldest}
+    removed += [name for t, name in full if t not in keep and name not in bases]
+    for name in removed:
+        os.remove(os.path.join(directory, name))
+    return sorted(removed)
@@ -0,0 +1,137 @@
+import socket
+import ssl
+import statistics
+import time
+from collections import namedtuple
+from urllib.parse import urlsplit
+
+
+class TLSCheckError(Exception):
+    pass
+
+
+Measurement = namedtuple('Measurement', ('connect', 'handshake', 'ttfb', 'resumed'))
+Negotiated = namedtuple('Negotiated', ('version', 'cipher', 'protocol', 'key'))
+
+
+def _context(verify, protocols=('http/1.1',)):
+    context = ssl.create_default_context()
+    if not verify:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    context.set_alpn_protocols(list(protocols))
+    return context
+
+
+def _target(url):
+    parts = urlsplit(url)
+    if parts.scheme != 'https':
+        raise TLSCheckError('Not an HTTPS URL: {0}'.format(url))
+    return parts.hostname, parts.port or 443, parts.path or '/'
+
+
+def negotiated(url, verify=True, timeout=10):
+    """
+    Returns what the server negotiates with a client that supports HTTP/2.
+    """
+    host, port, _ = _target(url)
+    context = _context(verify, protocols=('h2', 'http/1.1'))
+    try:
+        with socket.create_connection((host, port), timeout=timeout) as sock:
+            with context.wrap_socket(sock, server_hostname=host) as tls:
+                cipher = tls.cipher()
+                certificate = tls.getpeercert(binary_form=True) or b''
+                return Negotiated(
+                    version=tls.version(),
+                    cipher=cipher[0] if cipher else '',
+                    protocol=tls.selected_alpn_protocol() or 'http/1.1',
+                    key=_key_type(certificate),
+                )
+    except (OSError, ssl.SSLError) as e:
+        raise TLSCheckError('Failed to connect to {0}: {1}'.format(url, e))
+
+
+def _key_type(certificate):
+    # The key algorithm OIDs in DER, good enough to tell ECDSA from RSA
+    # without parsing the certificate
+    if b'\x2a\x86\x48\xce\x3d\x02\x01' in certificate:
+        return 'ECDSA'
+    if b'\x2a\x86\x48\x86\xf7\x0d\x01\x01\x01' in certificate:
+        return 'RSA'
+    return 'unknown'
+
+
+def measure(url, context, session=None, timeout=10):
+    """
+    Makes one request over a new connection. Returns the Measurement and the
+    TLS session to resume the next connection with. Times are in seconds from
+    the start of the connection.
+    """
+    host, port, path = _target(url)
+    start = time.perf_counter()
+    try:
+        with socket.create_connection((host, port), timeout=timeout) as sock:
+            connected = time.perf_counter()
+            with context.wrap_socket(sock, server_hostname=host, session=session) as tls:
+                handshake = time.perf_counter()
+                tls.sendall(
+                    'GET {0} HTTP/1.1\r\nHost: {1}\r\nConnection: close\r\n\r\n'.format(
+                        path, host
+                    ).encode()
+                )
+                if not tls.recv(1):
+                    raise TLSCheckError('The server closed the connection')
+                first_byte = time.perf_counter()
+                # TLS 1.3 sends the session tickets after the handshake, so
+                # read the response to get them
+                while tls.recv(64 * 1024):
+                    pass
+                resumed = tls.session_reused
+                session = tls.session
+    except (OSError, ssl.SSLError) as e:
+        raise TLSCheckError('Failed to connect to {0}: {1}'.format(url, e))
+    return (
+        Measurement(
+            connect=connected - start,
+            handshake=handshake - start,
+            ttfb=first_byte - start,
+            resumed=resumed,
+        ),
+        session,
+    )
+
+
+def tls_check(url, count=10, verify=True, timeout=10):
+    """
+    Makes count requests over new connections, resuming the TLS session of
+    the previous one. The first connection makes the full handshake.
+    """
+    context = _context(verify)
+    session = None
+    results = []
+    for _ in range(count):
+        measurement, session = measure(url, context, session=session, timeout=timeout)
+        results.append(measurement)
+    return results
+
+
+def summarize(results):
+    """
+    Returns an ordered list of (name, milliseconds) for the full and the
+    resumed handshakes, and the median time to first byte.
+    """
+    full, resumed = results[0], [m for m in results[1:] if m.resumed]
+    summary = [
+        ('TCP connect', full.connect * 1000),
+        ('Full TLS handshake', full.handshake * 1000),
+        ('Time to first byte, new session', full.ttfb * 1000),
+    ]
+    if resumed:
+        summary += [
+            ('Resumed TLS handshake', statistics.median(m.handshake for m in resumed) * 1000),
+            (
+                'Time to first byte, resumed session',
+                statistics.median(m.ttfb for m in resumed) * 1000,
+            ),
+        ]
+    return summary
@@ -0,0 +1,138 @@
+import math
+import os
+import shutil
+import subprocess
+from collections import OrderedDict, namedtuple
+
+
+MB = 1024 * 1024
+GB = 1024 * MB
+# Approximate memory used by one app or worker container
+CONTAINER_MEMORY = 512 * MB
+# Approximate number of DB connections opened by one app or worker container
+CONTAINER_CONNECTIONS = 10
+# Connections for backups, restores and admin sessions
+SPARE_CONNECTIONS = 20
+# Memory left for the OS, nginx, SMTP and the page cache
+RESERVED_MEMORY = 1 * GB
+# InnoDB allocates the buffer pool in chunks of this size
+BUFFER_POOL_CHUNK = 128 * MB
+LOW_DISK_SPACE = 10 * GB
+
+HostResources = namedtuple('HostResources', ('cpus', 'memory', 'rotational', 'disk_free'))
+
+
+def _clamp(value, low, high):
+    return max(low, min(value, high))
+
+
+def _docker_resources():
+    """
+    Returns CPUs, memory and the data directory of Docker. Docker runs in a
+    VM on Mac OS X, so its resources may differ from the host resources.
+    """
+    try:
+        result = subprocess.run(
+            ['docker', 'info', '--format', '{{.NCPU}} {{.MemTotal}} {{.DockerRootDir}}'],
+            stdin=subprocess.DEVNULL,
+            capture_output=True,
+            timeout=10,
+        )
+        cpus, memory, root_dir = result.stdout.decode().split(maxsplit=2)
+        return int(cpus), int(memory), root_dir.strip()
+    except (OSError, ValueError, subprocess.TimeoutExpired):
+        return None
+
+
+def is_rotational(path):
+    """
+    Returns whether the disk that holds the path is a spinning disk, or None
+    if unknown.
+    """
+    try:
+        device = os.stat(path).st_dev
+        block = os.path.realpath(
+            '/sys/dev/block/{0}:{1}'.format(os.major(device), os.minor(device)),
+        )
+        for directory in (block, os.path.dirname(block)):
+            flag = os.path.join(directory, 'queue', 'rotational')
+            if os.path.exists(flag):
+                with open(flag) as f:
+                    return f.read().strip() == '1'
+    except OSError:
+        pass
+    return None
+
+
+def detect_host():
+    resources = _docker_resources()
+    if resources:
+        cpus, memory, data_path = resources
+    else:
+        cpus = os.cpu_count() or 1
+        memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+        data_path = '/'
+    if not os.path.isdir(data_path):
+        # Docker data is in a VM, only the local disk can be checked
+        data_path = '/'
+    return HostResources(
+        cpus=cpus,
+        memory=memory,
+        rotational=is_rotational(data_path),
+        disk_free=shutil.disk_usage(data_path).free,
+    )
+
+
+def propose(host):
+    """
+    Proposes configuration values for the host. Returns an OrderedDict of
+    {(section, option): value}.
+    """
+    web = _clamp(math.ceil(host.cpus / 2), 1, 8)
+    slim = _clamp(host.cpus // 4, 1, 4)
+    # Fat workers mostly wait for the network, so there may be more of them
+    # than CPUs
+    fat = _clamp(host.cpus, 2, 16)
+    redis = _clamp(host.memory // 20, 128 * MB, 2 * GB)
+
+    def free_memory():
+        # One more container for beat
+        containers = web + slim + fat + 1
+        return host.memory - RESERVED_MEMORY - redis - containers * CONTAINER_MEMORY
+
+    # Give up some of the processes on hosts with little memory, leaving at
+    # least 256 MB for the DB
+    while free_memory() < 2 * BUFFER_POOL_CHUNK and (fat > 2 or web > 1):
+        if fat > 2:
+            fat -= 1
+        else:
+            web -= 1
+    buffer_pool = min(free_memory() * 3 // 4, host.memory // 2)
+    buffer_pool = max(buffer_pool // BUFFER_POOL_CHUNK, 1) * BUFFER_POOL_CHUNK
+    connections = (web + slim + fat + 1) * CONTAINER_CONNECTIONS + SPARE_CONNECTIONS
+    proposal = OrderedDict(
+        (
+            (('web', 'count'), web),
+            (('worker', 'slim_count'), slim),
+            (('worker', 'fat_count'), fat),
+            (('db', 'innodb_buffer_pool_size'), buffer_pool // MB),
+            (('db', 'max_connections'), max(connections, 151)),
+            (('redis', 'maxmemory'), redis // MB),
+        )
+    )
+    if host.rotational is not None:
+        proposal[('db', 'innodb_io_capacity')] = 200 if host.rotational else 2000
+    return proposal
+
+
+def config_diff(parser, proposal):
+    """
+    Returns a list of (section, option, current, proposed) tuples for the
+    values that differ from the current configuration.
+    """
+    diff = []
+    for (section, option), value in proposal.items():
+        current = parser.get(section, option, fallback='')
+        if current != str(value):
+            diff.append((section, option, current, str(value)))
+    return diff
@@ -1,12 +1,28 @@
 import contextlib
 import ipaddress
 import os
+import queue
 import random
+import shlex
+import signal
 import string
+import subprocess
+import threading
+import time
 import traceback
+from collections import deque
 
 import click
-import sarge
+
+
+# Longer lines are split, so that a command that never prints a newline
+# can't grow a single line without bound
+MAX_LINE = 64 * 1024
+# How many bytes of output run() keeps in memory. The oldest lines are
+# dropped when it's exceeded
+MAX_CAPTURE = 16 * 1024 * 1024
+# How long a command may take to exit after SIGTERM before it's killed
+KILL_GRACE = 5
 
 
 @contextlib.contextmanager
@@ -19,6 +35,144 @@ def cd(path):
         os.chdir(cwd)
 
 
+class CommandTimeout(RuntimeError):
+    pass
+
+
+class Command:
+    """
+    Runs a command in its own process group and yields its output line by
+    line as (stream name, line) tuples. The lines pass from the reader
+    threads through a bounded queue, so if the consumer falls behind, the
+    readers stop reading and the command blocks on a full pipe instead of
+    its output piling up in memory.
+
+    If the command doesn't finish within the timeout, the whole process
+    group is killed and CommandTimeout is raised.
+    """
+
+    def __init__(self, cmd, timeout=None, capture=True, env=None, queue_size=1000, **kwargs):
+        self.args = shlex.split(cmd) if isinstance(cmd, str) else list(cmd)
+        self.timeout = timeout
+        self.deadline = time.monotonic() + timeout if timeout else None
+        if capture:
+            kwargs['stdout'] = subprocess.PIPE
+            kwargs['stderr'] = subprocess.PIPE
+        self.process = subprocess.Popen(
+            self.args,
+            env={**os.environ, **env} if env else None,
+            start_new_session=True,
+            **kwargs,
+        )
+        self.lines = queue.Queue(queue_size)
+        self.readers = []
+        if capture:
+            for name, pipe in (('stdout', self.process.stdout), ('stderr', self.process.stderr)):
+                reader = threading.Thread(target=self._read, args=(name, pipe), daemon=True)
+                reader.start()
+                self.readers.append(reader)
+
+    def _read(self, name, pipe):
+        with pipe:
+            for line in iter(lambda: pipe.readline(MAX_LINE), b''):
+                self.lines.put((name, line))
+        self.lines.put((name, None))
+
+    def _remaining(self):
+        if self.deadline is None:
+            return None
+        return max(self.deadline - time.monotonic(), 0)
+
+    def _timed_out(self):
+        self.kill()
+        return CommandTimeout(
+            'Command timed out after {0} seconds: {1}'.format(self.timeout, self.args[0]),
+        )
+
+    def __iter__(self):
+        open_streams = len(self.readers)
+        while open_streams:
+            try:
+                name, line = self.lines.get(timeout=self._remaining())
+            except queue.Empty:
+                raise self._timed_out()
+            if line is None:
+                open_streams -= 1
+                continue
+            yield name, line.decode(errors='replace').rstrip('\r\n')
+
+    def wait(self):
+        """
+        Waits for the command to exit and returns its exit code.
+        """
+        try:
+            return self.process.wait(timeout=self._remaining())
+        except subprocess.TimeoutExpired:
+            raise self._timed_out()
+
+    def kill(self):
+        """
+        Stops the process group, first with SIGTERM and then with SIGKILL.
+        """
+        if self.process.poll() is not None:
+            return
+        try:
+            os.killpg(self.process.pid, signal.SIGTERM)
+            try:
+                self.process.wait(timeout=KILL_GRACE)
+                return
+            except subprocess.TimeoutExpired:
+                pass
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        self.process.wait()
+
+    def close(self):
+        # The command runs in its own process group, so Ctrl+C doesn't reach
+        # it. Make sure it doesn't outlive the CLI when something goes wrong
+        self.kill()
+        # Unblock the readers waiting on the full queue
+        while any(reader.is_alive() for reader in self.readers):
+            try:
+                self.lines.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class OutputBuffer:
+    """
+    Keeps the last lines of the output, up to max_bytes in total.
+    """
+
+    def __init__(self, max_bytes=MAX_CAPTURE):
+        self.max_bytes = max_bytes
+        self.lines = deque()
+        self.size = 0
+        self.truncated = False
+
+    def append(self, line):
+        self.lines.append(line)
+        self.size += len(line) + 1
+        while self.size > self.max_bytes and len(self.lines) > 1:
+            self.size -= len(self.lines.popleft()) + 1
+            self.truncated = True
+
+
+class CommandResult:
+    def __init__(self, returncode, stdout, stderr):
+        self.returncode = returncode
+        self.stdout_lines = list(stdout.lines)
+        self.stderr_lines = list(stderr.lines)
+        self.truncated = stdout.truncated or stderr.truncated
+
+
 def run(
     cmd,
     raise_on_error=True,
@@ -26,43 +180,44 @@ def run(
     suppress_output=False,
     exit_on_error=True,
     skip_error_codes=None,
+    timeout=None,
+    max_capture=MAX_CAPTURE,
     **kwargs,
 ):
     """
-    Wrapper around sarge.run that can raise errors and capture stdout.
+    Runs a command, printing its output as it comes unless it's suppressed.
+    Can raise errors and capture stdout, keeping at most max_capture bytes
+    of each stream.
     """
-
-    def echo_output(stdout, stderr):
-        if stdout:
-            click.echo(stdout)
-        if stderr:
-            click.echo(stderr, err=True)
-
-    if capture_output:
-        kwargs['stdout'] = sarge.Capture()
-        kwargs['stderr'] = sarge.Capture()
-    result = sarge.run(cmd, **kwargs)
-    code = result.returncode
+    stdout = OutputBuffer(max_capture)
+    stderr = OutputBuffer(max_capture)
+    error = None
+    with Command(cmd, timeout=timeout, capture=capture_output, **kwargs) as command:
+        try:
+            for name, line in command:
+                (stdout if name == 'stdout' else stderr).append(line)
+                if not suppress_output:
+                    click.echo(line, err=name == 'stderr')
+            code = command.wait()
+        except CommandTimeout as e:
+            code, error = None, str(e)
     skip_error_codes = skip_error_codes or []
-    if code and code not in skip_error_codes and raise_on_error:
-        if capture_output:
-            echo_output(result.stdout.read(), result.stderr.read())
+    failed = error or (code and code not in skip_error_codes)
+    if failed and raise_on_error:
+        if suppress_output:
+            for line in stdout.lines:
+                click.echo(line)
+            for line in stderr.lines:
+                click.echo(line, err=True)
         # print two last traceback records: current line and run caller
         traceback.print_stack(limit=2)
-        msg = 'Command failed, exit code {0}'.format(code)
+        msg = error or 'Command failed, exit code {0}'.format(code)
         if exit_on_error:
             click.echo(msg)
             exit(1)
         else:
             raise RuntimeError(msg)
-    if capture_output:
-        stdout = result.stdout.read()
-        result.stdout_lines = stdout.decode().split('\n')
-        if result.stdout_lines[-1] == '':
-            result.stdout_lines = result.stdout_lines[:-1]
-        if not suppress_output:
-            echo_output(stdout, result.stderr.read())
-    return result
+    return CommandResult(code, stdout, stderr)
 
 
 def compose(cmd, **kwargs):
@@ -0,0 +1,10 @@
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def cache_home(monkeypatch, tmp_path_factory):
+    # Keep the caches of the tests, such as the resolved hostnames, out of
+    # the cache directory of the user
+    path = tmp_path_factory.mktemp('cache')
+    monkeypatch.setenv('XDG_CACHE_HOME', str(path))
+    return path
@@ -0,0 +1,30 @@
+import os
+import subprocess
+import sys
+
+from teamplify_runner.assets import PRECOMPRESS_SCRIPT
+
+
+def _precompress(root):
+    result = subprocess.run(
+        [sys.executable, '-'],
+        input=PRECOMPRESS_SCRIPT.replace("'/static'", repr(str(root))).encode(),
+        capture_output=True,
+        check=True,
+    )
+    return int(result.stdout)
+
+
+def test_precompress_script(tmp_path):
+    (tmp_path / 'css').mkdir()
+    (tmp_path / 'css' / 'app.0123456789ab.css').write_text('body { color: red; }\n' * 100)
+    (tmp_path / 'tiny.js').write_text('x')
+    (tmp_path / 'logo.png').write_bytes(b'\x89PNG' * 1000)
+    assert _precompress(tmp_path) == 1
+    assert os.path.exists(tmp_path / 'css' / 'app.0123456789ab.css.gz')
+    assert not os.path.exists(tmp_path / 'tiny.js.gz')
+    assert not os.path.exists(tmp_path / 'logo.png.gz')
+    assert _precompress(tmp_path) == 0
+    (tmp_path / 'css' / 'app.0123456789ab.css').write_text('body { color: blue; }\n' * 100)
+    os.utime(tmp_path / 'css' / 'app.0123456789ab.css', (1, 1))
+    assert _precompress(tmp_path) == 1
@@ -0,0 +1,175 @@
+import json
+import sys
+import time
+
+import pytest
+
+from teamplify_runner.autoscale import (
+    AutoscaleError,
+    Autoscaler,
+    Compose,
+    WorkerGroup,
+    queue_lengths,
+    step,
+    worker_groups,
+)
+from teamplify_runner.configurator import Configurator
+
+
+# Answers LLEN commands from a JSON file, like redis-cli reading stdin
+FAKE_REDIS_CLI = """
+import json, sys
+queues = json.load(open(sys.argv[1]))
+for line in sys.stdin:
+    command, queue = line.split()
+    assert command == 'LLEN'
+    print(queues.get(queue, 0))
+"""
+
+# Keeps the number of containers of each service in a JSON file
+FAKE_COMPOSE = """
+import json, sys, time
+path, args = sys.argv[1], sys.argv[2:]
+state = json.load(open(path))
+if args[0] == 'ps':
+    for i in range(state.get(args[-1], 0)):
+        print('{0}-{1}'.format(args[-1], i))
+elif args[0] == 'up':
+    # Like stopping workers that finish their tasks
+    time.sleep(state.get('delay', 0))
+    if state.get('fail'):
+        sys.exit('no such service')
+    service, count = args[args.index('--scale') + 1].split('=')
+    state[service] = int(count)
+    state.setdefault('calls', []).append(args)
+    json.dump(state, open(path, 'w'))
+"""
+
+
+def _script(tmp_path, name, source):
+    path = tmp_path / name
+    path.write_text(source)
+    return [sys.executable, str(path)]
+
+
+def test_queue_lengths(tmp_path):
+    queues = tmp_path / 'queues.json'
+    queues.write_text(json.dumps({'celery': 12, 'sync': 40}))
+    command = _script(tmp_path, 'redis_cli.py', FAKE_REDIS_CLI) + [str(queues)]
+    assert queue_lengths(('celery', 'sync', 'empty'), command) == {
+        'celery': 12,
+        'sync': 40,
+        'empty': 0,
+    }
+    with pytest.raises(AutoscaleError):
+        queue_lengths(('celery',), [sys.executable, '-c', 'import sys; sys.exit(1)'])
+
+
+def test_worker_groups():
+    env = Configurator().env()
+    groups = worker_groups(env, None, 8, (), ('sync',))
+    assert groups == [WorkerGroup('fat', 'worker_fat', 3, 8, ('sync',), 1)]
+    with pytest.raises(AutoscaleError):
+        worker_groups(env, None, 2, (), ('sync',))
+
+
+def test_autoscaler_hysteresis():
+    group = WorkerGroup('slim', 'worker_slim', 1, 5, ('celery',), 0)
+    autoscaler = Autoscaler(group, tasks_per_worker=10, up_cooldown=60, down_cooldown=300)
+    assert autoscaler.decide(1, 5, now=0) == (1, None)
+    # Capped by the maximum
+    assert autoscaler.decide(1, 100, now=0)[0] == 5
+    autoscaler.changed(0)
+    assert autoscaler.decide(5, 45, now=10) == (5, None)
+    # Backlog is low, but not for long enough
+    assert autoscaler.decide(5, 10, now=20) == (5, None)
+    # A burst resets the low backlog period
+    assert autoscaler.decide(5, 30, now=200) == (5, None)
+    assert autoscaler.decide(5, 10, now=210) == (5, None)
+    assert autoscaler.decide(5, 10, now=500) == (5, None)
+    assert autoscaler.decide(5, 10, now=510) == (4, 'backlog stayed low')
+    autoscaler.changed(510)
+    # Adding workers waits for the cooldown and for the host load
+    assert autoscaler.decide(4, 50, now=520)[0] == 4
+    assert autoscaler.decide(4, 50, now=600, overloaded=True)[0] == 4
+    assert autoscaler.decide(4, 50, now=600) == (5, 'backlog needs 5 worker(s)')
+
+
+def test_step_scales_with_compose(tmp_path):
+    state = tmp_path / 'state.json'
+    state.write_text(json.dumps({'worker_fat': 2, 'worker_slim': 1}))
+    compose = Compose({}, command=_script(tmp_path, 'compose.py', FAKE_COMPOSE) + [str(state)])
+    autoscalers = [
+        Autoscaler(WorkerGroup('slim', 'worker_slim', 1, 3, ('celery',), 0)),
+        Autoscaler(WorkerGroup('fat', 'worker_fat', 3, 8, ('sync', 'sync_penalized'), 1)),
+    ]
+    decisions = step(autoscalers, compose, {'celery': 2, 'sync': 40, 'sync_penalized': 20}, now=0)
+    assert decisions == [('fat', 60, 3, 6, 'backlog needs 6 worker(s)')]
+    compose.wait()
+    result = json.loads(state.read_text())
+    assert result['worker_fat'] == 5
+    assert result['worker_slim'] == 1
+    assert '--timeout' in result['calls'][0]
+
+
+class BrokenCompose:
+    """
+    Fails to count the fat workers and to scale the slim ones.
+    """
+
+    def __init__(self):
+        self.scaled = []
+
+    def busy(self, service):
+        return False
+
+    def count(self, service):
+        if service == 'worker_fat':
+            raise AutoscaleError('docker compose ps failed')
+        return 1
+
+    def scale(self, service, count):
+        if service == 'worker_slim':
+            raise AutoscaleError('docker compose up failed')
+        self.scaled.append((service, count))
+
+
+def test_step_continues_after_errors():
+    autoscalers = [
+        Autoscaler(WorkerGroup(name, service, 1, 5, (queue,), 0), 10, 0, 0)
+        for name, service, queue in (
+            ('fat', 'worker_fat', 'sync'),
+            ('slim', 'worker_slim', 'celery'),
+            ('other', 'worker_other', 'other'),
+        )
+    ]
+    compose = BrokenCompose()
+    lengths = {'sync': 30, 'celery': 30, 'other': 30}
+    decisions = step(autoscalers, compose, lengths, now=0)
+    assert decisions == [
+        ('fat', 30, None, None, 'failed: docker compose ps failed'),
+        ('slim', 30, 1, 1, 'failed: docker compose up failed'),
+        ('other', 30, 1, 3, 'backlog needs 3 worker(s)'),
+    ]
+    assert compose.scaled == [('worker_other', 3)]
+
+
+def test_step_does_not_wait_for_scaling(tmp_path):
+    state = tmp_path / 'state.json'
+    state.write_text(json.dumps({'worker_slim': 1, 'delay': 2}))
+    compose = Compose({}, command=_script(tmp_path, 'compose.py', FAKE_COMPOSE) + [str(state)])
+    autoscalers = [Autoscaler(WorkerGroup('slim', 'worker_slim', 1, 3, ('celery',), 0))]
+    start = time.monotonic()
+    assert step(autoscalers, compose, {'celery': 30}, now=0)[0][3] == 3
+    assert time.monotonic() - start < 1.5
+    # No decisions for the group until the scaling is done
+    assert compose.busy('worker_slim')
+    assert step(autoscalers, compose, {'celery': 0}, now=1000) == []
+    compose.wait()
+    assert json.loads(state.read_text())['worker_slim'] == 3
+
+    state.write_text(json.dumps({'worker_slim': 1, 'fail': True}))
+    compose.scale('worker_slim', 2)
+    with pytest.raises(AutoscaleError, match='no such service'):
+        compose.wait()
+    assert not compose.busy('worker_slim')
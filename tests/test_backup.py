@@ -0,0 +1,98 @@
+import io
+import shutil
+import sys
+
+import pytest
+
+from teamplify_runner.backup import (
+    ParallelGzipWriter,
+    ZstdWriter,
+    compressor,
+    decompressor,
+    dump,
+    load,
+)
+
+
+ENV = {'DB_USER': 'root', 'DB_PASSWORD': 'secret', 'DB_NAME': 'teamplify'}
+
+requires_zstd = pytest.mark.skipif(not shutil.which('zstd'), reason='zstd is not installed')
+
+
+def _round_trip(compression, data, **kwargs):
+    archive = io.BytesIO()
+    writer = compressor(compression, archive, **kwargs)
+    writer.write(data)
+    writer.close()
+    source = decompressor(io.BufferedReader(io.BytesIO(archive.getvalue())))
+    try:
+        return source.read()
+    finally:
+        source.close()
+
+
+@pytest.mark.parametrize('size', [0, 10, 100000])
+def test_parallel_gzip_round_trip(size):
+    data = bytes(i % 251 for i in range(size))
+    assert _round_trip('gzip', data, threads=3) == data
+
+
+def test_parallel_gzip_writes_blocks_in_order():
+    archive = io.BytesIO()
+    writer = ParallelGzipWriter(archive, threads=4, block_size=1000)
+    data = b''.join(str(i).encode() + b'\n' for i in range(10000))
+    for i in range(0, len(data), 777):
+        writer.write(data[i : i + 777])
+    writer.close()
+    assert writer.blocks_written > 4
+    assert decompressor(io.BufferedReader(io.BytesIO(archive.getvalue()))).read() == data
+
+
+@requires_zstd
+def test_zstd_round_trip():
+    data = b'INSERT INTO t VALUES (1);\n' * 10000
+    assert _round_trip('zstd', data, level=1, threads=2) == data
+
+
+@requires_zstd
+def test_zstd_writer_output_is_zstd():
+    archive = io.BytesIO()
+    writer = ZstdWriter(archive)
+    writer.write(b'data')
+    writer.close()
+    assert archive.getvalue().startswith(b'\x28\xb5\x2f\xfd')
+
+
+def test_decompressor_rejects_unknown_format():
+    with pytest.raises(RuntimeError):
+        decompressor(io.BufferedReader(io.BytesIO(b'plain text')))
+
+
+def test_dump_streams_command_output_and_passes_password():
+    archive = io.BytesIO()
+    writer = compressor('gzip', archive)
+    command = [sys.executable, '-c', 'import os; print("pwd=" + os.environ["MYSQL_PWD"])']
+    total = dump(ENV, writer, command=command)
+    writer.close()
+    source = decompressor(io.BufferedReader(io.BytesIO(archive.getvalue())))
+    assert source.read() == b'pwd=secret\n'
+    assert total == len(b'pwd=secret\n')
+
+
+def test_dump_raises_on_command_failure():
+    command = [sys.executable, '-c', 'import sys; sys.stderr.write("boom"); sys.exit(2)']
+    with pytest.raises(RuntimeError, match='exit code 2: boom'):
+        dump(ENV, io.BytesIO(), command=command)
+
+
+def test_load_streams_source_into_command(tmp_path):
+    target = tmp_path / 'loaded.sql'
+    command = [
+        sys.executable,
+        '-c',
+        'import shutil, sys; shutil.copyfileobj(sys.stdin.buffer, open(sys.argv[1], "wb"))',
+        str(target),
+    ]
+    data = b'CREATE TABLE t (id int);\n' * 100000
+    load(ENV, io.BytesIO(data), command=command)
+    assert target.read_bytes() == data
@@ -0,0 +1,93 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from teamplify_runner.bench import (
+    Bench,
+    BenchError,
+    _slot_time,
+    compare_results,
+    histogram,
+    percentile,
+)
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.clients.add(self.client_address)
+        if self.path == '/slow':
+            time.sleep(0.02)
+        status = 404 if self.path == '/missing' else 200
+        body = b'ok'
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.clients = set()
+    server.lock = threading.Lock()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_percentile_and_histogram():
+    ordered = [i / 1000 for i in range(1, 101)]
+    assert percentile(ordered, 50) == 0.05
+    assert percentile(ordered, 99) == 0.099
+    assert percentile([], 50) == 0.0
+    buckets = dict(histogram([0.001, 0.004, 0.02, 30]))
+    assert buckets[5] == 2
+    assert buckets[25] == 1
+    assert buckets[None] == 1
+
+
+def test_slot_time():
+    # 10 req/sec after a 2 sec ramp-up, the first 10 requests are in the ramp-up
+    assert _slot_time(0, 10, 2) == 0
+    assert _slot_time(10, 10, 2) == 2
+    assert _slot_time(20, 10, 2) == 3
+    assert _slot_time(5, 10, 0) == 0.5
+
+
+def test_closed_loop(server):
+    url = 'http://127.0.0.1:{0}/'.format(server.server_port)
+    summary = Bench(url, paths=('/', '/slow'), concurrency=3, duration=0.5).run()
+    assert summary['requests'] > 10
+    assert summary['errors'] == 0
+    assert set(summary['paths']) == {'/', '/slow'}
+    assert summary['paths']['/slow']['p50'] >= 20
+    # One keep-alive connection per thread
+    assert len(server.clients) == 3
+
+
+def test_fixed_rate(server):
+    url = 'http://127.0.0.1:{0}/'.format(server.server_port)
+    summary = Bench(url, paths=('/missing',), concurrency=2, duration=1, ramp_up=0.5, rate=20).run()
+    # Requests of the ramp-up are not counted
+    assert 17 <= summary['requests'] <= 21
+    assert summary['errors'] == summary['requests']
+    assert summary['settings']['rate'] == 20
+
+
+def test_failures_and_comparison():
+    with pytest.raises(BenchError, match='All requests'):
+        Bench('http://127.0.0.1:9/', concurrency=1, duration=0.1, timeout=1).run()
+    rows = compare_results({'throughput': 100.0, 'p50': 10.0}, {'throughput': 120.0, 'p50': 5.0})
+    assert rows[0] == ('throughput', 100.0, 120.0, 20.0)
+    assert rows[1] == ('p50', 10.0, 5.0, -50.0)
+    assert rows[2][3] is None
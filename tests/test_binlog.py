@@ -0,0 +1,85 @@
+import io
+import json
+import tarfile
+
+import pytest
+
+from teamplify_runner.backup import compressor
+from teamplify_runner.binlog import (
+    MANIFEST_NAME,
+    BinlogError,
+    PositionSniffer,
+    files_to_ship,
+    order_chain,
+    parse_source_position,
+)
+
+
+def test_parse_source_position():
+    assert parse_source_position(
+        b"-- CHANGE REPLICATION SOURCE TO SOURCE_LOG_FILE='binlog.000003', SOURCE_LOG_POS=157;",
+    ) == {'file': 'binlog.000003', 'position': 157}
+    assert parse_source_position(
+        b"-- CHANGE MASTER TO MASTER_LOG_FILE='mysql-bin.000012', MASTER_LOG_POS=4;",
+    ) == {'file': 'mysql-bin.000012', 'position': 4}
+    assert parse_source_position(b'-- MySQL dump') is None
+
+
+def test_position_sniffer_passes_data_through():
+    sink = io.BytesIO()
+    sniffer = PositionSniffer(sink)
+    sniffer.write(b"-- MySQL dump\n-- CHANGE REPLICATION SOURCE TO SOURCE_LOG_FILE='binlog")
+    sniffer.write(b".000002', SOURCE_LOG_POS=1234;\nINSERT INTO t VALUES (1);\n")
+    assert sniffer.position == {'file': 'binlog.000002', 'position': 1234}
+    assert sink.getvalue().endswith(b'INSERT INTO t VALUES (1);\n')
+
+
+def test_files_to_ship_skips_the_active_binlog():
+    logs = [('binlog.000001', 10), ('binlog.000002', 20), ('binlog.000003', 30)]
+    assert files_to_ship(logs, 'binlog.000002') == [('binlog.000002', 20)]
+    with pytest.raises(BinlogError):
+        files_to_ship(logs, 'binlog.000000')
+
+
+def _incremental(path, start, end, base='full.sql.gz', base_position=None):
+    manifest = {
+        'base': base,
+        'base_position': base_position or {'file': 'binlog.000001', 'position': 157},
+        'created': '2024-01-01T00:00:00',
+        'start': start,
+        'end': end,
+        'files': [],
+    }
+    with open(path, 'wb') as f:
+        writer = compressor('gzip', f)
+        with tarfile.open(fileobj=writer, mode='w|') as tar:
+            data = json.dumps(manifest).encode()
+            info = tarfile.TarInfo(MANIFEST_NAME)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+        writer.close()
+    return str(path)
+
+
+def test_order_chain(tmp_path):
+    first = {'file': 'binlog.000001', 'position': 157}
+    second = {'file': 'binlog.000002', 'position': 4}
+    third = {'file': 'binlog.000003', 'position': 4}
+    b = _incremental(tmp_path / 'b.binlog.tar.gz', second, third)
+    a = _incremental(tmp_path / 'a.binlog.tar.gz', first, second)
+    chain = order_chain('/backups/full.sql.gz', [b, a])
+    assert [path for path, _ in chain] == [a, b]
+
+
+def test_order_chain_detects_gaps(tmp_path):
+    first = {'file': 'binlog.000001', 'position': 157}
+    b = _incremental(
+        tmp_path / 'b.binlog.tar.gz',
+        {'file': 'binlog.000002', 'position': 4},
+        {'file': 'binlog.000003', 'position': 4},
+    )
+    with pytest.raises(BinlogError, match='continuous chain'):
+        order_chain('full.sql.gz', [b])
+    a = _incremental(tmp_path / 'a.binlog.tar.gz', first, first, base='other.sql.gz')
+    with pytest.raises(BinlogError, match='other.sql.gz'):
+        order_chain('full.sql.gz', [a])
@@ -1,6 +1,13 @@
+import socket
+import subprocess
+import sys
+
 import pytest
+from click.testing import CliRunner
 
-from teamplify_runner.cli import _root_url
+from teamplify_runner.backup import COMPRESSION_SUFFIXES
+from teamplify_runner.cli import COMPRESSIONS, Settings, _root_url, cli
+from teamplify_runner.configurator import Configurator
 
 
 @pytest.mark.parametrize(
@@ -17,3 +24,68 @@ from teamplify_runner.cli import _root_url
 def test_root_url(use_ssl, port, expected):
     env = {'WEB_HOST': 'example.com', 'WEB_PORT': port, 'WEB_USE_SSL': use_ssl}
     assert _root_url(env) == expected
+
+
+# Generous enough for slow CI machines, loading requests alone used to take
+# a good part of it
+IMPORT_BUDGET = 0.5
+
+
+def test_import_time():
+    script = (
+        'import sys, time\n'
+        'start = time.perf_counter()\n'
+        'import teamplify_runner.cli\n'
+        'print(time.perf_counter() - start)\n'
+        'print("requests" in sys.modules)\n'
+        'print(",".join(sorted(m for m in sys.modules if m.startswith("teamplify_runner."))))\n'
+    )
+    output = subprocess.run(
+        [sys.executable, '-c', script],
+        capture_output=True,
+        check=True,
+    )
+    import_time, requests_loaded, modules = output.stdout.decode().split()
+    assert requests_loaded == 'False'
+    assert float(import_time) < IMPORT_BUDGET
+    # The feature modules are imported by the commands that use them
+    assert modules.split(',') == [
+        'teamplify_runner.cli',
+        'teamplify_runner.configurator',
+        'teamplify_runner.utils',
+    ]
+
+
+def test_compressions():
+    assert sorted(COMPRESSIONS) == sorted(COMPRESSION_SUFFIXES)
+
+
+@pytest.mark.parametrize('args', [['--help'], ['--version'], ['start', '--help']])
+def test_no_config_for_help(monkeypatch, args):
+    def fail(*args, **kwargs):
+        raise AssertionError('The configuration must not be loaded')
+
+    monkeypatch.setattr(Configurator, 'load', fail)
+    monkeypatch.setattr(socket, 'gethostbyname', fail)
+    result = CliRunner().invoke(cli, args, obj={})
+    assert result.exit_code == 0, result.output
+    assert 'Teamplify runner' in result.output or 'Usage' in result.output
+
+
+@pytest.mark.parametrize(
+    'args,error',
+    [
+        (['--repository', '--compression', 'zstd'], 'can not be used with'),
+        (['--repository', '--level', '12'], 'the repository supports levels from 1 to 9'),
+        (['--level', '12'], 'gzip supports levels from 1 to 9'),
+    ],
+)
+def test_backup_options(monkeypatch, args, error):
+    def load(settings):
+        settings['config'] = None
+        settings['env'] = Configurator().env()
+
+    monkeypatch.setattr(Settings, 'load', load)
+    result = CliRunner().invoke(cli, ['backup'] + args, obj={})
+    assert result.exit_code == 2
+    assert error in result.output
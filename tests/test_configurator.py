@@ -1,8 +1,11 @@
 import os
+import socket
+import time
 
+import pytest
 from pytest import fail
 
-from teamplify_runner.configurator import ConfigurationError, Configurator
+from teamplify_runner.configurator import ConfigurationError, Configurator, HostnameResolver
 
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -56,3 +59,106 @@ def test_deeply_invalid_configuration():
         assert e.messages == expected_errors
     else:
         fail('Configuration {0} must be invalid'.format(invalid_config))
+
+
+def test_binlog_mysqld_args():
+    env = Configurator().loads('[db]\nbinlog = yes\nbinlog_expire_days = 2\n').env()
+    assert '--log-bin=binlog' in env['DB_MYSQLD_ARGS']
+    assert '--binlog-expire-logs-seconds=172800' in env['DB_MYSQLD_ARGS']
+    assert Configurator().env()['DB_MYSQLD_ARGS'] == '--skip-log-bin'
+
+
+def test_resources():
+    env = Configurator().env()
+    assert env['RESOURCES_WEB_CPUS'] == ''
+    assert env['RESOURCES_WORKER_FAT_MEMORY_RESERVATION'] == ''
+
+    configuration = Configurator().loads(
+        '[resources]\n'
+        'web_cpus = 1.5\n'
+        'web_cpuset = 0\n'
+        'web_memory = 2g\n'
+        'web_memory_reservation = 1024m\n'
+        'db_cpus = 0\n'
+        'db_cpuset = 0-a\n'
+        'worker_fat_memory = 1t\n'
+        'beat_memory = 512m\n'
+        'beat_memory_reservation = 1g\n'
+    )
+    try:
+        configuration.validate()
+    except ConfigurationError as e:
+        assert e.messages == [
+            '[main] product_key: Product key is missing',
+            '[resources] db_cpus: Must be greater than 0. You provided: 0',
+            '[resources] db_cpuset: Must be a list of CPUs, such as 0-3 or 0,2. You provided: 0-a',
+            '[resources] worker_fat_memory: Must be a size, such as 512m or 2g. You provided: 1t',
+            '[resources] beat_memory_reservation: Must not exceed beat_memory. You provided: 1g',
+        ]
+    else:
+        fail('Configuration with invalid resources must be invalid')
+
+
+def test_signing_key_is_generated_when_missing():
+    config = Configurator().loads('')
+    key = config.env()['CRYPTO_SIGNING_KEY']
+    assert len(key) == 50
+    assert config.env()['CRYPTO_SIGNING_KEY'] == key
+    config = Configurator().loads('[crypto]\nsigning_key = secret\n')
+    assert config.env()['CRYPTO_SIGNING_KEY'] == 'secret'
+
+
+def test_hostname_resolver(monkeypatch, tmp_path):
+    lookups = []
+
+    def gethostbyname(hostname):
+        lookups.append(hostname)
+        if hostname == 'slow.example.com':
+            time.sleep(5)
+        if hostname == 'missing.example.com':
+            raise socket.gaierror('Name or service not known')
+        return '10.0.0.1'
+
+    monkeypatch.setattr(socket, 'gethostbyname', gethostbyname)
+    cache_path = str(tmp_path / 'hostnames.json')
+    resolver = HostnameResolver(timeout=0.5, cache_path=cache_path)
+    start = time.monotonic()
+    resolver.resolve(['db.example.com', 'missing.example.com', 'slow.example.com'])
+    # The lookups run concurrently and the slow one is given up
+    assert time.monotonic() - start < 2
+    resolver.check('db.example.com')
+    with pytest.raises(ConfigurationError, match="Can't resolve"):
+        resolver.check('missing.example.com')
+    with pytest.raises(ConfigurationError, match='Timed out'):
+        resolver.check('slow.example.com')
+
+    # The next run takes the resolved hostname from the cache
+    lookups.clear()
+    HostnameResolver(cache_path=cache_path).check('db.example.com')
+    assert lookups == []
+    HostnameResolver(ttl=-1, cache_path=str(tmp_path / 'other.json')).check('db.example.com')
+    assert lookups == ['db.example.com']
+
+
+def test_hostname_cache_location(monkeypatch, cache_home):
+    monkeypatch.setattr(socket, 'gethostbyname', lambda hostname: '10.0.0.1')
+    HostnameResolver(cache=False).check('db.example.com')
+    assert not (cache_home / 'teamplify').exists()
+    HostnameResolver().check('db.example.com')
+    assert (cache_home / 'teamplify' / 'hostnames.json').exists()
+
+
+def test_offline_validation(monkeypatch):
+    def fail(*args, **kwargs):
+        raise AssertionError('Must not resolve hostnames offline')
+
+    monkeypatch.setattr(socket, 'gethostbyname', fail)
+    resolver = HostnameResolver(offline=True)
+    config = Configurator().loads(
+        '[main]\nproduct_key = 42\n[web]\nhost = teamplify_web.example.com\n'
+        '[db]\nhost = -1 # comment after value\n'
+    )
+    with pytest.raises(ConfigurationError) as e:
+        config.validate(resolver=resolver)
+    assert '[db] host: Invalid hostname: -1 # comment after value' in e.value.messages
+    assert not any(m.startswith('[web] host') for m in e.value.messages)
@@ -0,0 +1,165 @@
+import io
+import json
+import socketserver
+import struct
+import threading
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import parse_qs, unquote, urlparse
+
+import pytest
+
+from teamplify_runner.docker_api import DockerAPIError, DockerClient, socket_path
+
+
+def frame(stream, data):
+    return struct.pack('>BxxxL', stream, len(data)) + data
+
+
+class DockerStandIn(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path):
+        self.connections = 0
+        self.requests = []
+        super().__init__(path, Handler)
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def address_string(self):
+        return 'unix'
+
+    def log_message(self, *args):
+        pass
+
+    def _json(self, data, status=200):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return json.loads(self.rfile.read(length)) if length else None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        self.server.requests.append(('GET', url.path, parse_qs(url.query), None))
+        if url.path == '/_ping':
+            self.send_response(200)
+            self.send_header('Content-Length', '2')
+            self.end_headers()
+            self.wfile.write(b'OK')
+        elif url.path == '/containers/json':
+            self._json([{'Id': 'abc'}])
+        elif url.path == '/exec/e1/json':
+            self._json({'ExitCode': 3})
+        elif url.path == '/events':
+            self.send_response(200)
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for event in ({'status': 'start'}, {'status': 'die'}):
+                line = json.dumps(event).encode() + b'\n'
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(line), line))
+            self.wfile.write(b'0\r\n\r\n')
+        else:
+            self._json({'message': 'page not found'}, status=404)
+
+    def do_POST(self):
+        body = self._body()
+        self.server.requests.append(('POST', self.path, None, body))
+        if self.path == '/containers/teamplify_db/exec':
+            self._json({'Id': 'e1'}, status=201)
+        elif self.path == '/exec/e1/start':
+            self.send_response(101)
+            self.send_header('Connection', 'Upgrade')
+            self.send_header('Upgrade', 'tcp')
+            self.end_headers()
+            self.wfile.flush()
+            # Echo stdin until the client closes it
+            data = self.rfile.read()
+            self.wfile.write(frame(1, data.upper()) + frame(2, b'warning\n'))
+            self.close_connection = True
+        else:
+            self._json({'message': 'No such container'}, status=404)
+
+    def do_DELETE(self):
+        self.server.requests.append(('DELETE', self.path, None, None))
+        if unquote(self.path).startswith('/images/mysql:8.0'):
+            self._json({'message': 'image is being used'}, status=409)
+        else:
+            self.send_response(204)
+            self.end_headers()
+
+
+@pytest.fixture
+def server(tmp_path):
+    server = DockerStandIn(str(tmp_path / 'docker.sock'))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_requests_reuse_connection(server):
+    client = DockerClient(server.server_address)
+    client.ping()
+    connections = server.connections
+    for _ in range(5):
+        assert client.containers(filters={'label': ['a=b']}) == [{'Id': 'abc'}]
+    assert server.connections == connections + 1
+    method, path, query, _ = server.requests[-1]
+    assert json.loads(query['filters'][0]) == {'label': ['a=b']}
+    assert query['all'] == ['0']
+
+
+def test_errors(server):
+    client = DockerClient(server.server_address)
+    with pytest.raises(DockerAPIError, match='image is being used') as e:
+        client.remove_image('mysql:8.0.35-oracle')
+    assert e.value.status == 409
+    client.remove_volume('teamplify_runner_db')
+    with pytest.raises(DockerAPIError, match='Failed to connect'):
+        DockerClient(server.server_address + '.missing').ping()
+
+
+def test_exec(server):
+    client = DockerClient(server.server_address)
+    code, stdout, stderr = client.exec_run(
+        'teamplify_db',
+        ['mysql', '-e', 'select 1'],
+        env={'MYSQL_PWD': 'secret'},
+        stdin=io.BytesIO(b'select 1;\n'),
+    )
+    assert (code, stdout, stderr) == (3, b'SELECT 1;\n', b'warning\n')
+    created = server.requests[0][3]
+    assert created['Cmd'] == ['mysql', '-e', 'select 1']
+    assert created['Env'] == ['MYSQL_PWD=secret']
+    assert created['AttachStdin']
+
+
+def test_events(server):
+    client = DockerClient(server.server_address)
+    events = list(client.events(filters={'type': ['container']}, until=1))
+    assert [event['status'] for event in events] == ['start', 'die']
+
+
+def test_socket_path(monkeypatch, tmp_path):
+    monkeypatch.setenv('DOCKER_CONFIG', str(tmp_path))
+    monkeypatch.delenv('DOCKER_CONTEXT', raising=False)
+    monkeypatch.setenv('DOCKER_HOST', 'unix:///run/user/1000/docker.sock')
+    assert socket_path() == '/run/user/1000/docker.sock'
+    monkeypatch.setenv('DOCKER_HOST', 'tcp://10.0.0.1:2376')
+    assert socket_path() is None
+    monkeypatch.delenv('DOCKER_HOST')
+    assert socket_path() == '/var/run/docker.sock'
+    (tmp_path / 'config.json').write_text(json.dumps({'currentContext': 'remote'}))
+    assert socket_path() is None
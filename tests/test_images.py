@@ -0,0 +1,152 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from teamplify_runner.images import ImageError, parse_reference, prefetch, remote_digest
+
+
+def test_parse_reference():
+    assert parse_reference('redis:6.2.6') == ('registry-1.docker.io', 'library/redis', '6.2.6')
+    assert parse_reference('jwilder/nginx-proxy') == (
+        'registry-1.docker.io',
+        'jwilder/nginx-proxy',
+        'latest',
+    )
+    assert parse_reference('public.ecr.aws/q5a3z0t4/teamplify/server:stable') == (
+        'public.ecr.aws',
+        'q5a3z0t4/teamplify/server',
+        'stable',
+    )
+    assert parse_reference('localhost:5000/server') == ('localhost:5000', 'server', 'latest')
+
+
+class RegistryHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        if self.headers.get('Authorization') != 'Bearer secret':
+            self.send_response(401)
+            self.send_header(
+                'WWW-Authenticate',
+                'Bearer realm="http://{0}:{1}/token",service="registry",'
+                'scope="repository:{2}:pull"'.format(
+                    *self.server.server_address, 'teamplify/server'
+                ),
+            )
+        elif self.path == '/v2/teamplify/server/manifests/stable':
+            self.send_response(200)
+            self.send_header('Docker-Content-Digest', 'sha256:abc')
+        else:
+            self.send_response(404)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        assert 'scope=repository%3Ateamplify%2Fserver%3Apull' in self.path
+        body = b'{"token": "secret"}'
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def registry():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), RegistryHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield '127.0.0.1:{0}'.format(server.server_port)
+    server.shutdown()
+    server.server_close()
+
+
+def test_remote_digest(registry):
+    assert remote_digest(registry + '/teamplify/server:stable', scheme='http') == 'sha256:abc'
+    assert remote_digest(registry + '/teamplify/server:latest', scheme='http') is None
+
+
+def test_prefetch_skips_up_to_date_images():
+    local = {
+        'redis:6.2.6': ('sha256:1', 'sha256:redis'),
+        'jwilder/nginx-proxy:latest': ('sha256:2', 'sha256:old'),
+    }
+    remote = {'redis:6.2.6': 'sha256:redis', 'jwilder/nginx-proxy': 'sha256:new'}
+    pulls = []
+
+    def pull(reference):
+        time.sleep(0.05)
+        pulls.append(reference)
+
+    pulled = prefetch(
+        ['redis:6.2.6', 'jwilder/nginx-proxy', 'mysql:8.0.35-oracle'],
+        local=local,
+        digest=remote.get,
+        pull=pull,
+    )
+    assert pulled == ['jwilder/nginx-proxy', 'mysql:8.0.35-oracle']
+    assert sorted(pulls) == sorted(pulled)
+
+
+def test_prefetch_reports_failures():
+    def pull(reference):
+        if reference == 'broken':
+            raise ImageError('Failed to pull broken')
+
+    with pytest.raises(ImageError, match='Failed to pull broken'):
+        prefetch(['broken', 'redis'], local={}, pull=pull)
+
+
+def test_prefetch_falls_back_to_local_images():
+    local = {
+        'redis:6.2.6': ('sha256:1', 'sha256:redis'),
+        'jwilder/nginx-proxy:latest': ('sha256:2', 'sha256:old'),
+    }
+    remote = {'jwilder/nginx-proxy': 'sha256:new'}
+    pulls = []
+
+    def pull(reference):
+        pulls.append(reference)
+        raise ImageError('Failed to pull {0}'.format(reference))
+
+    # The registry is down: both pulls fail, but the images exist locally
+    pulled = prefetch(
+        ['redis:6.2.6', 'jwilder/nginx-proxy'],
+        local=local,
+        digest=remote.get,
+        pull=pull,
+    )
+    assert pulled == []
+    assert sorted(pulls) == ['jwilder/nginx-proxy', 'redis:6.2.6']
+    with pytest.raises(ImageError, match='Failed to pull mysql'):
+        prefetch(['mysql:8.0.35-oracle'], local=local, digest=remote.get, pull=pull)
+
+
+def test_prefetch_pulls_without_remote_digest():
+    # A private registry or a failed token request gives no digest, so the
+    # pull decides whether the local image is up to date
+    local = {'redis:6.2.6': ('sha256:1', 'sha256:redis')}
+    pulls = []
+    pulled = prefetch(
+        ['redis:6.2.6'], local=local, digest=lambda reference: None, pull=pulls.append
+    )
+    assert pulled == pulls == ['redis:6.2.6']
+
+
+def test_prefetch_missing_only():
+    local = {'redis:6.2.6': ('sha256:1', 'sha256:redis')}
+    pulls = []
+
+    def digest(reference):
+        raise AssertionError('Must not check the registry')
+
+    pulled = prefetch(
+        ['redis:6.2.6', 'mysql:8.0.35-oracle'],
+        local=local,
+        digest=digest,
+        pull=pulls.append,
+        missing_only=True,
+    )
+    assert pulled == pulls == ['mysql:8.0.35-oracle']
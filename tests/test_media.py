@@ -0,0 +1,81 @@
+import os
+
+import pytest
+
+from teamplify_runner.media import MediaBackups, MediaError, Volume
+
+
+def _write(root, path, data):
+    path = os.path.join(root, path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def _read_tree(root):
+    tree = {}
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            with open(path, 'rb') as f:
+                tree[os.path.relpath(path, root)] = f.read()
+    return tree
+
+
+def _stats(root):
+    stats = {}
+    for path in _read_tree(root):
+        st = os.stat(os.path.join(root, path))
+        stats[path] = (st.st_mode, st.st_mtime_ns)
+    return stats
+
+
+def test_backup_copies_only_changed_files(tmp_path):
+    media = str(tmp_path / 'media')
+    _write(media, 'avatars/1.png', b'one')
+    _write(media, 'avatars/2.png', b'two')
+    _write(media, 'export.csv', b'a,b')
+    volume = Volume.local(media)
+    backups = MediaBackups(str(tmp_path / 'backups'))
+
+    assert backups.backup(volume, 'first', threads=2) == (3, 3, 9)
+    _write(media, 'avatars/2.png', b'changed')
+    os.remove(os.path.join(media, 'export.csv'))
+    assert backups.backup(volume, 'second', threads=2) == (2, 1, 7)
+
+    assert backups.snapshots() == ['first', 'second']
+    first = os.path.join(backups.snapshot_dir('first'), 'avatars', '1.png')
+    second = os.path.join(backups.snapshot_dir('second'), 'avatars', '1.png')
+    assert os.stat(first).st_ino == os.stat(second).st_ino
+    assert _read_tree(backups.snapshot_dir('second')) == _read_tree(media)
+
+    backups.remove('first')
+    assert backups.snapshots() == ['second']
+    assert _read_tree(backups.snapshot_dir('second')) == _read_tree(media)
+
+
+def test_restore(tmp_path):
+    media = str(tmp_path / 'media')
+    _write(media, 'avatars/1.png', b'one')
+    _write(media, 'avatars/2.png', b'two')
+    os.chmod(os.path.join(media, 'avatars', '2.png'), 0o600)
+    volume = Volume.local(media)
+    backups = MediaBackups(str(tmp_path / 'backups'))
+    backups.backup(volume, 'first')
+    expected = _read_tree(media)
+    expected_stats = _stats(media)
+
+    _write(media, 'avatars/2.png', b'changed')
+    _write(media, 'new.txt', b'new')
+    assert backups.restore('first', volume, threads=2) == (1, 1)
+    assert _read_tree(media) == expected
+    # The times and permissions are restored too, so nothing changes next time
+    assert _stats(media) == expected_stats
+    assert backups.restore('first', volume) == (0, 0)
+
+    _write(backups.snapshot_dir('first'), 'avatars/1.png', b'bad')
+    os.remove(os.path.join(media, 'avatars', '1.png'))
+    with pytest.raises(MediaError, match='damaged'):
+        backups.restore('first', volume)
+    with pytest.raises(MediaError, match='not found'):
+        backups.restore('missing', volume)
@@ -0,0 +1,167 @@
+import threading
+
+import requests
+
+from teamplify_runner import metrics
+from teamplify_runner.docker_api import DockerAPIError
+from teamplify_runner.metrics import (
+    CachedCollector,
+    Container,
+    collect,
+    metrics_server,
+    parse_size,
+    parse_stats,
+    parse_stats_line,
+    prometheus,
+)
+
+
+STATS = {
+    'cpu_stats': {
+        'cpu_usage': {'total_usage': 3_000_000_000},
+        'system_cpu_usage': 20_000_000_000,
+        'online_cpus': 4,
+    },
+    'precpu_stats': {
+        'cpu_usage': {'total_usage': 1_000_000_000},
+        'system_cpu_usage': 12_000_000_000,
+    },
+    'memory_stats': {
+        'usage': 1_610_612_736 + 4096,
+        'limit': 6 * 1024**3,
+        'stats': {'inactive_file': 4096},
+    },
+    'networks': {
+        'eth0': {'rx_bytes': 1234, 'tx_bytes': 648},
+        'eth1': {'rx_bytes': 1, 'tx_bytes': 2},
+    },
+    'blkio_stats': {
+        'io_service_bytes_recursive': [
+            {'major': 8, 'minor': 0, 'op': 'read', 'value': 12_345_678},
+            {'major': 8, 'minor': 0, 'op': 'write', 'value': 4_100_000_001},
+        ],
+    },
+    'pids_stats': {'current': 42},
+}
+
+
+def test_parse_stats():
+    stats = parse_stats(STATS)
+    assert stats.cpu_percent == 100.0
+    assert stats.memory_usage == 1610612736
+    assert stats.memory_limit == 6 * 1024**3
+    assert (stats.network_receive, stats.network_transmit) == (1235, 650)
+    assert (stats.block_read, stats.block_write) == (12345678, 4100000001)
+    assert stats.pids == 42
+    # The first sample of a container has no previous CPU usage
+    assert parse_stats({}).cpu_percent == 0.0
+
+
+class FakeDocker:
+    def containers(self, filters=None, all=False):
+        assert filters == {'label': ['com.docker.compose.project=teamplify_runner']}
+        return [
+            {
+                'Id': container_id,
+                'Names': ['/' + name],
+                'Labels': {
+                    'com.docker.compose.service': 'worker_fat',
+                    'com.docker.compose.container-number': replica,
+                },
+            }
+            for container_id, name, replica in (
+                ('abc', 'teamplify_runner-worker_fat-1', '1'),
+                ('gone', 'teamplify_runner-worker_fat-2', '2'),
+            )
+        ]
+
+    def get(self, path, params=None):
+        assert params == {'stream': False}
+        if path == '/containers/gone/stats':
+            raise DockerAPIError('No such container', status=404)
+        return STATS
+
+
+def test_collect():
+    samples = collect(FakeDocker())
+    assert samples == [
+        (
+            Container('abc', 'teamplify_runner-worker_fat-1', 'worker_fat', '1'),
+            parse_stats(STATS),
+        )
+    ]
+
+
+STATS_LINE = (
+    '{"BlockIO":"12.3MB / 4.1GB","CPUPerc":"152.25%","Container":"abc","ID":"abc123",'
+    '"MemPerc":"25.00%","MemUsage":"1.5GiB / 6GiB","Name":"teamplify_db",'
+    '"NetIO":"1.2kB / 648B","PIDs":"42"}'
+)
+
+
+def test_parse_size():
+    assert parse_size('0B') == 0
+    assert parse_size('648B') == 648
+    assert parse_size('1.2kB') == 1200
+    assert parse_size('1.5GiB') == 1610612736
+    assert parse_size('--') == 0
+
+
+def test_parse_stats_line():
+    container_id, stats = parse_stats_line(STATS_LINE)
+    assert container_id == 'abc123'
+    assert stats.cpu_percent == 152.25
+    assert stats.memory_usage == 1610612736
+    assert (stats.network_receive, stats.network_transmit) == (1200, 648)
+    assert (stats.block_read, stats.block_write) == (12300000, 4100000000)
+    assert stats.pids == 42
+
+
+def test_collect_without_docker_api(monkeypatch):
+    def docker(*args):
+        if args[0] == 'ps':
+            return 'abc teamplify_db builtin_db 1\nfed teamplify_redis redis 1\n'
+        # The redis container has stopped between docker ps and docker stats
+        return STATS_LINE + '\n'
+
+    monkeypatch.setattr(metrics, 'docker_client', lambda: None)
+    monkeypatch.setattr(metrics, '_docker', docker)
+    assert collect() == [
+        (Container('abc', 'teamplify_db', 'builtin_db', '1'), parse_stats_line(STATS_LINE)[1])
+    ]
+
+
+def _samples():
+    return [(Container('abc', 'teamplify_db', 'builtin_db', '1'), parse_stats(STATS))]
+
+
+def test_prometheus():
+    text = prometheus(_samples())
+    assert '# TYPE teamplify_container_block_write_bytes_total counter\n' in text
+    assert (
+        'teamplify_container_cpu_percent{container="teamplify_db",service="builtin_db",'
+        'replica="1"} 100.0\n'
+    ) in text
+
+
+def test_metrics_server_caches_collections():
+    calls = []
+
+    def collect():
+        calls.append(1)
+        return _samples()
+
+    server = metrics_server(CachedCollector(60, collect=collect), '127.0.0.1', 0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        url = 'http://127.0.0.1:{0}/metrics'.format(server.server_port)
+        for _ in range(3):
+            response = requests.get(url, timeout=5)
+            assert response.status_code == 200
+            assert 'service="builtin_db"' in response.text
+        assert len(calls) == 1
+        assert requests.get(url + '/other', timeout=5).status_code == 404
+    finally:
+        server.shutdown()
+        server.server_close()
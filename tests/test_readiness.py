@@ -0,0 +1,123 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from teamplify_runner.readiness import (
+    Backoff,
+    parse_compose_ps,
+    pending_services,
+    wait_for_start,
+)
+
+
+def test_parse_compose_ps():
+    ndjson = (
+        '{"Service":"app","State":"running","Health":"starting"}\n'
+        '{"Service":"redis","State":"running","Health":""}\n'
+    )
+    array = (
+        '[{"Service":"app","State":"running","Health":"starting"},'
+        '{"Service":"redis","State":"running"}]'
+    )
+    expected = [('app', 'running', 'starting'), ('redis', 'running', '')]
+    assert parse_compose_ps(ndjson) == expected
+    assert parse_compose_ps(array) == expected
+    assert parse_compose_ps('') == []
+
+
+def test_pending_services():
+    containers = [
+        ('redis', 'running', ''),
+        ('app', 'running', 'starting'),
+        ('builtin_db', 'running', 'healthy'),
+        ('worker_slim', 'restarting', ''),
+    ]
+    assert pending_services(containers) == ['app (starting)', 'worker_slim (restarting)']
+
+
+def test_backoff():
+    backoff = Backoff(initial=0.1, maximum=0.3, factor=2)
+    assert [backoff.next() for _ in range(4)] == [0.1, 0.2, 0.3, 0.3]
+    backoff.reset()
+    assert backoff.next() == 0.1
+
+
+class TeamplifyHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        server.clients.add(self.client_address)
+        server.requests += 1
+        if server.requests < 3:
+            body = b'Teamplify is starting...'
+        else:
+            body = b"<script>window.BUILD_NUMBER = '123';</script>"
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def teamplify():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), TeamplifyHandler)
+    server.clients = set()
+    server.requests = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_wait_for_start_reuses_connection(teamplify):
+    calls = []
+
+    def services(env):
+        calls.append(env)
+        return [('app', 'running', '')]
+
+    wait_for_start(
+        'http://127.0.0.1:{0}/'.format(teamplify.server_port),
+        env={},
+        backoff=Backoff(initial=0.01),
+        services=services,
+    )
+    assert teamplify.requests == 3
+    assert len(teamplify.clients) == 1
+    assert calls
+
+
+def test_wait_for_start_times_out():
+    with pytest.raises(RuntimeError, match='waiting for app'):
+        wait_for_start(
+            'http://127.0.0.1:9/',
+            env={},
+            max_minutes=0.001,
+            backoff=Backoff(initial=0.01),
+            services=lambda env: [('app', 'restarting', '')],
+        )
+
+
+def test_wait_for_start_waits_for_healthchecks(teamplify):
+    states = iter(
+        [
+            [('app', 'running', 'starting'), ('redis', 'running', 'healthy')],
+            [('app', 'running', 'starting'), ('redis', 'running', 'healthy')],
+            [('app', 'running', 'starting'), ('redis', 'running', 'healthy')],
+            [('app', 'running', 'healthy'), ('redis', 'running', 'healthy')],
+        ]
+    )
+    wait_for_start(
+        'http://127.0.0.1:{0}/'.format(teamplify.server_port),
+        env={},
+        backoff=Backoff(initial=0.01),
+        services=lambda env: next(states),
+    )
+    # Served since the third request, then waited for the app healthcheck
+    assert teamplify.requests == 5
@@ -0,0 +1,148 @@
+import configparser
+
+import pytest
+
+from teamplify_runner.configurator import ConfigurationError, Configurator
+from teamplify_runner.render import (
+    render_mysql_cnf,
+    render_nginx_http_conf,
+    render_redis_conf,
+    render_vhost_conf,
+    render_vhost_location_conf,
+)
+
+
+def _mysqld(cnf):
+    parser = configparser.ConfigParser(allow_no_value=True, strict=False)
+    parser.read_string(cnf)
+    return parser['mysqld']
+
+
+def test_default_mysql_cnf_is_durable():
+    mysqld = _mysqld(render_mysql_cnf(Configurator().env()))
+    assert mysqld['character-set-server'] == 'utf8mb4'
+    assert 'innodb_buffer_pool_size' not in mysqld
+    assert mysqld['innodb_flush_log_at_trx_commit'] == '1'
+    assert mysqld['sync_binlog'] == '1'
+
+
+def test_presets_with_overrides():
+    env = (
+        Configurator()
+        .loads('[db]\nsize = large\nmax_connections = 800\ninnodb_log_file_size = 512\n')
+        .env()
+    )
+    mysqld = _mysqld(render_mysql_cnf(env))
+    assert mysqld['character-set-server'] == 'utf8mb4'
+    assert mysqld['innodb_buffer_pool_size'] == '4096M'
+    assert mysqld['innodb_redo_log_capacity'] == '1024M'
+    assert mysqld['max_connections'] == '800'
+
+    assert mysqld['innodb_flush_log_at_trx_commit'] == '1'
+
+    env = Configurator().loads('[db]\nsize = small\ndurability = fast\n').env()
+    mysqld = _mysqld(render_mysql_cnf(env))
+    assert mysqld['innodb_buffer_pool_size'] == '256M'
+    assert mysqld['innodb_flush_log_at_trx_commit'] == '2'
+    assert mysqld['sync_binlog'] == '0'
+
+
+def test_mysql_options_are_validated():
+    config = Configurator().loads(
+        '[db]\nsize = huge\ndurability = fast\ninnodb_flush_log_at_trx_commit = 3\n'
+        'innodb_buffer_pool_size = 1\n'
+    )
+    with pytest.raises(ConfigurationError) as e:
+        config.validate()
+    messages = '\n'.join(e.value.messages)
+    assert '[db] size' in messages
+    assert '[db] durability' not in messages
+    assert '[db] innodb_flush_log_at_trx_commit' in messages
+    assert '[db] innodb_buffer_pool_size' in messages
+
+
+def _redis(conf):
+    return dict(line.split(' ', 1) for line in conf.splitlines() if line and line[0] != '#')
+
+
+def test_shared_redis_instance():
+    env = Configurator().loads('[redis]\nmaxmemory = 256\nio_threads = 4\n').env()
+    redis = _redis(render_redis_conf(env))
+    assert redis['maxmemory'] == '256mb'
+    assert redis['maxmemory-policy'] == 'volatile-lru'
+    assert redis['io-threads'] == '4'
+    assert redis['appendonly'] == 'no'
+    assert 'broker' not in env['COMPOSE_PROFILES']
+    assert 'COMPOSE_FILE' not in env
+    assert 'CELERY_BROKER_URL' not in env
+
+
+def test_separate_broker_instance():
+    env = (
+        Configurator()
+        .loads('[redis]\nseparate_broker = yes\nmaxmemory = 512\nbroker_maxmemory = 128\n')
+        .env()
+    )
+    assert env['COMPOSE_PROFILES'] == 'nossl,broker'
+    assert env['CELERY_BROKER_URL'] == 'redis://redis_broker:6379/0'
+    assert env['COMPOSE_FILE'] == 'docker-compose.yml:docker-compose.broker.yml'
+    cache = _redis(render_redis_conf(env))
+    assert cache['maxmemory'] == '512mb'
+    assert cache['maxmemory-policy'] == 'allkeys-lru'
+    assert 'io-threads' not in cache
+    broker = _redis(render_redis_conf(env, broker=True))
+    assert broker['maxmemory'] == '128mb'
+    assert broker['maxmemory-policy'] == 'noeviction'
+    assert broker['appendonly'] == 'yes'
+
+
+def test_vhost_conf():
+    vhost = render_vhost_conf(Configurator().env())
+    assert 'gzip_types text/css' in vhost
+    assert 'open_file_cache max=' in vhost
+    assert 'immutable' in vhost
+    assert vhost.count('gzip_static on;') == 2
+    assert 'location = /favicon.ico' in vhost
+
+    env = Configurator().loads('[web]\nstatic_caching = no\nprecompress_static = no\n').env()
+    vhost = render_vhost_conf(env)
+    assert 'location /static/' in vhost
+    assert 'open_file_cache' not in vhost
+    assert 'immutable' not in vhost
+    assert 'gzip_static' not in vhost
+
+
+def test_uwsgi_upstream():
+    env = Configurator().env()
+    assert env['WEB_UPSTREAM_LOADBALANCE'] == 'least_conn;'
+    location = render_vhost_location_conf(env)
+    assert 'uwsgi_buffers 16 32k;' in location
+    assert 'uwsgi_cache' not in location
+    assert 'uwsgi_cache_path' not in render_nginx_http_conf(env)
+
+    env = Configurator().loads('[web]\nload_balancing = round_robin\nmicrocache = 5\n').env()
+    assert env['WEB_UPSTREAM_LOADBALANCE'] == ''
+    location = render_vhost_location_conf(env)
+    assert 'uwsgi_cache_valid 200 301 302 5s;' in location
+    assert 'uwsgi_no_cache $teamplify_no_cache;' in location
+    http = render_nginx_http_conf(env)
+    assert 'keys_zone=teamplify:10m' in http
+    assert 'map $http_cookie$http_authorization $teamplify_no_cache' in http
+
+
+def test_microcache_is_validated():
+    with pytest.raises(ConfigurationError):
+        Configurator().loads('[web]\nmicrocache = 600\n').validate()
+
+
+def test_tls_settings():
+    env = Configurator().env()
+    assert env['ENABLE_HTTP2'] == 'true'
+    assert env['DEFAULT_KEY_SIZE'] == 'ec-256'
+    assert 'ssl_buffer_size' not in render_nginx_http_conf(env)
+
+    env = Configurator().loads('[web]\nuse_ssl = builtin\nssl_key_type = rsa\nhttp2 = no\n').env()
+    assert env['ENABLE_HTTP2'] == 'false'
+    assert env['DEFAULT_KEY_SIZE'] == '4096'
+    assert env['SSL_POLICY'] == 'Mozilla-Intermediate'
+    assert 'ssl_buffer_size 4k;' in render_nginx_http_conf(env)
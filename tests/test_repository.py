@@ -0,0 +1,101 @@
+import random
+
+import pytest
+
+from teamplify_runner.repository import Chunker, Repository, RepositoryError
+
+
+def _dump(rows):
+    values = ','.join("({0},'{1}')".format(i, value) for i, value in rows)
+    return 'INSERT INTO `t` VALUES {0};\n'.format(values).encode()
+
+
+def _rows(count, seed=0):
+    rng = random.Random(seed)
+    return [(i, '{0:040x}'.format(rng.getrandbits(160))) for i in range(count)]
+
+
+def _chunks(data, **kwargs):
+    chunker = Chunker(**kwargs)
+    chunks = []
+    for i in range(0, len(data), 7000):
+        chunks.extend(chunker.feed(data[i : i + 7000]))
+    chunks.extend(chunker.flush())
+    return chunks
+
+
+def test_chunker_reassembles_data_and_respects_limits():
+    data = _dump(_rows(20000))
+    chunks = _chunks(data, min_size=4096, max_size=65536, mask=0xF)
+    assert b''.join(chunks) == data
+    assert len(chunks) > 10
+    assert all(len(chunk) <= 65536 for chunk in chunks)
+    assert all(len(chunk) >= 4096 for chunk in chunks[:-1])
+
+
+def test_chunker_resynchronizes_after_a_change():
+    rows = _rows(20000)
+    changed = list(rows)
+    changed.insert(100, (-1, 'inserted row'))
+    original_chunks = set(_chunks(_dump(rows), min_size=4096, max_size=65536, mask=0xF))
+    changed_chunks = _chunks(_dump(changed), min_size=4096, max_size=65536, mask=0xF)
+    new = [chunk for chunk in changed_chunks if chunk not in original_chunks]
+    assert len(new) <= 3
+
+
+def test_snapshot_round_trip_and_deduplication(tmp_path):
+    repository = Repository(str(tmp_path))
+    data = _dump(_rows(50000))
+    writer = repository.writer('first')
+    writer.write(data)
+    writer.close()
+    assert writer.new_chunks > 1
+
+    changed = data.replace(b"(25000,'", b"(25000,'changed")
+    writer = repository.writer('second')
+    writer.write(changed)
+    writer.close()
+    assert 0 < writer.new_chunks <= 3
+
+    with repository.open('second') as source:
+        assert source.stream.read() == changed
+        assert source.position() == len(changed)
+    assert [s['name'] for s in repository.snapshots()] == ['first', 'second']
+
+
+def test_prune_removes_unreferenced_chunks(tmp_path):
+    repository = Repository(str(tmp_path))
+    for name, seed in (('first', 1), ('second', 2)):
+        writer = repository.writer(name)
+        writer.write(_dump(_rows(20000, seed=seed)))
+        writer.close()
+    chunks_before = len(repository.index)
+
+    removed, removed_chunks, freed = repository.prune(keep_last=1)
+    assert removed == ['first']
+    assert removed_chunks > 0 and freed > 0
+    assert len(repository.index) == chunks_before - removed_chunks
+    assert len(Repository(str(tmp_path)).index) == len(repository.index)
+    with repository.open('second') as source:
+        assert source.stream.read() == _dump(_rows(20000, seed=2))
+    with pytest.raises(RepositoryError):
+        repository.open('first')
+
+
+def test_prune_waits_for_running_writer(tmp_path):
+    data = _dump(_rows(20000, seed=3))
+    writer = Repository(str(tmp_path)).writer('running')
+    writer.write(data)
+    # Another process must not remove the chunks that are not in a snapshot yet
+    other = Repository(str(tmp_path))
+    with pytest.raises(RepositoryError, match='in use'):
+        other.prune()
+    with pytest.raises(RepositoryError, match='in use'):
+        other.writer('concurrent')
+    writer.close()
+
+    assert other.prune() == ([], 0, 0)
+    with other.open('running') as source:
+        assert source.stream.read() == data
+    other.writer('aborted').abort()
+    other.prune()
@@ -0,0 +1,126 @@
+import io
+import sys
+
+import pytest
+
+from teamplify_runner.restore import (
+    BULK_LOAD_SETTINGS,
+    SKIP_BINLOG_SETTING,
+    restore,
+    split_dump,
+)
+
+
+DUMP = b"""-- MySQL dump 10.13
+--
+/*!40101 SET NAMES utf8mb4 */;
+/*!40014 SET @OLD_FOREIGN_KEY_CHECKS=@@FOREIGN_KEY_CHECKS, FOREIGN_KEY_CHECKS=0 */;
+
+--
+-- Table structure for table `alpha`
+--
+
+DROP TABLE IF EXISTS `alpha`;
+CREATE TABLE `alpha` (`id` int);
+
+--
+-- Dumping data for table `alpha`
+--
+
+LOCK TABLES `alpha` WRITE;
+INSERT INTO `alpha` VALUES (1),(2);
+UNLOCK TABLES;
+
+--
+-- Table structure for table `beta`
+--
+
+CREATE TABLE `beta` (`id` int);
+INSERT INTO `beta` VALUES (3);
+
+--
+-- Final view structure for view `gamma`
+--
+
+CREATE VIEW `gamma` AS SELECT 1;
+/*!40014 SET FOREIGN_KEY_CHECKS=@OLD_FOREIGN_KEY_CHECKS */;
+"""
+
+ENV = {'DB_USER': 'root', 'DB_PASSWORD': 'secret', 'DB_NAME': 'teamplify'}
+
+
+def _sections(dump, **kwargs):
+    sections = []
+    for kind, name, chunk in split_dump(io.BytesIO(dump), **kwargs):
+        if sections and sections[-1][:2] == (kind, name):
+            sections[-1] = (kind, name, sections[-1][2] + chunk)
+        else:
+            sections.append((kind, name, chunk))
+    return sections
+
+
+def test_split_dump_sections():
+    sections = _sections(DUMP)
+    assert [(kind, name) for kind, name, _ in sections] == [
+        ('preamble', None),
+        ('table', 'alpha'),
+        ('table', 'beta'),
+        ('serial', None),
+    ]
+    assert b'SET NAMES utf8mb4' in sections[0][2]
+    assert b'INSERT INTO `alpha`' in sections[1][2]
+    assert b'CREATE VIEW' in sections[3][2]
+    assert b''.join(chunk for _, _, chunk in sections) == DUMP
+
+
+def test_split_dump_limits_chunk_size():
+    dump = b'-- Table structure for table `t`\n' + b'INSERT INTO `t` VALUES (1);\n' * 1000
+    chunks = list(split_dump(io.BytesIO(dump), chunk_size=1024))
+    assert len(chunks) > 10
+    assert all(len(chunk) < 1024 + 100 for _, _, chunk in chunks)
+    assert b''.join(chunk for _, _, chunk in chunks) == dump
+
+
+def _fake_mysql(tmp_path):
+    # Every connection writes whatever it receives into its own file
+    script = (
+        'import os, shutil, sys, tempfile\n'
+        'fd, path = tempfile.mkstemp(dir=sys.argv[1])\n'
+        'with os.fdopen(fd, "wb") as f:\n'
+        '    shutil.copyfileobj(sys.stdin.buffer, f)\n'
+    )
+    return [sys.executable, '-c', script, str(tmp_path)]
+
+
+def test_restore_loads_tables_over_several_connections(tmp_path):
+    restore(ENV, io.BytesIO(DUMP), connections=2, command=_fake_mysql(tmp_path))
+    outputs = [p.read_bytes() for p in tmp_path.iterdir()]
+    # 2 loader connections + 1 connection for the views
+    assert len(outputs) == 3
+    for output in outputs:
+        assert output.startswith(BULK_LOAD_SETTINGS)
+        assert SKIP_BINLOG_SETTING not in output
+        assert b'SET NAMES utf8mb4' in output
+    combined = b''.join(outputs)
+    assert combined.count(b'INSERT INTO `alpha`') == 1
+    assert combined.count(b'INSERT INTO `beta`') == 1
+    assert combined.count(b'CREATE VIEW') == 1
+
+
+def test_restore_skips_binlog_on_request(tmp_path):
+    restore(
+        ENV,
+        io.BytesIO(DUMP),
+        connections=2,
+        command=_fake_mysql(tmp_path),
+        skip_binlog=True,
+    )
+    outputs = [p.read_bytes() for p in tmp_path.iterdir()]
+    assert len(outputs) == 3
+    assert all(output.startswith(BULK_LOAD_SETTINGS + SKIP_BINLOG_SETTING) for output in outputs)
+
+
+def test_restore_fails_when_connection_fails():
+    command = [sys.executable, '-c', 'import sys; sys.stderr.write("denied"); sys.exit(1)']
+    with pytest.raises(RuntimeError, match='denied'):
+        restore(ENV, io.BytesIO(DUMP), connections=2, command=command)
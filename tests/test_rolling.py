@@ -0,0 +1,82 @@
+import pytest
+
+from teamplify_runner import rolling
+from teamplify_runner.configurator import Configurator
+from teamplify_runner.rolling import (
+    RollingUpdate,
+    RollingUpdateError,
+    check_states,
+    scale_args,
+    service_scale,
+    wait_ready,
+)
+
+
+def test_service_scale():
+    env = Configurator().loads('[web]\ncount = 3\n[worker]\nslim_count = 2\nfat_count = 4\n').env()
+    assert scale_args(service_scale(env)) == [
+        '--scale',
+        'app_replica=2',
+        '--scale',
+        'worker_slim=2',
+        '--scale',
+        'worker_fat_penalized=1',
+        '--scale',
+        'worker_fat=3',
+    ]
+    env = Configurator().loads('[worker]\nfat_count = 0\n').env()
+    scale = service_scale(env)
+    assert scale['worker_fat_penalized'] == 0
+    assert scale['worker_fat'] == 0
+
+
+def test_check_states():
+    assert check_states([('a', 'running', 0, 'healthy')], running_for=0)
+    assert not check_states([('a', 'running', 0, 'starting')], running_for=100)
+    # Containers without a healthcheck must keep running for a while
+    assert not check_states([('a', 'running', 0, '')], running_for=0)
+    assert check_states([('a', 'running', 0, '')], running_for=rolling.SETTLE_SECONDS)
+    for failed in (
+        ('a', 'running', 0, 'unhealthy'),
+        ('a', 'exited', 0, ''),
+        ('a', 'running', 1, ''),
+    ):
+        with pytest.raises(RollingUpdateError):
+            check_states([failed], running_for=0)
+
+
+def test_wait_ready():
+    states = iter(
+        [
+            [('a', 'created', 0, 'starting')],
+            [('a', 'running', 0, 'starting')],
+            [('a', 'running', 0, 'healthy')],
+        ]
+    )
+    wait_ready(['a'], interval=0, inspect=lambda ids: next(states))
+    with pytest.raises(RollingUpdateError, match="didn't become healthy"):
+        wait_ready(
+            ['a'],
+            timeout=0,
+            interval=0,
+            inspect=lambda ids: [('a', 'running', 0, 'starting')],
+        )
+
+
+@pytest.mark.parametrize('old_image', ['sha256:old', None])
+def test_rollback(monkeypatch, capsys, old_image):
+    commands = []
+    monkeypatch.setattr(rolling, '_run', lambda args, **kwargs: commands.append(args))
+    monkeypatch.setattr(rolling, '_compose', lambda env, *args: commands.append(list(args)))
+    env = dict(Configurator().env(), IMAGE_APP='teamplify/server:latest')
+    update = RollingUpdate(env, old_image)
+    update.created = ['new']
+    update.rollback()
+    tags = [args for args in commands if args[:2] == ['docker', 'tag']]
+    if old_image:
+        assert tags == [['docker', 'tag', 'sha256:old', 'teamplify/server:latest']]
+    else:
+        assert tags == []
+        assert 'The previous image is unknown' in capsys.readouterr().out
+    assert ['docker', 'rm', '--force', '--volumes', 'new'] in commands
+    assert commands[-1][:2] == ['up', '--detach']
@@ -0,0 +1,143 @@
+import hashlib
+import os
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+from teamplify_runner.backup import compressor
+from teamplify_runner.s3 import (
+    MultipartUpload,
+    S3Client,
+    S3Error,
+    S3Source,
+    parse_s3_url,
+)
+
+
+class FakeS3Handler(BaseHTTPRequestHandler):
+    """
+    The subset of the S3 API used for backups, keeping objects in memory
+    """
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, body=b'', headers=None):
+        headers = {'Content-Length': str(len(body)), **(headers or {})}
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _parse(self):
+        url = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query, keep_blank_values=True).items()}
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        return url.path, query, body
+
+    def do_POST(self):
+        path, query, body = self._parse()
+        store = self.server.store
+        if 'uploads' in query:
+            upload_id = str(len(store['uploads']) + 1)
+            store['uploads'][upload_id] = {}
+            self._reply(
+                200,
+                '<InitiateMultipartUploadResult><UploadId>{0}</UploadId>'
+                '</InitiateMultipartUploadResult>'.format(upload_id).encode(),
+            )
+        else:
+            parts = store['uploads'].pop(query['uploadId'])
+            numbers = [int(n) for n in re.findall(rb'<PartNumber>(\d+)</PartNumber>', body)]
+            store['objects'][path] = b''.join(parts[n] for n in numbers)
+            self._reply(200, b'<CompleteMultipartUploadResult/>')
+
+    def do_PUT(self):
+        _, query, body = self._parse()
+        self.server.store['uploads'][query['uploadId']][int(query['partNumber'])] = body
+        self._reply(200, headers={'ETag': '"{0}"'.format(hashlib.md5(body).hexdigest())})
+
+    def do_DELETE(self):
+        _, query, _ = self._parse()
+        self.server.store['uploads'].pop(query['uploadId'], None)
+        self.server.store['aborted'] += 1
+        self._reply(204)
+
+    def do_HEAD(self):
+        path, _, _ = self._parse()
+        data = self.server.store['objects'].get(path)
+        if data is None:
+            self._reply(404)
+        else:
+            self._reply(200, headers={'Content-Length': str(len(data))})
+
+    def do_GET(self):
+        path, _, _ = self._parse()
+        data = self.server.store['objects'][path]
+        start, end = re.match(r'bytes=(\d+)-(\d+)', self.headers['Range']).groups()
+        self._reply(206, data[int(start) : int(end) + 1])
+
+
+@pytest.fixture
+def s3():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeS3Handler)
+    server.store = {'objects': {}, 'uploads': {}, 'aborted': 0}
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    client = S3Client(
+        'http://127.0.0.1:{0}'.format(server.server_port),
+        access_key='key',
+        secret_key='secret',
+    )
+    yield client, server.store
+    server.shutdown()
+    server.server_close()
+
+
+def test_parse_s3_url():
+    assert parse_s3_url('s3://bucket/backups/db.sql.gz') == ('bucket', 'backups/db.sql.gz')
+    assert parse_s3_url('s3://bucket') == ('bucket', '')
+    with pytest.raises(S3Error):
+        parse_s3_url('s3:///db.sql.gz')
+
+
+def test_multipart_upload_and_ranged_restore(s3):
+    client, store = s3
+    data = os.urandom(300 * 1024) * 4
+    upload = MultipartUpload(client, 'bucket', 'db.sql.gz', part_size=100 * 1024, concurrency=3)
+    writer = compressor('gzip', upload, level=1)
+    for i in range(0, len(data), 50000):
+        writer.write(data[i : i + 50000])
+    writer.close()
+    upload.close()
+    assert store['objects']['/bucket/db.sql.gz']
+    assert upload.size == len(store['objects']['/bucket/db.sql.gz'])
+
+    source = S3Source(client, 's3://bucket/db.sql.gz', part_size=64 * 1024, concurrency=3)
+    with source:
+        assert source.name == 'db.sql.gz'
+        assert source.stream.read() == data
+        assert source.position() == source.size
+
+
+def test_empty_upload(s3):
+    client, store = s3
+    upload = MultipartUpload(client, 'bucket', 'empty')
+    upload.close()
+    assert store['objects']['/bucket/empty'] == b''
+
+
+def test_aborted_upload(s3):
+    client, store = s3
+    upload = MultipartUpload(client, 'bucket', 'db.sql.gz', part_size=1024)
+    upload.write(b'x' * 4096)
+    upload.abort()
+    assert store['aborted'] == 1
+    assert not store['uploads']
+    assert not store['objects']
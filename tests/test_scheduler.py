@@ -0,0 +1,115 @@
+import gzip
+import io
+import json
+import os
+import tarfile
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+from teamplify_runner.backup import RateLimiter
+from teamplify_runner.scheduler import (
+    SchedulerError,
+    apply_retention,
+    backup_lock,
+    backup_locks,
+    gfs_retention,
+)
+
+
+def test_gfs_retention():
+    # Daily backups for a year, ending on Sunday, 2024-03-31
+    end = datetime(2024, 3, 31, 3)
+    times = [end - timedelta(days=i) for i in range(366)]
+    keep = gfs_retention(times, daily=7, weekly=4, monthly=12)
+    daily = {end - timedelta(days=i) for i in range(7)}
+    assert daily <= keep
+    # Newest backups of the 3 previous weeks, which end on Sundays
+    assert {end - timedelta(weeks=i) for i in range(1, 4)} <= keep
+    # Newest backups of the previous months
+    assert {datetime(2024, 2, 29, 3), datetime(2024, 1, 31, 3), datetime(2023, 4, 30, 3)} <= keep
+    assert datetime(2023, 3, 31, 3) not in keep
+    assert len(keep) == 7 + 3 + 11
+
+    assert gfs_retention(times, daily=0, weekly=0, monthly=0) == {end}
+    assert gfs_retention([]) == set()
+
+
+def test_apply_retention(tmp_path):
+    names = [
+        'teamplify_2024-03-01_03-00-00.sql.gz',
+        'teamplify_2024-03-02_03-00-00.sql.zst',
+        'teamplify_2024-03-02_09-00-00.binlog.tar.gz',
+        'teamplify_2024-03-02_15-00-00.sql.gz',
+        'teamplify_2024-03-02_21-00-00.binlog.tar.gz',
+        'other_2024-03-01_03-00-00.sql.gz',
+        'notes.txt',
+    ]
+    for name in names:
+        (tmp_path / name).write_bytes(b'')
+    removed = apply_retention(str(tmp_path), 'teamplify', daily=1, weekly=0, monthly=0)
+    assert removed == [
+        'teamplify_2024-03-01_03-00-00.sql.gz',
+        'teamplify_2024-03-02_03-00-00.sql.zst',
+        'teamplify_2024-03-02_09-00-00.binlog.tar.gz',
+    ]
+    assert sorted(os.listdir(tmp_path)) == sorted(set(names) - set(removed))
+
+
+def _incremental(path, base):
+    with gzip.open(str(path), 'wb') as f, tarfile.open(fileobj=f, mode='w|') as tar:
+        data = json.dumps({'base': base}).encode()
+        info = tarfile.TarInfo('manifest.json')
+        info.size = len(data)
+        tar.addfile(info, io.BytesIO(data))
+
+
+def test_apply_retention_keeps_bases_of_incrementals(tmp_path):
+    names = [
+        'teamplify_2024-02-29_03-00-00.sql.gz',
+        'teamplify_2024-03-02_03-00-00.sql.gz',
+        'teamplify_2024-03-03_03-00-00.sql.gz',
+        'teamplify_2024-03-04_03-00-00.sql.gz',
+    ]
+    for name in names:
+        (tmp_path / name).write_bytes(b'')
+    # Monthly retention keeps the full backups of February 29th and March
+    # 4th, but an incremental backup in between needs the one of March 2nd
+    _incremental(tmp_path / 'teamplify_2024-03-02_09-00-00.binlog.tar.gz', names[1])
+    removed = apply_retention(str(tmp_path), 'teamplify', daily=1, weekly=0, monthly=2)
+    assert removed == ['teamplify_2024-03-03_03-00-00.sql.gz']
+    assert (tmp_path / names[1]).exists()
+
+
+def test_backup_lock(tmp_path):
+    with backup_lock(str(tmp_path)):
+        with pytest.raises(SchedulerError):
+            with backup_lock(str(tmp_path)):
+                pass
+    with backup_lock(str(tmp_path)):
+        pass
+    other = tmp_path / 'other'
+    other.mkdir()
+    # A manual backup to the directory of a scheduled backup has to wait too
+    with backup_locks(str(other), str(tmp_path), str(tmp_path / '.')):
+        with pytest.raises(SchedulerError):
+            with backup_lock(str(tmp_path)):
+                pass
+    with backup_locks(str(other), str(tmp_path)):
+        pass
+
+
+def test_backup_lock_missing_directory(tmp_path):
+    with pytest.raises(SchedulerError, match='Could not create the backup lock'):
+        with backup_lock(str(tmp_path / 'missing')):
+            pass
+
+
+def test_rate_limiter():
+    limiter = RateLimiter(1024 * 1024)
+    start = time.monotonic()
+    for _ in range(6):
+        limiter.consume(256 * 1024)
+    # The first second worth of data passes as a burst
+    assert 0.4 <= time.monotonic() - start < 1
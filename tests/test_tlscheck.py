@@ -0,0 +1,69 @@
+import shutil
+import ssl
+import subprocess
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from teamplify_runner.tlscheck import TLSCheckError, negotiated, summarize, tls_check
+
+
+class Handler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        body = b'Hello'
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def https_url(tmp_path):
+    if not shutil.which('openssl'):
+        pytest.skip('openssl is not installed')
+    cert, key = str(tmp_path / 'cert.pem'), str(tmp_path / 'key.pem')
+    subprocess.run(
+        [
+            'openssl', 'req', '-x509', '-nodes', '-days', '1', '-subj', '/CN=localhost',
+            '-newkey', 'ec', '-pkeyopt', 'ec_paramgen_curve:prime256v1',
+            '-keyout', key, '-out', cert,
+        ],
+        check=True,
+        capture_output=True,
+    )  # fmt: skip
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert, key)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.socket = context.wrap_socket(server.socket, server_side=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield 'https://127.0.0.1:{0}/'.format(server.server_port)
+    server.shutdown()
+    server.server_close()
+
+
+def test_tls_check(https_url):
+    info = negotiated(https_url, verify=False)
+    assert info.version.startswith('TLS')
+    assert info.key == 'ECDSA'
+    assert info.protocol == 'http/1.1'
+
+    results = tls_check(https_url, count=3, verify=False)
+    assert len(results) == 3
+    assert not results[0].resumed
+    assert all(m.resumed for m in results[1:])
+    for m in results:
+        assert 0 < m.connect <= m.handshake <= m.ttfb
+    names = [name for name, _ in summarize(results)]
+    assert 'Resumed TLS handshake' in names
+
+
+def test_tls_check_verifies_certificate(https_url):
+    with pytest.raises(TLSCheckError):
+        tls_check(https_url, count=2)
+    with pytest.raises(TLSCheckError, match='Not an HTTPS URL'):
+        tls_check('http://127.0.0.1/')
@@ -0,0 +1,33 @@
+from teamplify_runner.configurator import Configurator
+from teamplify_runner.tune import GB, HostResources, config_diff, propose
+
+
+def test_propose_for_a_small_host():
+    proposal = propose(HostResources(cpus=2, memory=4 * GB, rotational=None, disk_free=50 * GB))
+    assert proposal[('web', 'count')] == 1
+    assert proposal[('worker', 'fat_count')] == 2
+    assert proposal[('db', 'innodb_buffer_pool_size')] >= 128
+    assert proposal[('db', 'max_connections')] == 151
+    assert ('db', 'innodb_io_capacity') not in proposal
+
+
+def test_propose_for_a_large_host():
+    host = HostResources(cpus=32, memory=128 * GB, rotational=False, disk_free=1000 * GB)
+    proposal = propose(host)
+    assert proposal[('web', 'count')] == 8
+    assert proposal[('worker', 'slim_count')] == 4
+    assert proposal[('worker', 'fat_count')] == 16
+    assert proposal[('db', 'innodb_buffer_pool_size')] == 64 * 1024
+    assert proposal[('db', 'innodb_buffer_pool_size')] % 128 == 0
+    assert proposal[('db', 'max_connections')] == (8 + 4 + 16 + 1) * 10 + 20
+    assert proposal[('redis', 'maxmemory')] == 2048
+    assert proposal[('db', 'innodb_io_capacity')] == 2000
+
+
+def test_config_diff():
+    config = Configurator().loads('[web]\ncount = 4\n[db]\nmax_connections = 300\n')
+    proposal = {('web', 'count'): 4, ('db', 'max_connections'): 151, ('redis', 'maxmemory'): 256}
+    assert config_diff(config.parser, proposal) == [
+        ('db', 'max_connections', '300', '151'),
+        ('redis', 'maxmemory', '', '256'),
+    ]
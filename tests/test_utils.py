@@ -0,0 +1,93 @@
+import sys
+import time
+
+import pytest
+
+from teamplify_runner import utils
+from teamplify_runner.utils import Command, CommandTimeout, OutputBuffer, run
+
+
+def python(code):
+    return [sys.executable, '-c', code]
+
+
+def test_command_streams_lines():
+    code = 'import sys; print("one"); print("two", file=sys.stderr); print("three")'
+    with Command(python(code)) as command:
+        lines = list(command)
+        assert command.wait() == 0
+    assert [line for name, line in lines if name == 'stdout'] == ['one', 'three']
+    assert [line for name, line in lines if name == 'stderr'] == ['two']
+
+
+def test_command_backpressure():
+    # The command can't print more than the queue holds while nobody reads
+    code = 'import sys\nfor i in range(100000): print(i)\nprint("done", file=sys.stderr)'
+    with Command(python(code), queue_size=10) as command:
+        time.sleep(0.5)
+        assert command.process.poll() is None
+        lines = [line for name, line in command if name == 'stdout']
+        assert command.wait() == 0
+    assert len(lines) == 100000
+
+
+def test_command_timeout_kills_process_group(tmp_path, monkeypatch):
+    # The child ignores SIGTERM and starts a grandchild, which must be
+    # killed as well
+    monkeypatch.setattr(utils, 'KILL_GRACE', 1)
+    marker = tmp_path / 'marker'
+    code = (
+        'import signal, subprocess, sys, time\n'
+        'signal.signal(signal.SIGTERM, signal.SIG_IGN)\n'
+        'subprocess.Popen([sys.executable, "-c", '
+        '"import time; time.sleep(3); open({0!r}, \'w\').close()"])\n'
+        'print("started", flush=True)\n'
+        'time.sleep(60)\n'
+    ).format(str(marker))
+    start = time.monotonic()
+    with pytest.raises(CommandTimeout):
+        with Command(python(code), timeout=1) as command:
+            list(command)
+    assert time.monotonic() - start < 10
+    assert command.process.returncode is not None
+    time.sleep(3)
+    assert not marker.exists()
+
+
+def test_output_buffer_is_bounded():
+    buffer = OutputBuffer(max_bytes=12)
+    for line in ('aaa', 'bbb', 'ccc', 'ddd'):
+        buffer.append(line)
+    assert list(buffer.lines) == ['bbb', 'ccc', 'ddd']
+    assert buffer.truncated
+
+
+def test_run(capsys):
+    result = run(python('print("a b")\nprint()\nprint("c")'), suppress_output=True)
+    assert result.returncode == 0
+    assert result.stdout_lines == ['a b', '', 'c']
+    assert capsys.readouterr().out == ''
+    result = run('{0} -c "print(\'quoted arg\')"'.format(sys.executable))
+    assert result.stdout_lines == ['quoted arg']
+    assert 'quoted arg' in capsys.readouterr().out
+
+
+def test_run_env():
+    result = run(
+        python('import os; print(os.environ["TEST_VALUE"], "PATH" in os.environ)'),
+        suppress_output=True,
+        env={'TEST_VALUE': 'x'},
+    )
+    assert result.stdout_lines == ['x True']
+
+
+def test_run_errors(capsys):
+    code = 'import sys; print("oops", file=sys.stderr); sys.exit(3)'
+    with pytest.raises(RuntimeError, match='exit code 3'):
+        run(python(code), suppress_output=True, exit_on_error=False)
+    # The output of a failed command is shown even if it was suppressed
+    assert 'oops' in capsys.readouterr().err
+    assert run(python(code), raise_on_error=False).returncode == 3
+    assert run(python(code), skip_error_codes=[3]).returncode == 3
+    with pytest.raises(RuntimeError, match='timed out'):
+        run(python('import time; time.sleep(60)'), timeout=0.5, exit_on_error=False)